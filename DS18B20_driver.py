@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+#
+#Direct sysfs reader for a DS18B20 on the kernel's w1 bus. Replaces the W1ThermSensor library on the hot path:
+#the attribute file is opened once and re-read with pread into the same buffer, and the unit conversion is
+#integer math on the kernel's millidegree value.
+
+import os
+import time
+
+
+w1DevicesDir = "/sys/bus/w1/devices"
+familyCode = "28" #DS18B20 family code, the device directory is 28-<address>
+
+#Integer conversion from millidegrees C to tenths of a degree: (milli * num + offset) // den, rounded
+unitScales = {
+    'C': (1, 0, 100),
+    'F': (9, 160000, 500), #milli * 9/5 / 100 + 320
+}
+
+
+#Conversion time in seconds for each resolution in bits. Each bit halves the step size and doubles the wait
+conversionTimes = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+
+#Scratchpad temperature after power on, before any conversion. Reading it means the sensor browned out or the
+#conversion never ran, and a hot tub never gets to 85C
+powerOnResetMilli = 85000
+
+
+class SensorError(Exception):
+    pass
+
+
+#Dallas/Maxim 1-Wire CRC8 (x^8 + x^5 + x^4 + 1), precomputed for every byte value
+crcTable = []
+for value in range(256):
+    crc = 0
+    for bit in range(8):
+        if (crc ^ value) & 1:
+            crc = (crc >> 1) ^ 0x8C
+        else:
+            crc >>= 1
+        value >>= 1
+    crcTable.append(crc)
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = crcTable[crc ^ byte]
+    return crc
+
+
+class ds18b20:
+    def __init__(self, address, unit='F', devicesDir=w1DevicesDir):
+        self.path = os.path.join(devicesDir, familyCode + "-" + address)
+        self.scale = unitScales.get(unit)
+        self.buffer = bytearray(128)
+        self.resolution = 12 #Power-on default
+        self.fd = None
+        self.open()
+
+    def open(self):
+        #Newer kernels expose the converted value as a plain integer in 'temperature'. Older ones only have w1_slave
+        try:
+            self.fd = os.open(os.path.join(self.path, "temperature"), os.O_RDONLY)
+            self.useTemperatureFile = True
+        except OSError:
+            try:
+                self.fd = os.open(os.path.join(self.path, "w1_slave"), os.O_RDONLY)
+            except OSError as error:
+                raise SensorError("No DS18B20 at {}: {}".format(self.path, error))
+            self.useTemperatureFile = False
+
+    def readMilliCelsius(self):
+        #Each pread at offset 0 makes the kernel run a fresh conversion
+        if self.fd is None: #Dropped after a failed read
+            self.open()
+        try:
+            length = os.preadv(self.fd, [self.buffer], 0)
+        except OSError as error:
+            #The kernel fails the read if the sensor stops answering, and a sensor that drops off the bus and comes
+            #back gets a new sysfs entry, so the old fd can't recover. Open it again on the next read
+            self.close()
+            raise SensorError("Read failed: {}".format(error))
+        if self.useTemperatureFile:
+            try:
+                milli = int(self.buffer[:length])
+            except ValueError:
+                raise SensorError("Bad temperature reading {!r}".format(bytes(self.buffer[:length])))
+            if milli == powerOnResetMilli:
+                raise SensorError("Power-on reset value, no conversion")
+            return milli
+        #w1_slave is two lines of the 9 scratchpad bytes in hex, first line ends in the kernel's crc verdict:
+        #72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        #72 01 4b 46 7f ff 0e 10 57 t=23125
+        if length < 27 or not self.buffer[:length].split(b"\n", 1)[0].endswith(b"YES"):
+            raise SensorError("Sensor not ready or crc failed")
+        scratchpad = bytes.fromhex(self.buffer[:26].decode())
+        if crc8(scratchpad[:8]) != scratchpad[8]:
+            raise SensorError("Scratchpad crc mismatch")
+        raw = scratchpad[0] | (scratchpad[1] << 8)
+        raw &= ~((1 << (12 - self.resolution)) - 1) #Low bits are undefined below 12 bit resolution
+        if raw & 0x8000:
+            raw -= 0x10000
+        milli = raw * 125 // 2 #Raw value is in 1/16 degree steps
+        if milli == powerOnResetMilli:
+            raise SensorError("Power-on reset value, no conversion")
+        return milli
+
+    def get_temperature(self):
+        #Temperature in the unit given at startup, rounded to a tenth of a degree
+        num, offset, den = self.scale
+        milli = self.readMilliCelsius()
+        return ((milli * num + offset) * 2 + den) // (den * 2) / 10
+
+    def set_resolution(self, bits):
+        #Change the conversion resolution (9-12 bits) through the kernel's 'resolution' attribute. Not written to
+        #the sensor's EEPROM, so it goes back to 12 bits after a power cycle. Returns False if the kernel is too old
+        if bits == self.resolution:
+            return True
+        try:
+            with open(os.path.join(self.path, "resolution"), "w") as resolutionFile:
+                resolutionFile.write(str(bits))
+        except OSError:
+            return False
+        self.resolution = bits
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ds18b20_bus:
+    #Several DS18B20s on one w1 master. read_all() starts one conversion on every sensor at once through the
+    #kernel's therm_bulk_read, then reads each result, so N sensors cost about one conversion time instead of N.
+    #Kernels without therm_bulk_read fall back to reading the sensors one at a time, as does bulk=False. After a bulk
+    #conversion fails the sensors are read one at a time for bulkBackoff seconds, then bulk conversion is tried again
+    def __init__(self, sensors, master="w1_bus_master1", devicesDir=w1DevicesDir, bulk=None, bulkBackoff=300):
+        self.sensors = sensors #name: ds18b20, or anything with get_temperature/set_resolution/resolution
+        self.bulkPath = os.path.join(devicesDir, master, "therm_bulk_read")
+        if bulk is None:
+            bulk = os.path.exists(self.bulkPath)
+        self.bulk = bulk
+        self.bulkBackoff = bulkBackoff
+        self.bulkRetryTime = 0 #time.monotonic() before which reads go one sensor at a time after a failed bulk conversion
+
+    def set_resolution(self, bits):
+        for sensor in self.sensors.values():
+            sensor.set_resolution(bits)
+
+    def trigger(self):
+        #Start a conversion on every sensor on the bus. Returns the time to wait for it
+        with open(self.bulkPath, "w") as bulkFile:
+            bulkFile.write("trigger")
+        return max(conversionTimes[sensor.resolution] for sensor in self.sensors.values())
+
+    def converting(self):
+        #therm_bulk_read reads -1 while any sensor is still converting
+        with open(self.bulkPath, "rb") as bulkFile:
+            return bulkFile.read().strip() == b"-1"
+
+    def read_all(self):
+        #Returns {name: (temperature, timestamp)} for every sensor that read cleanly, and {name: error} for the rest
+        readings = {}
+        errors = {}
+        if self.bulk and time.monotonic() >= self.bulkRetryTime:
+            try:
+                time.sleep(self.trigger())
+                for i in range(50): #Give slow sensors up to another half second
+                    if not self.converting():
+                        break
+                    time.sleep(0.01)
+            except OSError as error:
+                #The master failed the bulk conversion or its attribute went away (or isn't writable). Nothing on
+                #the bus converted, so this read fails for every sensor, and reads go one sensor at a time until
+                #the backoff is over
+                self.bulkRetryTime = time.monotonic() + self.bulkBackoff
+                error = SensorError("Bulk conversion failed: {}".format(error))
+                return readings, {name: error for name in self.sensors}
+        for name, sensor in self.sensors.items():
+            try:
+                readings[name] = (sensor.get_temperature(), time.time())
+            except SensorError as error:
+                errors[name] = error
+        return readings, errors
+
+
+#Per-read cost against a fake sysfs tree, compared with W1ThermSensor if it is installed
+if __name__ == '__main__':
+    import tempfile
+    reads = 10000
+    with tempfile.TemporaryDirectory() as devicesDir:
+        address = "031722cbb8ff"
+        os.mkdir(os.path.join(devicesDir, familyCode + "-" + address))
+        with open(os.path.join(devicesDir, familyCode + "-" + address, "w1_slave"), "w") as slave:
+            slave.write("72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n")
+        sensor = ds18b20(address, 'F', devicesDir)
+        start = time.process_time()
+        for i in range(reads):
+            sensor.get_temperature()
+        print("ds18b20 w1_slave:      {:.1f} us per read ({})".format((time.process_time() - start) / reads * 1e6, sensor.get_temperature()))
+        sensor.close()
+
+        with open(os.path.join(devicesDir, familyCode + "-" + address, "temperature"), "w") as temperature:
+            temperature.write("23125\n")
+        sensor = ds18b20(address, 'F', devicesDir)
+        start = time.process_time()
+        for i in range(reads):
+            sensor.get_temperature()
+        print("ds18b20 temperature:   {:.1f} us per read ({})".format((time.process_time() - start) / reads * 1e6, sensor.get_temperature()))
+        sensor.close()
+
+        try:
+            from w1thermsensor import W1ThermSensor
+        except ImportError:
+            print("w1thermsensor not installed, skipping comparison")
+        else:
+            W1ThermSensor.BASE_DIRECTORY = devicesDir
+            os.remove(os.path.join(devicesDir, familyCode + "-" + address, "temperature"))
+            libSensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, address)
+            start = time.process_time()
+            for i in range(reads):
+                libSensor.get_temperature(W1ThermSensor.DEGREES_F)
+            print("W1ThermSensor:         {:.1f} us per read".format((time.process_time() - start) / reads * 1e6))
+
+        #Four sensors with one bulk conversion. Wall time is dominated by the single conversion wait
+        os.mkdir(os.path.join(devicesDir, "w1_bus_master1"))
+        with open(os.path.join(devicesDir, "w1_bus_master1", "therm_bulk_read"), "w") as bulkFile:
+            bulkFile.write("0\n")
+        sensors = {}
+        for name in ["Water in", "Water out", "Heater", "Ambient"]:
+            sensorAddress = "{:012x}".format(len(sensors) + 1)
+            os.mkdir(os.path.join(devicesDir, familyCode + "-" + sensorAddress))
+            with open(os.path.join(devicesDir, familyCode + "-" + sensorAddress, "temperature"), "w") as temperature:
+                temperature.write("{}\n".format(20000 + len(sensors) * 1500))
+            sensors[name] = ds18b20(sensorAddress, 'F', devicesDir)
+        bus = ds18b20_bus(sensors, devicesDir=devicesDir)
+        start = time.time()
+        readings, errors = bus.read_all()
+        print("ds18b20_bus, 4 sensors: {:.3f} s per read ({} sequential conversions would take {:.3f} s)".format(
+            time.time() - start, len(sensors), conversionTimes[12] * len(sensors)))
+        for name in readings:
+            print("   {}: {}".format(name, readings[name][0]))
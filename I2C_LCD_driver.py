@@ -13,29 +13,53 @@ Made available under GNU GENERAL PUBLIC LICENSE
 """
 #
 #
-import smbus2 as smbus
+try:
+   import smbus2 as smbus
+except ImportError: # only recording_bus works without smbus2
+   smbus = None
 from time import *
 
 class i2c_device:
-   def __init__(self, addr, port=1):
+   def __init__(self, addr, port=1, bus=None):
       self.addr = addr
-      self.bus = smbus.SMBus(port)
+      if bus is None:
+         bus = smbus.SMBus(port)
+      self.bus = bus
+      # stand-in buses bring their own i2c_msg so they work without smbus2
+      self.i2c_msg = getattr(bus, 'i2c_msg', None) or smbus.i2c_msg
+      # totals for metrics, only updated by whichever thread drives the LCD
+      self.transactions = 0
+      self.bytes_written = 0
 
 # Write a single command
    def write_cmd(self, cmd):
       self.bus.write_byte(self.addr, cmd)
+      self.transactions += 1
+      self.bytes_written += 1
       sleep(0.0001)
 
 # Write a command and argument
    def write_cmd_arg(self, cmd, data):
       self.bus.write_byte_data(self.addr, cmd, data)
+      self.transactions += 1
+      self.bytes_written += 2
       sleep(0.0001)
 
 # Write a block of data
    def write_block_data(self, cmd, data):
       self.bus.write_block_data(self.addr, cmd, data)
+      self.transactions += 1
+      self.bytes_written += len(data) + 1
       sleep(0.0001)
 
+# Write a run of bytes as one transaction. The bus clock paces the bytes,
+# 9 bit times each, so no sleeps are needed between them
+   def write_bytes(self, data):
+      for start in range(0, len(data), I2C_MAX_WRITE):
+         self.bus.i2c_rdwr(self.i2c_msg.write(self.addr, data[start:start + I2C_MAX_WRITE]))
+         self.transactions += 1
+      self.bytes_written += len(data)
+
 # Read a single byte
    def read(self):
       return self.bus.read_byte(self.addr)
@@ -48,7 +72,45 @@ class i2c_device:
    def read_block_data(self, cmd):
       return self.bus.read_block_data(self.addr, cmd)
 
+# Stand-in for smbus2.SMBus that records every transaction instead of sending
+# it, as (kind, bytes written). bus_time() is what the same traffic would
+# take on the wire at the given clock
+class recording_bus:
+   class i2c_msg:
+      @staticmethod
+      def write(addr, data):
+         return bytes(data)
+
+   def __init__(self, port=1):
+      self.transactions = []
+
+   def write_byte(self, addr, value):
+      self.transactions.append(('byte', bytes([value])))
+
+   def write_byte_data(self, addr, cmd, value):
+      self.transactions.append(('byte_data', bytes([cmd, value])))
+
+   def write_block_data(self, addr, cmd, data):
+      self.transactions.append(('block_data', bytes([cmd, len(data)] + list(data))))
+
+   def i2c_rdwr(self, *msgs):
+      for msg in msgs:
+         self.transactions.append(('rdwr', bytes(msg)))
+
+   def written(self):
+      return b''.join(data for kind, data in self.transactions)
+
+   def bus_time(self, clock=100000):
+      # start + address byte + data bytes + stop, 9 clocks per byte
+      return sum((len(data) + 1) * 9 + 2 for kind, data in self.transactions) / clock
 
+   def clear(self):
+      self.transactions = []
+
+
+# Largest single write handed to i2c_rdwr. A full 80 character frame is 960
+# bytes, so one frame is normally one transaction
+I2C_MAX_WRITE = 4096
 
 # LCD Address
 ADDRESS = 0x27
@@ -99,10 +161,18 @@ En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
 
+# display geometry, and the DDRAM address of the first cell of each line
+LCD_ROWS = 4
+LCD_COLS = 20
+LCD_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
 class lcd:
-   #initializes objects and lcd
-   def __init__(self):
-      self.lcd_device = i2c_device(ADDRESS)
+   #initializes objects and lcd. Give address for panels that aren't at ADDRESS,
+   # e.g. several on one bus with their backpacks' address jumpers set
+   def __init__(self, bus=None, address=ADDRESS):
+      self.lcd_device = i2c_device(address, bus=bus)
+      self.batch = None
+      self.batch_depth = 0
 
       self.lcd_write(0x03)
       self.lcd_write(0x03)
@@ -115,6 +185,12 @@ class lcd:
       self.lcd_write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
       sleep(0.2)
 
+      # shadow copy of what the panel shows, plus the DDRAM address counter
+      self.frame = [[' '] * LCD_COLS for row in range(LCD_ROWS)]
+      self.cursor = 0x00
+      # pattern in each CGRAM slot, None until this driver has written it
+      self.cgram = [None] * 8
+
 
    # clocks EN to latch command
    def lcd_strobe(self, data):
@@ -132,6 +208,37 @@ class lcd:
       self.lcd_write_four_bits(mode | (cmd & 0xF0))
       self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
 
+   # expander bytes for one command or character, the same sequence lcd_write
+   # sends: for each nibble, data, data with EN high, data with EN low
+   def lcd_bytes(self, cmd, mode=0):
+      high = mode | (cmd & 0xF0) | LCD_BACKLIGHT
+      low = mode | ((cmd << 4) & 0xF0) | LCD_BACKLIGHT
+      return bytes((high, high | En, high & ~En, low, low | En, low & ~En))
+
+   # send a command or character, or queue it if a batch is open. Only for
+   # writes that complete within one byte time (not clear or home)
+   def lcd_send(self, cmd, mode=0):
+      if self.batch is None:
+         self.lcd_device.write_bytes(self.lcd_bytes(cmd, mode))
+      else:
+         self.batch += self.lcd_bytes(cmd, mode)
+
+   # collect lcd_send writes and send them as one I2C transaction on flush.
+   # Batches nest, only the outermost flush sends
+   def lcd_begin(self):
+      if self.batch is None:
+         self.batch = bytearray()
+      self.batch_depth += 1
+
+   def lcd_flush(self):
+      self.batch_depth -= 1
+      if self.batch_depth > 0:
+         return
+      if self.batch:
+         self.lcd_device.write_bytes(bytes(self.batch))
+      self.batch = None
+      self.batch_depth = 0
+
    # write a character to lcd (or character rom) 0x09: backlight | RS=DR<
    # works!
    def lcd_write_char(self, charvalue, mode=1):
@@ -141,22 +248,19 @@ class lcd:
 
    # put string function
    def lcd_display_string(self, string, line):
-      if line == 1:
-         self.lcd_write(0x80)
-      if line == 2:
-         self.lcd_write(0xC0)
-      if line == 3:
-         self.lcd_write(0x94)
-      if line == 4:
-         self.lcd_write(0xD4)
-
-      for char in string:
-         self.lcd_write(ord(char), Rs)
+      self.lcd_display_string_pos(string, line, 0)
 
    # clear lcd and set to home
    def lcd_clear(self):
       self.lcd_write(LCD_CLEARDISPLAY)
       self.lcd_write(LCD_RETURNHOME)
+      self.frame = [[' '] * LCD_COLS for row in range(LCD_ROWS)]
+      self.cursor = 0x00
+
+   # forget the shadow frame so the next lcd_display_frame redraws every cell
+   def lcd_invalidate(self):
+      self.frame = [[None] * LCD_COLS for row in range(LCD_ROWS)]
+      self.cursor = None
 
    # define backlight on/off (lcd.backlight(1); off= lcd.backlight(0)
    def backlight(self, state): # for state, 1 = on, 0 = off
@@ -165,25 +269,139 @@ class lcd:
       elif state == 0:
          self.lcd_device.write_cmd(LCD_NOBACKLIGHT)
 
-   # add custom characters (0 - 7)
+   # add custom characters (0 - 7), from slot 0. Slots that already hold the
+   # same pattern are skipped
    def lcd_load_custom_chars(self, fontdata):
-      self.lcd_write(0x40);
-      for char in fontdata:
-         for line in char:
-            self.lcd_write_char(line)         
-         
+      self.lcd_begin()
+      for slot, char in enumerate(fontdata):
+         self.lcd_load_custom_char(slot, char)
+      self.lcd_flush()
+
+   # put one custom character (8 rows of 5 bits, top first) in a CGRAM slot,
+   # unless it is already there. Returns True if it was sent
+   def lcd_load_custom_char(self, slot, pattern):
+      pattern = tuple(pattern)
+      if self.cgram[slot] == pattern:
+         return False
+      self.lcd_send(LCD_SETCGRAMADDR | (slot << 3))
+      self.cursor = None # address counter now points into CGRAM
+      for line in pattern:
+         self.lcd_send(line, Rs)
+      self.cgram[slot] = pattern
+      return True
+
    # define precise positioning (addition from the forum)
    def lcd_display_string_pos(self, string, line, pos):
-    if line == 1:
-      pos_new = pos
-    elif line == 2:
-      pos_new = 0x40 + pos
-    elif line == 3:
-      pos_new = 0x14 + pos
-    elif line == 4:
-      pos_new = 0x54 + pos
+    pos_new = LCD_ROW_OFFSETS[line - 1] + pos
 
-    self.lcd_write(0x80 + pos_new)
+    self.lcd_begin()
+    self.lcd_set_address(pos_new)
 
     for char in string:
-      self.lcd_write(ord(char), Rs)
+      self.lcd_write_data(char)
+    self.lcd_flush()
+
+   # move the DDRAM address counter, skipped if it is already there
+   def lcd_set_address(self, addr):
+      if addr != self.cursor:
+         self.lcd_send(LCD_SETDDRAMADDR | addr)
+         self.cursor = addr
+
+   # write one character at the cursor and keep the shadow frame in step
+   def lcd_write_data(self, char):
+      self.lcd_send(ord(char), Rs)
+      if self.cursor is not None:
+         index = ddram_to_index(self.cursor)
+         if index is not None:
+            row, col = index_to_cell(index)
+            self.frame[row][col] = char
+            self.cursor = index_to_ddram((index + 1) % LCD_CELLS)
+         else:
+            self.cursor = None
+
+   # show a whole frame (list of up to 4 strings), only sending the cells that
+   # differ from what the panel already shows
+   def lcd_display_frame(self, lines):
+      self.lcd_begin()
+      for addr, text in self.frame_diff(lines):
+         self.lcd_set_address(addr)
+         for char in text:
+            self.lcd_write_data(char)
+      self.lcd_flush()
+
+   # work out the runs (DDRAM address, text) needed to turn the shadow frame
+   # into the new one. A single unchanged cell between two changes is rewritten,
+   # since that costs the same as the address command needed to skip it
+   def frame_diff(self, lines):
+      wanted = []
+      for row in range(LCD_ROWS):
+         text = lines[row] if row < len(lines) else ''
+         wanted.append(text[:LCD_COLS].ljust(LCD_COLS))
+
+      runs = []
+      for index in range(LCD_CELLS):
+         row, col = index_to_cell(index)
+         if self.frame[row][col] == wanted[row][col]:
+            continue
+         if runs and index - runs[-1][1] <= 2:
+            runs[-1][1] = index
+         else:
+            runs.append([index, index])
+
+      diff = []
+      for start, end in runs:
+         text = ''
+         for index in range(start, end + 1):
+            row, col = index_to_cell(index)
+            text += wanted[row][col]
+         diff.append((index_to_ddram(start), text))
+      return diff
+
+
+# In 2 line mode the address counter runs 0x00-0x27 then 0x40-0x67, which on a
+# 20x4 panel is lines 1, 3, 2, 4 in that order. Cells are numbered along that
+# path so that consecutive numbers are consecutive writes
+LCD_CELLS = LCD_ROWS * LCD_COLS
+LCD_WRITE_ORDER = (0, 2, 1, 3)
+
+def index_to_cell(index):
+   return LCD_WRITE_ORDER[index // LCD_COLS], index % LCD_COLS
+
+def index_to_ddram(index):
+   row, col = index_to_cell(index)
+   return LCD_ROW_OFFSETS[row] + col
+
+# map a DDRAM address back to its cell number, or None if it is not on the panel
+def ddram_to_index(addr):
+   for path in range(LCD_ROWS):
+      col = addr - LCD_ROW_OFFSETS[LCD_WRITE_ORDER[path]]
+      if 0 <= col < LCD_COLS:
+         return path * LCD_COLS + col
+   return None
+
+
+# Cost of drawing a full 80 character frame, one write at a time as before and
+# batched into one transaction. Runs against recording_bus, so no panel needed
+if __name__ == '__main__':
+   bus = recording_bus()
+   panel = lcd(bus=bus)
+   frame = ['Temp: 101.3 -> 102  ', 'Hold Temp - Manual  ', 'PUMP HEAT BLOW LIGHT', '      23:59:59      ']
+
+   bus.clear()
+   start = time()
+   for line in range(LCD_ROWS):
+      panel.lcd_write(LCD_SETDDRAMADDR | LCD_ROW_OFFSETS[line])
+      for char in frame[line]:
+         panel.lcd_write(ord(char), Rs)
+   legacy_time = time() - start
+   legacy = bus.written()
+   print('write per byte: %d transactions, %d bytes, %.1f ms wall, %.1f ms on the bus'
+         % (len(bus.transactions), len(legacy), legacy_time * 1000, bus.bus_time() * 1000))
+
+   panel.lcd_invalidate()
+   bus.clear()
+   start = time()
+   panel.lcd_display_frame(frame)
+   batched_time = time() - start
+   print('batched frame:  %d transactions, %d bytes, %.1f ms wall, %.1f ms on the bus'
+         % (len(bus.transactions), len(bus.written()), batched_time * 1000, bus.bus_time() * 1000))
@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+#
+#Performance benchmarks for the control loop, input path and display path. Runs the real control code against
+#sim_backend's stand-ins, with I2C time taken from recording_bus's virtual bus clock, and writes the results as
+#JSON so runs from different releases can be compared.
+#
+#Usage: python3 benchmark.py [results.json]
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import sim_backend
+import DS18B20_driver
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {"p{}".format(point): ordered[min(len(ordered) - 1, len(ordered) * point // 100)] for point in points}
+
+
+def benchmarkControlLoop(hours=6):
+    #A schedule mode evening with someone using the buttons. Times every main loop pass and every button press
+    #from the GPIO edge to the first relay change it causes, in real (not virtual) time
+    start = time.mktime((2026, 1, 5, 16, 0, 0, 0, 0, -1))
+    sim = sim_backend.simulation(start, hours, {"defaultMode": 1})
+    for minutes in range(30, hours * 60, 45): #Wake the screen, pump on, blower on, blower off
+        for offset, button in enumerate(["pumpButtonPin", "pumpButtonPin", "blowerButtonPin", "blowerButtonPin"]):
+            sim.press(button, start + minutes * 60 + offset * 2)
+
+    passTimes = []
+    buttonLatencies = []
+    pending = {"pass": None, "press": None}
+    realSleep = sim.clock.sleep
+    def timedSleep(seconds, wakeEvent=None):
+        if pending["pass"] is not None:
+            passTimes.append(time.perf_counter() - pending["pass"])
+        realSleep(seconds, wakeEvent)
+        pending["pass"] = time.perf_counter()
+    sim.clock.sleep = timedSleep
+    realPress = sim.gpio.press
+    def timedPress(pin, hold=0.2):
+        pending["press"] = time.perf_counter()
+        realPress(pin, hold)
+    sim.gpio.press = timedPress
+    def relayChanged(pin, value):
+        if pending["press"] is not None:
+            buttonLatencies.append(time.perf_counter() - pending["press"])
+            pending["press"] = None
+    sim.gpio.outputHooks.append(relayChanged)
+
+    cpuStart = time.process_time()
+    controller = sim_backend.run(sim)
+    cpuTime = time.process_time() - cpuStart
+    sim.checkInterlock()
+
+    bus = controller["lcd"].lcd_device.bus
+    frames = max(controller["displayFramesRendered"], 1)
+    frameBytes = sum(len(data) for kind, data in bus.transactions)
+    return {
+        "simulated_hours": hours,
+        "loop_passes": len(passTimes),
+        "loop_pass_seconds": percentiles(passTimes),
+        "button_presses_measured": len(buttonLatencies),
+        "button_to_relay_seconds": percentiles(buttonLatencies),
+        "frames": controller["displayFramesRendered"],
+        "i2c_transactions_per_frame": len(bus.transactions) / frames,
+        "i2c_bytes_per_frame": frameBytes / frames,
+        "i2c_bus_seconds_per_frame": bus.bus_time() / frames,
+        "cpu_seconds_per_simulated_hour": cpuTime / hours,
+        "relay_transitions": len(sim.gpio.transitions),
+        "relay_gpio_writes": controller["relays"].writes,
+        "relay_redundant_requests": controller["relays"].suppressed,
+    }
+
+
+def benchmarkDisplay():
+    #Full redraw and clear on the real driver over recording_bus. Wall time includes the driver's own sleeps
+    import I2C_LCD_driver
+    bus = I2C_LCD_driver.recording_bus()
+    panel = I2C_LCD_driver.lcd(bus=bus)
+    frame = ["Temp: 101.3 -> 102", "Hold Temp - Manual", "PUMP HEAT BLOW LIGHT", "      23:59:59"]
+    results = {}
+    for name, action in [("full_frame", lambda: (panel.lcd_invalidate(), panel.lcd_display_frame(frame))),
+                         ("clock_tick", lambda: panel.lcd_display_frame(frame[:3] + ["      00:00:00"])),
+                         ("lcd_clear", panel.lcd_clear)]:
+        bus.clear()
+        wallStart = time.perf_counter()
+        action()
+        results[name] = {"wall_seconds": time.perf_counter() - wallStart, "transactions": len(bus.transactions),
+                         "bytes": len(bus.written()), "bus_seconds": bus.bus_time()}
+    #The heater switching on, with the status row as words and as icons already loaded into CGRAM
+    import lcd_glyphs
+    glyphs = lcd_glyphs.cache(panel)
+    glyphs.beginFrame()
+    iconRow = glyphs.char("pumpHigh") + " " + glyphs.char("heat") + " " + glyphs.char("blower") + " " + glyphs.char("light")
+    for name, before, after in [("heater_on_words", "PUMP      BLOW LIGHT", "PUMP HEAT BLOW LIGHT"),
+                                ("heater_on_icons", iconRow[:2] + " " + iconRow[3:], iconRow)]:
+        panel.lcd_display_frame(frame[:2] + [before] + frame[3:])
+        bus.clear()
+        panel.lcd_display_frame(frame[:2] + [after] + frame[3:])
+        results[name] = {"transactions": len(bus.transactions), "bytes": len(bus.written()), "bus_seconds": bus.bus_time()}
+    return results
+
+
+def benchmarkSensor(reads=5000):
+    #CPU cost of one DS18B20_driver read against a fake sysfs tree, for each file the kernel might offer
+    results = {}
+    with tempfile.TemporaryDirectory() as devicesDir:
+        address = "031722cbb8ff"
+        sensorDir = os.path.join(devicesDir, DS18B20_driver.familyCode + "-" + address)
+        os.mkdir(sensorDir)
+        with open(os.path.join(sensorDir, "w1_slave"), "w") as slave:
+            slave.write("72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n")
+        for name in ["w1_slave", "temperature"]:
+            if name == "temperature":
+                with open(os.path.join(sensorDir, "temperature"), "w") as temperature:
+                    temperature.write("23125\n")
+            sensor = DS18B20_driver.ds18b20(address, 'F', devicesDir)
+            cpuStart = time.process_time()
+            for i in range(reads):
+                sensor.get_temperature()
+            results[name + "_read_seconds"] = (time.process_time() - cpuStart) / reads
+            sensor.close()
+    return results
+
+
+def benchmarkMetrics(updates=100000):
+    #Cost of the instrumentation on the hot path, next to one LCD character write on the real driver
+    import I2C_LCD_driver
+    import metrics
+    registry = metrics.registry()
+    count = registry.counter("test_total", "Test counter")
+    timing = registry.histogram("test_seconds", "Test histogram", (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+    results = {}
+    for name, action in [("counter_inc_seconds", count.inc), ("histogram_observe_seconds", lambda: timing.observe(0.003))]:
+        start = time.perf_counter()
+        for i in range(updates):
+            action()
+        results[name] = (time.perf_counter() - start) / updates
+    bus = I2C_LCD_driver.recording_bus()
+    panel = I2C_LCD_driver.lcd(bus=bus)
+    bus.clear()
+    start = time.perf_counter()
+    panel.lcd_write_char(ord("A"))
+    results["lcd_char_write_wall_seconds"] = time.perf_counter() - start
+    results["lcd_char_write_bus_seconds"] = bus.bus_time()
+    start = time.perf_counter()
+    registry.text()
+    results["export_text_seconds"] = time.perf_counter() - start
+    return results
+
+
+def benchmarkStartup(runs=5):
+    #Time from the top of hottubcontrol.py to the relays being driven off, and to the end of the first control pass,
+    #in a fresh interpreter each run so the imports are counted. The simulation sets up the LCD and sensor in line,
+    #so this is the slow case; on the Pi they start in parallel with the rest
+    import subprocess
+    script = ("import json, sys, time, sim_backend\n"
+              "sim = sim_backend.simulation(time.time(), 0.01)\n"
+              "controller = sim_backend.run(sim)\n"
+              "json.dump([controller['startupSafeSeconds'], controller['startupDecisionSeconds']], sys.stdout)\n")
+    safe = []
+    decision = []
+    for run in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, check=True).stdout
+        runSafe, runDecision = json.loads(output)
+        safe.append(runSafe)
+        decision.append(runDecision)
+    return {"safe_outputs_seconds": percentiles(safe, (50, 100)), "first_decision_seconds": percentiles(decision, (50, 100))}
+
+
+def benchmarkHistory(days=30):
+    #Cost of logging one record from the main loop, of each flush to the SD card, and of scanning a month of each
+    #tier back with history_log.read()
+    import history_log
+    results = {}
+    with tempfile.TemporaryDirectory() as historyDir, tempfile.TemporaryDirectory() as spoolDir:
+        start = 1767225600.0 #2026-01-01 UTC
+        log = history_log.logger(historyDir, spoolDir, 3600, {"raw": 0})
+        appendStart = time.perf_counter()
+        for second in range(86400):
+            log.append(start + second, 95 + second % 600 / 100, 95, 98, 1, 0, 5)
+        results["append_seconds"] = (time.perf_counter() - appendStart) / 86400
+        flushStart = time.perf_counter()
+        log.flush(start + 86400)
+        results["flush_seconds"] = time.perf_counter() - flushStart
+        log.close()
+        #Copy the day out to the rest of the month, shifting the times
+        for tier in ["raw", "minute"]:
+            recordFormat = history_log.recordFormats[tier]
+            day = list(history_log.read(historyDir, tier))
+            for offset in range(1, days):
+                path = os.path.join(historyDir, history_log.segmentName(tier, start + offset * 86400))
+                with open(path, "ab") as segmentFile:
+                    segmentFile.write(b"".join(recordFormat.pack(record[0] + offset * 86400, *record[1:]) for record in day))
+        for tier in ["raw", "minute"]:
+            scanStart = time.perf_counter()
+            total = 0
+            count = 0
+            for record in history_log.read(historyDir, tier, start, start + days * 86400):
+                total += record[1 if tier == "raw" else 4]
+                count += 1
+            results[tier + "_scan"] = {"records": count, "seconds": time.perf_counter() - scanStart}
+    return results
+
+
+def benchmarkReplay(days=7):
+    #Record days of schedule mode, with the buttons used every evening, to a trace and time trace_log.replay()
+    #running it back. month_seconds scales that to 30 days
+    import trace_log
+    start = time.mktime((2026, 1, 5, 0, 0, 0, 0, 0, -1))
+    options = {"defaultMode": 1, "scheduleWindows": [("daily", "17:00", "22:00")]}
+    with tempfile.TemporaryDirectory() as traceDir:
+        sim = sim_backend.simulation(start, days * 24, dict(options, traceFile=os.path.join(traceDir, "trace.bin"),
+                                                                  thermalModelFile=os.path.join(traceDir, "model.json")))
+        for day in range(days):
+            for offset, button in enumerate(["pumpButtonPin", "pumpButtonPin", "blowerButtonPin", "blowerButtonPin"]):
+                sim.press(button, start + day * 86400 + 20 * 3600 + offset * 2)
+        recordStart = time.perf_counter()
+        sim_backend.run(sim)
+        recordTime = time.perf_counter() - recordStart
+        replayStart = time.perf_counter()
+        recorded, replayed, differences = trace_log.replay(os.path.join(traceDir, "trace.bin"),
+                                                           dict(options, thermalModelFile=os.path.join(traceDir, "replay.json")))
+        replayTime = time.perf_counter() - replayStart
+        return {"days": days, "trace_bytes": os.path.getsize(os.path.join(traceDir, "trace.bin")),
+                "record_seconds": recordTime, "replay_seconds": replayTime, "month_seconds": replayTime / days * 30,
+                "relay_changes": len(recorded), "differences": len(differences)}
+
+
+def benchmarkWebApi(requests=5000, clients=20):
+    #Requests per second and latency of GET /status from local keep-alive clients, and what the main loop's side
+    #(publishing a changed status, draining commands) costs while they hammer the server
+    import asyncio
+    import threading
+    import web_api
+    api = web_api.server(port=0)
+    api.start()
+    fieldNames = ("currentTemp", "targetTemp", "runMode")
+    request = b"GET /status HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    latencies = []
+
+    async def client(count):
+        reader, writer = await asyncio.open_connection("127.0.0.1", api.boundPort)
+        for i in range(count):
+            sent = time.perf_counter()
+            writer.write(request)
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+                if line == b"\r\n":
+                    break
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - sent)
+        writer.close()
+
+    async def burst():
+        await asyncio.gather(*[client(requests // clients) for i in range(clients)])
+
+    loopCosts = []
+    done = threading.Event()
+    def controlLoop():
+        #Stand-in for the main loop: a new status every pass, as when the temperature changes
+        temp = 90.0
+        while not done.is_set():
+            passStart = time.perf_counter()
+            temp += 0.1
+            api.publish(fieldNames, (round(temp, 1), 100, 1))
+            for command in api.pending():
+                pass
+            loopCosts.append(time.perf_counter() - passStart)
+            time.sleep(0.001)
+    loopThread = threading.Thread(target=controlLoop)
+    loopThread.start()
+    wallStart = time.perf_counter()
+    asyncio.run(burst())
+    wall = time.perf_counter() - wallStart
+    done.set()
+    loopThread.join()
+    api.stop()
+    return {"requests": len(latencies), "clients": clients, "requests_per_second": len(latencies) / wall,
+            "latency_seconds": percentiles(latencies), "status_updates": api.statusUpdates,
+            "control_loop_publish_seconds": percentiles(loopCosts)}
+
+
+def benchmarkMultiTub(counts=(1, 4, 16), hours=1):
+    #Step latency of multi_tub.py's scheduler against the stand-in hardware, from the start of a pass to the end of
+    #each tub's step, with every tub's pump running so each one samples its sensor every second. The percentiles
+    #are over the last 10000 steps, worst_step_seconds and slow_steps over the whole run. step_cpu_seconds is the
+    #scheduler thread's CPU time over the same spans, so the gap to step_latency_seconds is time the host took away
+    import multi_tub
+    results = {}
+    start = time.mktime((2026, 1, 5, 18, 0, 0, 0, 0, -1))
+    for count in counts:
+        configs = sim_backend.multiConfigs(count)
+        for config in configs:
+            config["scheduleWindows"] = [("daily", "17:00", "22:00")]
+        sim = sim_backend.multiSimulation(start, hours, configs)
+        wallStart = time.perf_counter()
+        tubScheduler = multi_tub.simulate(sim)
+        controllers = tubScheduler.controllers.values()
+        results["tubs_{}".format(count)] = {"wall_seconds": time.perf_counter() - wallStart,
+            "steps": sum(tub.steps for tub in controllers), "sensor_reads": tubScheduler.sensors.reads,
+            "step_latency_seconds": percentiles(tubScheduler.latencies),
+            "step_cpu_seconds": percentiles(tubScheduler.cpuLatencies),
+            "worst_step_seconds": max(tub.worstStep for tub in controllers),
+            "slow_steps": sum(tub.slowSteps for tub in controllers), "bound_seconds": multi_tub.stepLatencyBound,
+            "save_seconds": percentiles(tubScheduler.saveTimes)}
+    return results
+
+
+if __name__ == '__main__':
+    outputFile = sys.argv[1] if len(sys.argv) > 1 else "benchmark_results.json"
+    results = {
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "startup": benchmarkStartup(),
+        "control_loop": benchmarkControlLoop(),
+        "display": benchmarkDisplay(),
+        "sensor": benchmarkSensor(),
+        "web_api": benchmarkWebApi(),
+        "metrics": benchmarkMetrics(),
+        "history": benchmarkHistory(),
+        "replay": benchmarkReplay(),
+        "multi_tub": benchmarkMultiTub(),
+    }
+    with open(outputFile, "w") as resultsFile:
+        json.dump(results, resultsFile, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+#
+#Button input for the controller. A sampler reads every button pin, runs each pin through its own integrating
+#debounce filter and puts a (pin, time) event on a queue for every debounced press. While every pin is settled
+#released it reads them at a slow idle rate, and at the full rate from the first low read until they settle again. The control loop
+#drains the queue, so how quickly a press is seen doesn't depend on what else the loop was doing, and a button
+#held down can't upset the others. In interrupt mode the GPIO edge callbacks feed the same queue.
+
+import queue
+import threading
+
+
+class sampler:
+    def __init__(self, gpio, pins, clock, samplePeriod=0.005, debounceTime=0.02, repressTime=0.3, wake=None, idlePeriod=None):
+        self.gpio = gpio
+        self.pins = list(pins)
+        self.clock = clock
+        self.samplePeriod = samplePeriod #Seconds between reads of every pin
+        self.idlePeriod = samplePeriod if idlePeriod is None else idlePeriod #Seconds between reads while none is busy()
+        self.integratorMax = max(1, round(debounceTime / samplePeriod)) #Consecutive-ish reads before a change counts
+        self.repressTime = repressTime #A press this soon after the same pin was released is ignored
+        self.wake = wake #Called after an event is queued, e.g. the main loop's wakeEvent.set
+        self.events = queue.SimpleQueue() #(pin, time the pin first read low)
+        self.integrators = dict.fromkeys(self.pins, 0) #0 is settled released, integratorMax settled pressed
+        self.pressed = dict.fromkeys(self.pins, False) #Debounced state
+        self.lowSince = dict.fromkeys(self.pins, None) #Time of the first low read of the press being filtered
+        self.releaseTimes = dict.fromkeys(self.pins, float("-inf"))
+        self.samples = 0
+        self.inputMany = getattr(gpio, "input_many", None) #Reads every pin in one call where the backend can
+        self.stopEvent = threading.Event()
+
+    def sample(self):
+        #Read every pin once and step its filter. Low is pressed, the buttons pull the pin to ground
+        now = self.clock.time()
+        self.samples += 1
+        if self.inputMany is not None:
+            levels = self.inputMany(self.pins)
+        else:
+            levels = [self.gpio.input(pin) for pin in self.pins]
+        for pin, level in zip(self.pins, levels):
+            count = self.integrators[pin]
+            if level == 0:
+                if count == 0:
+                    self.lowSince[pin] = now
+                if count < self.integratorMax:
+                    count += 1
+                    if count == self.integratorMax and not self.pressed[pin]:
+                        self.pressed[pin] = True
+                        if now - self.releaseTimes[pin] > self.repressTime:
+                            self.put(pin, self.lowSince[pin])
+            elif count > 0:
+                count -= 1
+                if count == 0 and self.pressed[pin]:
+                    self.pressed[pin] = False
+                    self.releaseTimes[pin] = now
+            self.integrators[pin] = count
+
+    def busy(self):
+        #True while any pin is between settled states or held down, so it still needs sampling
+        for pin in self.pins:
+            if self.integrators[pin]:
+                return True
+        return False
+
+    def put(self, pin, when):
+        self.events.put((pin, when))
+        if self.wake is not None:
+            self.wake()
+
+    def edge(self, pin):
+        #GPIO edge callback for interrupt mode. RPi.GPIO's bouncetime has already filtered the contact bounce
+        self.put(pin, self.clock.time())
+
+    def pending(self):
+        #Yields queued (pin, time) events without blocking
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    def run(self):
+        #Sampling thread. Deadlines are fixed multiples of samplePeriod so a slow read doesn't shift the rest. A press
+        #is first seen up to idlePeriod after it starts, and the debounce runs at samplePeriod from there
+        nextSample = self.clock.time()
+        while not self.stopEvent.is_set():
+            self.sample()
+            nextSample += self.samplePeriod if self.busy() else self.idlePeriod
+            delay = nextSample - self.clock.time()
+            if delay < 0: #Fell behind, don't try to catch up with a burst of reads
+                nextSample = self.clock.time()
+            else:
+                self.stopEvent.wait(delay)
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopEvent.set()
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+#
+#GPIO through the Linux gpiochip character device (the v2 uAPI in linux/gpio.h), as an alternative to RPi.GPIO.
+#It has the same calls the controller uses from RPi.GPIO, but all inputs are claimed in one line request and all
+#outputs in another. input_many() reads every button with one ioctl, and output() with lists of pins and values
+#sets every relay in it with one ioctl, so the kernel changes them together and pumpRunHigh() never has both pump
+#relays in between states.
+#
+#Line offsets on the Pi's main gpiochip are the BCM numbers. Lines are released when the process exits.
+#
+#Usage: python3 gpiochip_backend.py /dev/gpiochipN <input line> <output line> exercises a chip, e.g. one made
+#with the kernel's gpio-sim module, and times single and bulk access
+
+import fcntl
+import os
+import select
+import struct
+import threading
+
+
+#From linux/gpio.h
+linesMax = 64
+nameSize = 32
+attrsMax = 10
+FLAG_ACTIVE_LOW = 1 << 1
+FLAG_INPUT = 1 << 2
+FLAG_OUTPUT = 1 << 3
+FLAG_EDGE_RISING = 1 << 4
+FLAG_EDGE_FALLING = 1 << 5
+FLAG_BIAS_PULL_UP = 1 << 8
+FLAG_BIAS_PULL_DOWN = 1 << 9
+ATTR_ID_FLAGS = 1
+ATTR_ID_OUTPUT_VALUES = 2
+ATTR_ID_DEBOUNCE = 3
+EVENT_FALLING_EDGE = 2
+
+lineAttribute = struct.Struct("<IIQ") #id, padding, flags/values/debounce_period_us
+configAttribute = struct.Struct("<" + lineAttribute.format[1:] + "Q") #Attribute, mask of lines it applies to
+lineConfig = struct.Struct("<QI20x" + (configAttribute.format[1:]) * attrsMax) #flags, num_attrs, padding, attrs
+lineRequest = struct.Struct("<{}I{}s{}sII20xi".format(linesMax, nameSize, lineConfig.size))
+lineValues = struct.Struct("<QQ") #bits, mask
+lineEvent = struct.Struct("<QIIII24x") #timestamp_ns, id, offset, seqno, line_seqno
+
+
+def iowr(number, size):
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | number
+
+GET_LINE_IOCTL = iowr(0x07, lineRequest.size)
+GET_VALUES_IOCTL = iowr(0x0E, lineValues.size)
+SET_VALUES_IOCTL = iowr(0x0F, lineValues.size)
+
+
+def packConfig(flags, attributes):
+    #attributes is [(id, value, mask)], at most attrsMax
+    values = []
+    for attributeId, value, mask in attributes:
+        values += [attributeId, 0, value, mask]
+    values += [0, 0, 0, 0] * (attrsMax - len(attributes))
+    return lineConfig.pack(flags, len(attributes), *values)
+
+
+class lines:
+    #One line request, a group of lines read or written together. Values are 0/1 as on the pins
+    def __init__(self, chipFd, offsets, flags, consumer, attributes=()):
+        self.offsets = list(offsets)
+        self.bits = {offset: 1 << index for index, offset in enumerate(self.offsets)}
+        self.allMask = (1 << len(self.offsets)) - 1
+        request = bytearray(lineRequest.pack(*(self.offsets + [0] * (linesMax - len(self.offsets))),
+            consumer.encode()[:nameSize - 1], packConfig(flags, attributes), len(self.offsets), 0, -1))
+        fcntl.ioctl(chipFd, GET_LINE_IOCTL, request)
+        self.fd = lineRequest.unpack(request)[-1]
+        self.values = bytearray(lineValues.size) #Reused by every get/set, no allocation per call
+        self.levels = 0 #Bitmap of what an output request was last set to, since the kernel would read back the same
+
+    def get(self, mask=None):
+        #Bitmap of the levels of the lines in mask (all of them by default), bit n for self.offsets[n]
+        lineValues.pack_into(self.values, 0, 0, self.allMask if mask is None else mask)
+        fcntl.ioctl(self.fd, GET_VALUES_IOCTL, self.values)
+        return lineValues.unpack_from(self.values)[0]
+
+    def set(self, bits, mask):
+        lineValues.pack_into(self.values, 0, bits, mask)
+        fcntl.ioctl(self.fd, SET_VALUES_IOCTL, self.values)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class chip:
+    #Stand-in for the RPi.GPIO module. setup() only records what each pin should be. The outputs set up so far are
+    #requested together, at their initial values, by commit() or the first output(), so they all change in one
+    #request from then on. A held output line is never released until cleanup(): on the Pi a released line can go
+    #back to an input and float, which is a relay glitch. Setting up an output again only sets its value on the
+    #request that holds it, and an output set up after commit() gets a request of its own. Inputs are requested
+    #together on first use, and again whenever setup() changes them
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_UP = 22
+    PUD_DOWN = 21
+    FALLING = 32
+
+    def __init__(self, path="/dev/gpiochip0", consumer="hottubcontrol"):
+        self.path = path
+        self.consumer = consumer
+        self.chipFd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        self.inputPins = {} #Pin: pull
+        self.outputPins = {} #Pin: initial value
+        self.pendingOutputs = [] #Output pins set up since the last commit(), not requested yet
+        self.outputRequests = [] #lines requests holding the outputs, in the order they were made
+        self.outputOf = {} #Pin: the lines request holding it
+        self.edgePins = {} #Pin: (callback, bouncetime in ms)
+        self.inputs = None
+        self.detected = set()
+        self.eventThread = None
+
+    def setmode(self, mode):
+        pass #Line offsets are always BCM numbers
+
+    def setup(self, pin, direction, initial=None, pull_up_down=None):
+        if direction == self.OUT:
+            if pin in self.inputPins:
+                del self.inputPins[pin]
+                self.edgePins.pop(pin, None)
+                self.release("inputs") #Requested again without this pin on next use
+            level = 1 if initial is None else int(initial)
+            self.outputPins[pin] = level
+            if pin in self.outputOf:
+                if initial is not None: #Already held, so only its value changes
+                    self.output(pin, level)
+            elif pin not in self.pendingOutputs:
+                self.pendingOutputs.append(pin)
+        else:
+            if pin in self.outputOf:
+                raise ValueError("GPIO {} is held as an output until cleanup()".format(pin))
+            if pin in self.pendingOutputs:
+                self.pendingOutputs.remove(pin)
+                del self.outputPins[pin]
+            self.inputPins[pin] = pull_up_down
+            self.release("inputs")
+
+    def commit(self):
+        #Request every output set up since the last commit in one line request, each at its initial value. The
+        #controller calls this straight after setting up the relay pins, so they are driven off from then on
+        if not self.pendingOutputs:
+            return
+        pins = self.pendingOutputs
+        self.pendingOutputs = []
+        levels = 0
+        for index, pin in enumerate(pins):
+            levels |= self.outputPins[pin] << index
+        request = lines(self.chipFd, pins, FLAG_OUTPUT, self.consumer, [(ATTR_ID_OUTPUT_VALUES, levels, (1 << len(pins)) - 1)])
+        request.levels = levels
+        self.outputRequests.append(request)
+        for pin in pins:
+            self.outputOf[pin] = request
+
+    def release(self, group):
+        if getattr(self, group) is not None:
+            getattr(self, group).close()
+            setattr(self, group, None)
+
+    def requestInputs(self):
+        pins = list(self.inputPins)
+        attributes = []
+        #Lines share one set of flags unless an attribute overrides them, so group the pins by flags
+        flagGroups = {}
+        for index, pin in enumerate(pins):
+            flags = FLAG_INPUT
+            if self.inputPins[pin] == self.PUD_UP:
+                flags |= FLAG_BIAS_PULL_UP
+            elif self.inputPins[pin] == self.PUD_DOWN:
+                flags |= FLAG_BIAS_PULL_DOWN
+            if pin in self.edgePins:
+                flags |= FLAG_EDGE_FALLING
+            flagGroups[flags] = flagGroups.get(flags, 0) | 1 << index
+        for flags, mask in flagGroups.items():
+            attributes.append((ATTR_ID_FLAGS, flags, mask))
+        debounce = {}
+        for index, pin in enumerate(pins):
+            if pin in self.edgePins and self.edgePins[pin][1]:
+                period = self.edgePins[pin][1] * 1000
+                debounce[period] = debounce.get(period, 0) | 1 << index
+        for period, mask in debounce.items():
+            attributes.append((ATTR_ID_DEBOUNCE, period, mask))
+        self.inputs = lines(self.chipFd, pins, FLAG_INPUT, self.consumer, attributes[:attrsMax])
+        if self.edgePins and self.eventThread is None:
+            self.eventThread = threading.Thread(target=self.readEvents)
+            self.eventThread.setDaemon(True)
+            self.eventThread.start()
+        return self.inputs
+
+    def output(self, pins, values):
+        #One pin and value, or lists of them like RPi.GPIO. A list is set with one ioctl per request it touches,
+        #which is one for pins that were set up before the same commit()
+        if self.pendingOutputs:
+            self.commit()
+        if isinstance(pins, int):
+            pins = (pins,)
+            values = (values,)
+        elif isinstance(values, int):
+            values = (values,) * len(pins)
+        masks = {}
+        for pin, value in zip(pins, values):
+            request = self.outputOf[pin]
+            bit = request.bits[pin]
+            masks[request] = masks.get(request, 0) | bit
+            if value:
+                request.levels |= bit
+            else:
+                request.levels &= ~bit
+        for request, mask in masks.items():
+            request.set(request.levels, mask)
+
+    def input(self, pin):
+        if pin in self.outputPins:
+            if self.pendingOutputs:
+                self.commit()
+            request = self.outputOf[pin]
+            return int(bool(request.levels & request.bits[pin]))
+        inputs = self.inputs or self.requestInputs()
+        bit = inputs.bits[pin]
+        return int(bool(inputs.get(bit)))
+
+    def input_many(self, pins):
+        #Levels of several input pins from one ioctl, in the order given
+        inputs = self.inputs or self.requestInputs()
+        levels = inputs.get()
+        return [int(bool(levels & inputs.bits[pin])) for pin in pins]
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        #Falling edges only, which is all the controller uses. bouncetime becomes the kernel's debounce period
+        self.edgePins[pin] = (callback, bouncetime)
+        self.release("inputs")
+        self.requestInputs()
+
+    def event_detected(self, pin):
+        if pin in self.detected:
+            self.detected.discard(pin)
+            return True
+        return False
+
+    def readEvents(self):
+        #Edge events come in on the inputs request fd, which is replaced whenever the inputs are requested again
+        while True:
+            inputs = self.inputs
+            if inputs is None:
+                threading.Event().wait(0.1)
+                continue
+            try:
+                ready = select.select([inputs.fd], [], [], 1)[0]
+                if not ready:
+                    continue
+                data = os.read(inputs.fd, lineEvent.size * 16)
+            except (OSError, ValueError): #Closed under us by a new request
+                continue
+            for start in range(0, len(data) - lineEvent.size + 1, lineEvent.size):
+                timestamp, eventId, offset, seqno, lineSeqno = lineEvent.unpack_from(data, start)
+                if eventId == EVENT_FALLING_EDGE and offset in self.edgePins:
+                    self.detected.add(offset)
+                    callback = self.edgePins[offset][0]
+                    if callback is not None:
+                        callback(offset)
+
+    def cleanup(self, *pins):
+        #Like RPi.GPIO, forget every pin. The kernel puts the lines back when they are released
+        self.release("inputs")
+        for request in self.outputRequests:
+            request.close()
+        self.inputPins = {}
+        self.outputPins = {}
+        self.pendingOutputs = []
+        self.outputRequests = []
+        self.outputOf = {}
+        self.edgePins = {}
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    gpio = chip(sys.argv[1])
+    inputPin, outputPin = int(sys.argv[2]), int(sys.argv[3])
+    gpio.setup(inputPin, gpio.IN, pull_up_down=gpio.PUD_UP)
+    gpio.setup(outputPin, gpio.OUT, initial=1)
+    for name, action in [("input", lambda: gpio.input(inputPin)), ("input_many", lambda: gpio.input_many([inputPin])),
+                         ("output", lambda: gpio.output(outputPin, 1)), ("output list", lambda: gpio.output([outputPin], [1]))]:
+        start = time.perf_counter()
+        for i in range(10000):
+            action()
+        print("{}: {:.1f} us".format(name, (time.perf_counter() - start) / 10000 * 1e6))
+    gpio.cleanup()
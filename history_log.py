@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+#
+#Long term history of the temperatures, target, relays and mode, in fixed width binary records. Each record is
+#appended to a spool file in RAM (tmpfs, like webOutputFile), and the spools are copied to the SD card in one
+#sequential write every flushInterval, so the card sees a few large appends an hour instead of one small write a
+#second. Only what was spooled since the last flush is lost in a power cut; a restart of the controller alone
+#loses nothing.
+#
+#There are three tiers. raw has one record per sample, minute and hour are rolled up from them with the min, max
+#and mean temperature and the fraction of the time the pump and heater were on. Each tier is split into segments
+#by UTC date (a day of raw, a month of minute, a year of hour records), and segments older than the tier's
+#retention are deleted. A segment is nothing but records back to back in time order, no header, so it can be
+#mapped straight into a NumPy structured array with numpy.memmap(path, numpyDtype(tier)), or scanned without
+#NumPy by read(), which finds the start of a time range by bisecting the mapped file.
+#
+#Usage: python3 history_log.py directory [tier] [hours] prints the last hours of a tier, 24 of minute by default
+
+from bisect import bisect_left
+import calendar
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+
+#Record layouts. Both are multiples of 8 bytes so the doubles stay aligned when mapped
+recordFormats = {
+    "raw": struct.Struct("<dfffBBBx"),
+    "minute": struct.Struct("<dIfffffffBB6x"),
+}
+recordFormats["hour"] = recordFormats["minute"]
+fieldNames = {
+    "raw": ("time", "currentTemp", "controlTemp", "targetTemp", "runMode", "manualMode", "flags"),
+    "minute": ("time", "count", "tempMin", "tempMax", "tempMean", "controlMean", "targetMean", "pumpOn", "heaterOn",
+               "runMode", "flags"),
+}
+fieldNames["hour"] = fieldNames["minute"]
+tierSeconds = {"minute": 60, "hour": 3600} #Bucket length of the rolled up tiers
+segmentFormats = {"raw": "%Y%m%d", "minute": "%Y%m", "hour": "%Y"} #UTC, so a segment is never split by a DST change
+#Bits in flags. Rolled up records have every bit that was set at any time in the bucket
+flagBits = {"pumpLow": 1, "pumpHigh": 2, "heater": 4, "blower": 8, "light": 16, "preheat": 32}
+pumpBits = flagBits["pumpLow"] | flagBits["pumpHigh"]
+numpyTypes = {"d": "<f8", "f": "<f4", "I": "<u4", "B": "u1"}
+
+
+def numpyDtype(tier):
+    #Description of a record for numpy.dtype(), including the padding
+    layout = recordFormats[tier].format[1:].rstrip("x0123456789")
+    offsets = [struct.calcsize("<" + layout[:position]) for position in range(len(layout))]
+    return {"names": list(fieldNames[tier]), "formats": [numpyTypes[code] for code in layout], "offsets": offsets,
+            "itemsize": recordFormats[tier].size}
+
+
+def segmentName(tier, when):
+    return "{}-{}.bin".format(tier, time.strftime(segmentFormats[tier], time.gmtime(when)))
+
+
+def segmentSpan(name):
+    #(start, end) epoch times covered by a segment file name, or None if it isn't one
+    tier, sep, rest = name.partition("-")
+    if tier not in segmentFormats or not rest.endswith(".bin"):
+        return None
+    try:
+        date = time.strptime(rest[:-4], segmentFormats[tier])
+    except ValueError:
+        return None
+    year, month, day = date[0], date[1], date[2]
+    start = calendar.timegm((year, month, day, 0, 0, 0))
+    if tier == "raw":
+        return start, start + 86400
+    if tier == "minute":
+        return start, calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+    return start, calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+
+
+def segments(directory, tier, start=0, end=math.inf):
+    #Paths of a tier's segments that overlap start to end, oldest first
+    found = []
+    for name in os.listdir(directory):
+        span = segmentSpan(name)
+        if span and name.startswith(tier + "-") and span[0] < end and span[1] > start:
+            found.append((span[0], os.path.join(directory, name)))
+    return [path for spanStart, path in sorted(found)]
+
+
+class timeIndex:
+    #The time field of each record in a mapped segment, as a sequence bisect can search without unpacking the rest
+    def __init__(self, block, recordSize):
+        self.block = block
+        self.recordSize = recordSize
+
+    def __len__(self):
+        return len(self.block) // self.recordSize
+
+    def __getitem__(self, index):
+        return struct.unpack_from("<d", self.block, index * self.recordSize)[0]
+
+
+def bisectTime(block, recordSize, when):
+    #Index of the first record at or after when
+    return bisect_left(timeIndex(block, recordSize), when)
+
+
+def lastRecordTime(path, tier):
+    #Time of the last whole record in a segment or spool file, -inf if there isn't one
+    recordSize = recordFormats[tier].size
+    try:
+        with open(path, "rb") as segmentFile:
+            size = os.fstat(segmentFile.fileno()).st_size // recordSize * recordSize
+            if size == 0:
+                return -math.inf
+            return struct.unpack("<d", os.pread(segmentFile.fileno(), 8, size - recordSize))[0]
+    except FileNotFoundError:
+        return -math.inf
+
+
+def readFile(path, tier, start=0, end=math.inf):
+    #Records from one segment or spool file with start <= time < end, as tuples in fieldNames order
+    recordFormat = recordFormats[tier]
+    with open(path, "rb") as segmentFile:
+        size = os.fstat(segmentFile.fileno()).st_size // recordFormat.size * recordFormat.size
+        if size == 0:
+            return
+        with mmap.mmap(segmentFile.fileno(), size, access=mmap.ACCESS_READ) as block:
+            first = bisectTime(block, recordFormat.size, start)
+            last = bisectTime(block, recordFormat.size, end) if end != math.inf else size // recordFormat.size
+            view = memoryview(block)[first * recordFormat.size:last * recordFormat.size]
+            try:
+                yield from recordFormat.iter_unpack(view)
+            finally:
+                view.release()
+
+
+def read(directory, tier, start=0, end=math.inf, spoolDirectory=None):
+    #Every record of a tier between start and end, oldest first. Give spoolDirectory to include what hasn't been
+    #flushed to directory yet
+    for path in segments(directory, tier, start, end):
+        yield from readFile(path, tier, start, end)
+    if spoolDirectory:
+        spoolPath = os.path.join(spoolDirectory, tier + ".spool")
+        if os.path.exists(spoolPath):
+            yield from readFile(spoolPath, tier, start, end)
+
+
+def load(directory, tier, start=0, end=math.inf):
+    #The flushed records of a tier between start and end as one NumPy structured array. Needs NumPy, which the
+    #controller itself doesn't
+    import numpy
+    dtype = numpy.dtype(numpyDtype(tier))
+    parts = []
+    for path in segments(directory, tier, start, end):
+        count = os.path.getsize(path) // dtype.itemsize
+        if count == 0:
+            continue
+        records = numpy.memmap(path, dtype, mode="r", shape=(count,))
+        times = records["time"]
+        parts.append(records[numpy.searchsorted(times, start):numpy.searchsorted(times, end)])
+    if not parts:
+        return numpy.zeros(0, dtype)
+    return numpy.concatenate(parts)
+
+
+class rollup:
+    #One bucket of a rolled up tier being built from raw records
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.tempMin = math.inf
+        self.tempMax = -math.inf
+        self.tempSum = 0
+        self.controlSum = 0
+        self.targetSum = 0
+        self.pumpCount = 0
+        self.heaterCount = 0
+        self.runMode = 0
+        self.flags = 0
+
+    def add(self, when, currentTemp, controlTemp, targetTemp, runMode, manualMode, flags):
+        self.count += 1
+        self.tempMin = min(self.tempMin, currentTemp)
+        self.tempMax = max(self.tempMax, currentTemp)
+        self.tempSum += currentTemp
+        self.controlSum += controlTemp
+        self.targetSum += targetTemp
+        if flags & pumpBits:
+            self.pumpCount += 1
+        if flags & flagBits["heater"]:
+            self.heaterCount += 1
+        self.runMode = runMode
+        self.flags |= flags
+
+    def pack(self):
+        count = self.count
+        return recordFormats["minute"].pack(self.start, count, self.tempMin, self.tempMax, self.tempSum / count,
+            self.controlSum / count, self.targetSum / count, self.pumpCount / count, self.heaterCount / count,
+            self.runMode, self.flags)
+
+
+class logger:
+    def __init__(self, directory, spoolDirectory, flushInterval=3600, retention=None):
+        self.directory = directory
+        self.spoolDirectory = spoolDirectory
+        self.flushInterval = flushInterval #Seconds between copies of the spools to directory
+        self.retention = {"raw": 31 * 86400, "minute": 400 * 86400, "hour": 0} #Seconds kept per tier, 0 is forever
+        self.retention.update(retention or {})
+        os.makedirs(directory, exist_ok=True)
+        os.makedirs(spoolDirectory, exist_ok=True)
+        self.spools = {} #Tier: fd of its spool file
+        self.spoolSegments = {} #Tier: name of the segment the spooled records belong in
+        for tier in recordFormats:
+            self.spools[tier] = os.open(os.path.join(spoolDirectory, tier + ".spool"), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            first = os.pread(self.spools[tier], 8, 0)
+            self.spoolSegments[tier] = segmentName(tier, struct.unpack("<d", first)[0]) if len(first) == 8 else None
+        self.buckets = {"minute": None, "hour": None} #rollup being built for each rolled up tier
+        self.lastFlush = None
+        self.lastTime = -math.inf
+        self.records = 0 #Appended since startup
+        self.flushes = 0
+        self.bytesFlushed = 0
+        self.resume()
+
+    def resume(self):
+        #After a restart, rebuild the buckets still open from the raw records already logged in them
+        rawSegments = segments(self.directory, "raw")
+        self.lastTime = max(lastRecordTime(rawSegments[-1], "raw") if rawSegments else -math.inf,
+                            lastRecordTime(os.path.join(self.spoolDirectory, "raw.spool"), "raw"))
+        if self.lastTime == -math.inf:
+            return
+        added = -math.inf
+        for record in read(self.directory, "raw", self.lastTime - self.lastTime % 3600, spoolDirectory=self.spoolDirectory):
+            if record[0] > added: #Skip anything both flushed and still spooled
+                self.addToBuckets(record, False)
+                added = record[0]
+
+    def addToBuckets(self, record, spoolClosed=True):
+        #Close any bucket the record is past, then add it to the open ones. Closed buckets are spooled unless
+        #spoolClosed is off, when resume() replays records whose buckets were spooled before the restart
+        when = record[0]
+        for tier, seconds in tierSeconds.items():
+            bucket = self.buckets[tier]
+            bucketStart = when - when % seconds
+            if bucket is not None and bucket.start != bucketStart:
+                if spoolClosed:
+                    self.spool(tier, bucket.start, bucket.pack())
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[tier] = rollup(bucketStart)
+            bucket.add(*record)
+
+    def spool(self, tier, when, data):
+        name = segmentName(tier, when)
+        if self.spoolSegments[tier] != name: #A spool only ever holds one segment's records
+            self.flushTier(tier)
+            self.spoolSegments[tier] = name
+        os.write(self.spools[tier], data)
+
+    def append(self, when, currentTemp, controlTemp, targetTemp, runMode, manualMode, flags):
+        #Log one sample. Times must go forward; a sample at or before the last one is dropped
+        if when <= self.lastTime:
+            return False
+        record = (when, currentTemp, controlTemp, targetTemp, runMode, manualMode, flags)
+        self.addToBuckets(record)
+        self.spool("raw", when, recordFormats["raw"].pack(*record))
+        self.lastTime = when
+        self.records += 1
+        if self.lastFlush is None:
+            self.lastFlush = when
+        elif when - self.lastFlush >= self.flushInterval:
+            self.flush(when)
+        return True
+
+    def flushTier(self, tier):
+        #Append the tier's spool to its segment in one write and empty the spool. Records the segment already has,
+        #from a flush that was cut off before the spool was emptied, are skipped
+        spool = self.spools[tier]
+        recordSize = recordFormats[tier].size
+        size = os.fstat(spool).st_size // recordSize * recordSize
+        if size == 0 or self.spoolSegments[tier] is None:
+            return
+        data = os.pread(spool, size, 0)
+        path = os.path.join(self.directory, self.spoolSegments[tier])
+        with open(path, "a+b") as segmentFile:
+            segmentSize = segmentFile.seek(0, os.SEEK_END)
+            if segmentSize % recordSize: #Cut off mid record, drop the partial one so the rest stay aligned
+                segmentSize -= segmentSize % recordSize
+                segmentFile.truncate(segmentSize)
+            if segmentSize:
+                lastTime = struct.unpack("<d", os.pread(segmentFile.fileno(), 8, segmentSize - recordSize))[0]
+                data = data[bisectTime(data, recordSize, math.nextafter(lastTime, math.inf)) * recordSize:]
+            segmentFile.write(data)
+            segmentFile.flush()
+            os.fsync(segmentFile.fileno())
+        os.ftruncate(spool, 0)
+        self.bytesFlushed += len(data)
+
+    def flush(self, now):
+        #Copy every spool to the SD card and drop segments past retention
+        for tier in recordFormats:
+            self.flushTier(tier)
+        self.prune(now)
+        self.lastFlush = now
+        self.flushes += 1
+
+    def prune(self, now):
+        for tier, keep in self.retention.items():
+            if not keep:
+                continue
+            for path in segments(self.directory, tier, 0, now - keep):
+                if segmentSpan(os.path.basename(path))[1] <= now - keep:
+                    os.remove(path)
+
+    def nextFlush(self):
+        return (self.lastFlush or 0) + self.flushInterval
+
+    def close(self, now=None):
+        #Flush everything spooled so far. The open buckets stay in the raw records and are rebuilt on the next start
+        self.flush(self.lastTime if now is None else now)
+        for spool in self.spools.values():
+            os.close(spool)
+        self.spools = {}
+
+
+if __name__ == '__main__':
+    historyDirectory = sys.argv[1]
+    tier = sys.argv[2] if len(sys.argv) > 2 else "minute"
+    hours = float(sys.argv[3]) if len(sys.argv) > 3 else 24
+    spoolDirectory = "/dev/shm/hottubhistory"
+    for record in read(historyDirectory, tier, time.time() - hours * 3600, spoolDirectory=spoolDirectory if os.path.isdir(spoolDirectory) else None):
+        values = dict(zip(fieldNames[tier], record))
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(values.pop("time"))),
+              " ".join("{}={}".format(name, round(value, 2) if isinstance(value, float) else value) for name, value in values.items()))
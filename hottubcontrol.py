@@ -2,13 +2,30 @@
 #
 #10/22/2017 Steven Kaye
 
-import I2C_LCD_driver #Note that this file contains the I2C address and certain settings
-import RPi.GPIO as GPIO
-#from ds18b20 import DS18B20
-from w1thermsensor import W1ThermSensor
 import time
+startupStart = time.perf_counter() #Startup times are measured from here, see startupSafeSeconds
+import I2C_LCD_driver #Note that this file contains the I2C address and certain settings
+import DS18B20_driver
+import temp_history
+import button_input
+import metrics
+import profiler
+import tub_controller
+import lcd_glyphs
 import sys
 import threading
+import signal
+import collections
+import os
+#trace_log, status_block, web_api, history_log and gpiochip_backend are only imported if their options are on,
+#after the relays are safe. web_api pulls in asyncio, which takes a good part of a second to import on a Pi 1
+
+simBackend = sys.modules.get("sim_backend") #Only ever loaded by sim_backend itself, never on the Pi
+sim = simBackend.current if simBackend else None #Set when running under sim_backend instead of on the Pi
+if sim is None:
+    clock = time
+else:
+    clock = sim.clock #Virtual time, only moves when the main loop sleeps
 
 
 #Set configurable constants
@@ -35,489 +52,611 @@ inactivityTimeoutMinutes = 60
 screenTimeoutMinutes = 5
 tempCheckTimes = [0] #If minute is one of these times, check temperature in hold temp mode (format [0, 15, 30, 45])
 sensorWarmupTime = 60 #Time in seconds. Sensor is mounted externally on this hot tub so it's going to take a while before it reflects the current temp
+maxTempAge = 120 #Time in seconds. The heater stays off until there's a good temperature reading, and goes off if there's been none for this long
 heaterCooldownTimeMinutes = 5 #Time in minutes. The high amperage heater will destroy its relay over time. It's best to cycle it on and off as infrequently as possible
-timeWindowStart = 18 #Hours to run filter/heat cycle
+timeWindowStart = 18 #Hours to run filter/heat cycle, from the start of timeWindowStart to the end of timeWindowEnd. Only used if scheduleWindows is empty
 timeWindowEnd = 20
+scheduleWindows = [] #Filter/heat windows as (days, start, end), e.g. [("weekdays", "18:00", "21:00"), ("weekends", "09:30", "12:00"), ("fri,sat", "22:00", "01:00")]. Days are daily, weekdays, weekends or day names. An end before the start runs past midnight
+scheduleExceptions = [] #One-off changes as (start, end, on), e.g. [("2026-12-24 12:00", "2026-12-26 22:00", 1)] to run the window over those days, or 0 to skip it
+enablePreheat = 1 #In schedule mode, start heating before timeWindowStart so the tub is at targetTemp when the window opens
+maxPreheatMinutes = 180 #Never start the preheat earlier than this before the window
+stateFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hottubstate.json") #runMode, targetTemp, heater cooldown, learned heating/cooling rates and relay cycle counts, restored at startup
+stateSaveInterval = 60 #Time in seconds. stateFile is only written when something in it changed, and at most this often
 temperatureUnit = 'F' #Uppercase F or C. Bad inputs will cause program to stop
 minTemp = 60
 maxTemp = 108 #Dont go crazy with these
 maxTempSag = 0.2 #Prevent short cycles on the heater by not turning it on until it's this far below targetTemp. Only functions in Schedule and Manual modes
 buttonType = 1 #0 is interrupt triggers, 1 is time-based polling
+gpioBackend = "RPi.GPIO" #"RPi.GPIO" or "gpiochip", which uses the kernel's GPIO character device to read all buttons at once and switch relays that change together in one step
+gpioChip = "/dev/gpiochip0" #Only for the gpiochip backend. Line numbers on it must be the BCM numbers, as on gpiochip0 of a Pi 1-4
 buttonBounceTime = 300 #Lower for better button response, raise to avoid accidental doubleclicks
-enableWebOutput = 0
+buttonSampleTime = 0.005 #Time in seconds between reads of every button pin by the input thread, in polling mode
+buttonIdleSampleTime = 0.05 #Time in seconds between reads while every button is released, in polling mode. A press is seen within this, then read every buttonSampleTime until released
+buttonDebounceTime = 0.02 #Time in seconds a pin has to (mostly) read the same before a press or release counts, in polling mode
+lcdIcons = 1 #Show the pump, heater, blower and light as one-character icons, with a temperature trend arrow and a heating progress bar. 0 shows them as words
+tempTrendRate = 0.05 #Degrees per minute the temperature has to be changing by for the trend arrow to show rising or falling
+heatBarDegrees = 10 #The heating progress bar fills over the last this many degrees below targetTemp
+enableWebOutput = 0 #Publish the status to webOutputFile every loop for other programs to read with status_block.py
 webOutputFile = "/dev/shm/hottubstatus" #This should be something in RAM to avoid excessive writes to the SD card
+enableWebApi = 0 #Serve status and accept targetTemp/runMode commands over HTTP, see web_api.py
+webApiAddress = "127.0.0.1" #Use "0.0.0.0" to allow other machines on the network. There is no authentication
+webApiPort = 8080
 tempSensorAddress = "031722cbb8ff" #Check for this in /sys/bus/w1/devices/
+#Temperature sampling policies: (seconds between samples, resolution in bits). Resolution changes need the sysfs backend
+sensorPolicies = {
+    "pump off": (30, 9), #Water isn't moving past the sensor, the reading is only for the display
+    "warmup": (5, 9), #Pump running but sensorWarmupTime not up yet, readings aren't compared
+    "heating": (1, 10), #Heater on and well below target, track the rise quickly
+    "near setpoint": (0, 12), #Within nearSetpointBand of turnOnTemp/targetTemp, full resolution back to back
+    "normal": (1, 12),
+}
+nearSetpointBand = 1.0 #Degrees either side of turnOnTemp/targetTemp that count as near the setpoint
+extraTempSensors = {} #Other DS18B20s on the same bus as name: address, e.g. {"Water in": "0317...", "Ambient": "0416..."}. Read with one bulk conversion. Needs the sysfs backend
+tempFilter = "median" #Temperature the heater decisions use: "median" of the last tempMedianWindow samples, "ema" (exponential moving average) or "raw"
+tempMedianWindow = 5
+tempEmaTimeConstant = 30 #Time in seconds
+tempHistorySize = 3600 #Samples kept for filtering and rate of change. Fixed size, memory doesn't grow with uptime
+tempSensorBackend = "sysfs" #"sysfs" reads the kernel's w1 files directly (DS18B20_driver), "w1thermsensor" uses the W1ThermSensor library
+metricsFile = "" #If set, write Prometheus metrics here for node_exporter's textfile collector, e.g. "/run/node_exporter/hottub.prom". Keep it on tmpfs
+metricsInterval = 15 #Time in seconds between metrics file updates
+profilePhases = 0 #Time each section of the main loop from startup. Otherwise kill -USR1 starts it, and a second USR1 writes the report to profileDir
+profileDir = "/tmp" #Where phase reports and stack samples (kill -USR2) are written
+stackProfileSeconds = 30 #How long kill -USR2 samples stacks for. A second USR2 stops it early
+historyDir = "" #If set, log temperatures, target, relays and mode every historyInterval to segments here for history_log.py, e.g. "/home/pi/hottubhistory"
+historySpoolDir = "/dev/shm/hottubhistory" #Where history is buffered between flushes to historyDir. This should be something in RAM to avoid excessive writes to the SD card
+historyInterval = 1 #Time in seconds between history records
+historyFlushMinutes = 60 #How often buffered history goes to historyDir. Up to this much is lost in a power cut
+historyRawDays = 31 #Days of every record kept. Minute averages are kept for historyMinuteDays, hourly ones forever
+historyMinuteDays = 400
+traceFile = "" #If set, record every input and output to this file for trace_log.py to replay. Starts a new trace on every restart
+maxLoopSleep = 5 #Longest time in seconds the main loop sleeps when nothing is due. It normally wakes for the next deadline, a button edge or a new temperature
 ##End user options##
+if sim is not None: #Simulation scenarios can override any of the above
+    globals().update(sim.options)
+if sim is not None:
+    GPIO = sim.gpio
+elif gpioBackend == "gpiochip":
+    import gpiochip_backend
+    GPIO = gpiochip_backend.chip(gpioChip)
+else:
+    import RPi.GPIO as GPIO
+if traceFile:
+    import trace_log
+    traceRecorder = trace_log.recorder(traceFile)
+    GPIO = trace_log.recording_gpio(GPIO, traceRecorder, clock)
+else:
+    traceRecorder = None
 
 
-lcd = I2C_LCD_driver.lcd() #Initialize LCD
-tempSensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, tempSensorAddress) #Initialize temp sensor. Note that pin is probably set in /boot/config.txt. Kernel default is pin 4.
+#Clear any previous GPIO config - May want to specify to only clear this program's pins in the future to play nice with others (though on my Pi 1 I'm using all but 3)
+#Set up GPIO pins before anything else, so the relays are driven off as soon as possible after a power blip. This uses the internal pull UP resistor, so we want the falling edge. The other pin of the buttons is GND
+GPIO.cleanup()
+GPIO.setmode(GPIO.BCM)
+GPIO.setup(pumpLowPin, GPIO.OUT, initial=1)
+GPIO.setup(pumpHighPin, GPIO.OUT, initial=1)
+GPIO.setup(heaterPin, GPIO.OUT, initial=1)
+GPIO.setup(blowerPin, GPIO.OUT, initial=1)
+GPIO.setup(lightPin, GPIO.OUT, initial=1)
+GPIO.setup(buttonLedPin, GPIO.OUT, initial=1)
+if hasattr(GPIO, "commit"): #gpiochip_backend: request every relay line now, at its initial level, rather than on the first output
+    GPIO.commit()
+GPIO.setup(pumpButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+GPIO.setup(blowerButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+GPIO.setup(lightButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+GPIO.setup(modeButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+GPIO.setup(tempUpButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+GPIO.setup(tempDownButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+startupSafeSeconds = time.perf_counter() - startupStart #Time to safe outputs
+startupDecisionSeconds = 0 #Time to the end of the first pass of the main loop, when the first relay decisions are written
+
+
+#The LCD and temp sensors are slow to set up (the LCD init sleeps, W1ThermSensor probes the bus), so on the Pi they
+#start in their own threads while the rest of the setup carries on. Whatever uses them waits on lcdReady/sensorReady
+lcd = None
+lcdGlyphs = None #lcd_glyphs.cache on lcd when lcdIcons is on
+tempSensor = None
+sensorBus = None
+lcdReady = threading.Event()
+sensorReady = threading.Event()
+startupErrors = {} #Hardware that failed to start: exception. The main loop goes to faultMode if there's anything here
+
+
+def initLcd():
+    global lcd
+    global lcdGlyphs
+    try:
+        if sim is None:
+            lcd = I2C_LCD_driver.lcd()
+        else:
+            lcd = I2C_LCD_driver.lcd(bus=I2C_LCD_driver.recording_bus())
+        lcd.lcd_clear()
+        if lcdIcons:
+            lcdGlyphs = lcd_glyphs.cache(lcd)
+    except Exception as error:
+        startupErrors["lcd"] = error
+        print("LCD failed to start:", error)
+        return
+    lcdReady.set()
+
+
+def initSensors():
+    #Initialize temp sensor. Note that pin is probably set in /boot/config.txt. Kernel default is pin 4.
+    global tempSensor
+    global sensorBus
+    global W1ThermSensor
+    try:
+        if sim is not None:
+            tempSensor = sim.sensor
+            sensorBus = DS18B20_driver.ds18b20_bus({"Water": tempSensor}, bulk=False)
+        elif tempSensorBackend == "w1thermsensor":
+            from w1thermsensor import W1ThermSensor
+            tempSensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, tempSensorAddress)
+        else:
+            tempSensor = DS18B20_driver.ds18b20(tempSensorAddress, temperatureUnit)
+            busSensors = {"Water": tempSensor} #The main sensor, which drives currentTemp
+            for sensorName in extraTempSensors:
+                busSensors[sensorName] = DS18B20_driver.ds18b20(extraTempSensors[sensorName], temperatureUnit)
+            sensorBus = DS18B20_driver.ds18b20_bus(busSensors)
+    except Exception as error:
+        startupErrors["sensor"] = error
+        print("Temperature sensor failed to start:", error)
+        return
+    sensorReady.set()
+
+
+if sim is None:
+    for initTarget in [initLcd, initSensors]:
+        initThread = threading.Thread(target=initTarget)
+        initThread.setDaemon(True)
+        initThread.start()
+else: #Keep the simulation deterministic
+    initLcd()
+    initSensors()
 
 
 #Setup some variables here with initial values. These shouldn't need to be set by hand unless testing
-runMode = defaultMode #Heating/filer schedule. 0 is filter only (summer mode), 1 is schedule mode, 2 is hold-temp mode. Note that this is the default mode after a power failure
-manualMode = 0 #Manual mode overrides some settings while people are in the hot tub
-targetTemp = 98 #Relatively safe default
-turnOnTemp = targetTemp - maxTempSag
-currentTemp = 0
-pumpStatus = 0
-heatStatus = 0
-lightStatus = 0
-blowerStatus = 0
-buttonLedStatus = 0
-inactivityTime = 0
-inactivityTimeout = inactivityTimeoutMinutes * 60
-screenTimeout = screenTimeoutMinutes * 60
-heaterCooldownTime = heaterCooldownTimeMinutes * 60
-heaterOffTime = 0
-buttonPressTime = 0
-loopProtect = 0
-inTimeWindow = 0
-watchingButton = 0
-debounceTimer = 0
+#The control state (runMode, targetTemp, the outputs and their timers) lives in tub, set up below
+tempTrend = 0 #1 rising, -1 falling or 0 steady, by tempTrendRate. Only kept up to date for lcdIcons
+lastTrendTime = 0
+tempHistory = temp_history.history(tempHistorySize, tempMedianWindow, tempEmaTimeConstant)
+buttonPins = [pumpButtonPin, blowerButtonPin, lightButtonPin, modeButtonPin, tempUpButtonPin, tempDownButtonPin]
+buttonActions = dict(zip(buttonPins, tub_controller.buttonActions)) #Pin: what tub.readButtons() calls it
+pressedButtons = {} #Pin: time it went down, for the presses drained from buttonSampler this pass
+buttonLatency = 0 #Seconds from button going down to its action on the last press
+buttonLatencyMax = 0
+wakeEvent = threading.Event() #Set by the sensor thread and button edges to wake the main loop early
+if not scheduleWindows: #The old single daily window, timeWindowEnd's hour included
+    scheduleWindows = [("daily", "{:02d}:00".format(timeWindowStart), "{:02d}:00".format((timeWindowEnd + 1) % 24))]
 epochTime = 0
-lcd.lcd_clear()
+startTime = clock.time()
+statusWriter = None #status_block.writer on webOutputFile when enableWebOutput is on
+webApi = None #web_api.server when enableWebApi is on
+historyLog = None #history_log.logger on historyDir when it's set
+nextHistoryTime = 0
+webStatusFields = ("currentTemp", "controlTemp", "targetTemp", "turnOnTemp", "runMode", "manualMode", "pumpStatus", "heatStatus", "blowerStatus", "lightStatus", "inPreheat", "temperatureUnit")
+#Display thread state. The display thread is the only thing that touches the LCD once it has started
+DisplayStatus = collections.namedtuple("DisplayStatus", "currentTemp targetTemp runMode manualMode pumpStatus heatStatus blowerStatus lightStatus tempTrend hour minute second")
+displayCondition = threading.Condition()
+displayStatus = None #Newest status waiting to be drawn. Replaced, not queued, if the display thread falls behind
+displayCommands = collections.deque() #Backlight/clear/text commands, run in order before the next frame
+lastDisplayStatus = None
+displayBusy = 0
+displayFramesRendered = 0
+displayFramesDropped = 0
+displayRenderTime = 0 #Total seconds spent drawing frames
+sensorPolicy = "normal"
+sensorReadings = {} #Latest (temperature, timestamp) from every sensor by name. "Water" is the one currentTemp comes from
+sensorSampleRate = 0 #Samples per second actually achieved under sensorPolicy
+sensorWakeEvent = threading.Event() #Set when the pump starts so the sensor thread drops out of slow sampling
+lastSampleTime = 0
+nextSampleTime = 0 #Simulation only, when the main loop should take the next sample
+lastMetricsTime = 0 #Controller time the run mode and heater totals were last brought up to date
+nextMetricsExport = 0
+#The control rules and state for the tub, on the output pins set up at the top. relays, stateJournal and thermalModel
+#are its parts, kept under their own names for the rest of this file
+tub = tub_controller.controller({name: value for name, value in globals().items() if name in tub_controller.defaults}, GPIO,
+    {"pumpLow": pumpLowPin, "pumpHigh": pumpHighPin, "heater": heaterPin, "blower": blowerPin, "light": lightPin, "buttonLed": buttonLedPin},
+    clock.time(), sensorWakeEvent.set) #Get the sensor out of its slow pump-off sampling when the pump starts
+relays = tub.relays
+stateJournal = tub.journal
+thermalModel = tub.thermalModel
+lastRunMode = tub.runMode
+if traceRecorder: #What the state file gave the controller, so a replay starts from the same runMode, targetTemp, heater cooldown and rates
+    tub.recordState()
+    traceRecorder.state(clock.time(), stateJournal.state)
+#Metrics. Each one is only updated from one thread, see metrics.py
+metricsRegistry = metrics.registry()
+loopDurationMetric = metricsRegistry.histogram("loop_duration_seconds", "Time spent in one pass of the main loop, not counting the sleep", (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+sensorReadMetric = metricsRegistry.histogram("sensor_read_seconds", "Time to read the temperature sensors, including the conversion", (0.01, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6))
+sensorFailureMetric = metricsRegistry.counter("sensor_read_failures_total", "Sensor reads that failed or had a bad crc")
+frameMetric = metricsRegistry.histogram("display_frame_seconds", "Time to draw one status frame on the LCD", (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+buttonMetrics = {}
+for buttonName, buttonPin in [("pump", pumpButtonPin), ("blower", blowerButtonPin), ("light", lightButtonPin), ("mode", modeButtonPin), ("temp up", tempUpButtonPin), ("temp down", tempDownButtonPin)]:
+    buttonMetrics[buttonPin] = metricsRegistry.counter("button_presses_total", "Debounced button presses", {"button": buttonName})
+heaterOnMetric = metricsRegistry.counter("heater_on_seconds_total", "Time the heater has been on")
+modeChangeMetric = metricsRegistry.counter("mode_changes_total", "Changes of runMode, from the mode button or the web API")
+modeTimeMetrics = {}
+for modeNumber, modeName in [(0, "filter only"), (1, "schedule"), (2, "hold temp")]:
+    modeTimeMetrics[modeNumber] = metricsRegistry.counter("run_mode_seconds_total", "Time spent in each runMode", {"mode": modeName})
+
+
+def collectMetrics():
+    #Copy in values kept elsewhere, just before each export
+    for name in relays.transitions:
+        metricsRegistry.counter("relay_transitions_total", "Relay off to on changes per output", {"output": name}).value = relays.transitions[name]
+    if lcdReady.is_set():
+        metricsRegistry.counter("i2c_transactions_total", "I2C transactions sent to the LCD").value = lcd.lcd_device.transactions
+        metricsRegistry.counter("i2c_bytes_total", "Bytes sent to the LCD over I2C").value = lcd.lcd_device.bytes_written
+    if lcdGlyphs is not None:
+        metricsRegistry.counter("lcd_glyph_uploads_total", "Icons written into the LCD's custom character slots").value = lcdGlyphs.uploads
+    metricsRegistry.gauge("startup_safe_outputs_seconds", "Time from starting to the relays being driven off").set(startupSafeSeconds)
+    metricsRegistry.gauge("startup_first_decision_seconds", "Time from starting to the end of the first control pass").set(startupDecisionSeconds)
+    metricsRegistry.gauge("temperature", "Latest water temperature reading, in temperatureUnit").set(tub.currentTemp)
+    metricsRegistry.gauge("control_temperature", "Filtered temperature the heater decisions use").set(tub.controlTemp)
+    metricsRegistry.gauge("target_temperature", "Temperature being held").set(tub.targetTemp)
+    metricsRegistry.gauge("manual_mode", "1 while in manual mode").set(tub.manualMode)
+    metricsRegistry.gauge("display_frames_dropped", "Status frames replaced before the display thread drew them").set(displayFramesDropped)
+
+metricsRegistry.collectors.append(collectMetrics)
+phaseTimer = profiler.phases(["time", "modes", "input", "display", "interlock", "web"])
+stackProfiler = profiler.stacks()
+if profilePhases:
+    phaseTimer.enable()
 
 
 def getCurrentTime():
     #Time gets epoch time in seconds, localtime converts that into a tuple that can be used more easily
-    etime = time.time()
+    etime = clock.time()
     currentTime = time.localtime(etime) 
     return currentTime[3], currentTime[4], currentTime[5], etime
 
 def readCurrentTemp():
     #Due to slow sensor reads slowing my main loop, I've split this off into a different thread that loops constantly, updating currentTemp when it's ready
+    sensorReady.wait()
     while True:
-        global currentTemp
-        if temperatureUnit == 'F':
-            currentTemp = tempSensor.get_temperature(W1ThermSensor.DEGREES_F)
-        elif temperatureUnit == 'C':
-            currentTemp = tempSensor.get_temperature(W1ThermSensor.DEGREES_C)
-        else:
-            faultMode() #Note that this only kills the temp reading thread
-        currentTemp = round(currentTemp, 1)
-        time.sleep(1)
-        #print(currentTemp)
-        #return currentTemp
-
-
-def filterOnlyMode():
-    if heatStatus != 0: #Shut off heater if it's on
-        heaterOff()
-    if manualMode != 1:
-        if (inTimeWindow == 1): #If within time window, run pump on low
-            if pumpStatus == 0:
-                pumpRunLow()
-        else:
-            if pumpStatus != 0:
-                pumpOff()
-
-
-def scheduleMode():
-    #if manualMode != 1: #Moving the manual check to later in this function
-    if (inTimeWindow == 1): #If within time window, run pump on low
-        if pumpStatus == 0: #Note this isn't the usual != 1 here; we don't want to force low speed if someone has high speed going instead. This does prevent a user from stopping the pump during this time
-            pumpRunLow()
-        if manualMode != 1: #Manual mode does this already. No need to do it twice per loop
-            if (epochTime - pumpStartTime >= sensorWarmupTime): #If sensor has had a chance to warm up, compare temps
-                if debug:
-                    print ("Sensor warm")
-                if (currentTemp < turnOnTemp):
-                    if heatStatus != 1:
-                        heaterOn()
-                elif (currentTemp >= targetTemp):
-                    if heatStatus != 0:
-                        heaterOff()
-                #else: #Error catch, should never hit this
-                #    if heatStatus != 0:
-                #        heaterOff()
-            elif debug:
-                print ("Sensor not warmed up")
-    elif manualMode != 1: #Dont shut off the pump if in manual mode
-        if heatStatus != 0:
-            heaterOff()
-        if pumpStatus != 0:
-            pumpOff()
-
-
-def holdTempMode():
-    global loopProtect
-    if manualMode != 1: #Manual mode has its own temperature holding. The temp check intervals holdTemp mode uses are so close together it doesn't matter if a user skips one
-        if (minute in tempCheckTimes or pumpStatus != 0): #If current time is one of the listed minutes OR if pump is already running check the temp. The pumpstatus check allows sensor warmups > 1 minute
-            if debug:
-                print("Check temperature now - loopProtect", loopProtect)
-            if (pumpStatus != 1 and loopProtect == 0): #If pump is not on low and we haven't already started it before, turn it on
-                pumpRunLow()
-                loopProtect = 1 #Prevent pump from being restarted multiple times in the check period, since the reading could finish in less than 60 seconds
-            if (epochTime - pumpStartTime >= sensorWarmupTime): #If sensor has had a chance to warm up, compare temps
-                if debug:
-                    print ("Sensor warm")
-                if (currentTemp < targetTemp):
-                    if (heatStatus != 1 and pumpStatus != 0):
-                        heaterOn()
-                else:
-                    heaterOff()
-                    pumpOff() #If up to temp after sensor caught up, shut everything off.
-            elif debug:
-                print ("Sensor not warmed up")
-        else:
-            pumpOff()
-            loopProtect = 0 #Reset loop protection once outside of check period
+        sensorWakeEvent.clear() #Before sampleTemp() picks the delay, so a pump start after that still cuts the wait short
+        delay = sampleTemp()
+        if delay > 0:
+            sensorWakeEvent.wait(delay)
+
+
+def sampleTemp():
+    #Take one temperature sample. Returns the time in seconds until the next one is due
+    global sensorPolicy
+    global sensorSampleRate
+    global lastSampleTime
+    global tempTrend
+    global lastTrendTime
+    sensorPolicy = tub.sensorPolicy(nearSetpointBand) #Pick a sampling policy from the controller state
+    interval, resolution = sensorPolicies[sensorPolicy]
+    if sim is not None or tempSensorBackend != "w1thermsensor":
+        sensorBus.set_resolution(resolution)
+        readStart = time.perf_counter()
+        readings, errors = sensorBus.read_all() #Already in temperatureUnit
+        sensorReadMetric.observe(time.perf_counter() - readStart)
+        if errors:
+            sensorFailureMetric.inc(len(errors))
+        sensorReadings.update(readings)
+        if debug:
+            for sensorName in errors:
+                print("Temperature read failed:", sensorName, errors[sensorName])
+        if "Water" not in readings: #Bad crc or sensor not ready, keep the last reading and try again
+            return 1
+        reading = readings["Water"][0]
+    elif temperatureUnit in ('F', 'C'):
+        try:
+            reading = tempSensor.get_temperature(W1ThermSensor.DEGREES_F if temperatureUnit == 'F' else W1ThermSensor.DEGREES_C)
+        except Exception as error: #The library raises its own errors for a missing sensor or bad crc
+            sensorFailureMetric.inc()
             if debug:
-                print ("Not time to check temperature")
+                print("Temperature read failed:", error)
+            return 1
+    else:
+        faultMode() #Note that this only kills the temp reading thread
+    reading = round(reading, 1)
+    sampleTime = clock.time()
+    if traceRecorder:
+        traceRecorder.temp(sampleTime, reading)
+    tempHistory.append(sampleTime, reading)
+    if lcdIcons and (sim is None or sim.display) and sampleTime - lastTrendTime >= 10: #The trend can't change much faster than this
+        lastTrendTime = sampleTime
+        rate = tempHistory.rate()
+        tempTrend = 1 if rate >= tempTrendRate else -1 if rate <= -tempTrendRate else 0
+    if tempFilter == "median":
+        filtered = round(tempHistory.median(), 1)
+    elif tempFilter == "ema":
+        filtered = round(tempHistory.ema, 1)
+    else:
+        filtered = reading
+    tub.tempTime = sampleTime
+    if reading != tub.currentTemp or filtered != tub.controlTemp:
+        tub.currentTemp = reading
+        tub.controlTemp = filtered
+        wakeEvent.set() #Let the main loop act on the new reading
+    if lastSampleTime and sampleTime > lastSampleTime:
+        sensorSampleRate = 1 / (sampleTime - lastSampleTime)
+    lastSampleTime = sampleTime
+    return interval
 
 
 def faultMode():
-    heaterOff()
-    pumpOff()
-    blowerOff()
-    lightOff()
-    lcd.lcd_clear()
-    lcd.lcd_display_string_pos("FAULT - STOPPING", 2, 2)
-    lcd.backlight(0)
+    tub.fault() #Everything off and saved
+    displayCommand("lcd_clear")
+    displayCommand("lcd_display_string_pos", "FAULT - STOPPING", 2, 2)
+    displayCommand("backlight", 0)
     print("FAULT - STOPPING")
+    waitForDisplay(2)
     GPIO.cleanup()
     sys.exit(0)
 
 
-def manualRunMode():
-    global manualMode
-    #inactivityTime = epochTime - buttonPressTime #Moving this to main loop
-    if inactivityTime > inactivityTimeout: #If idle for too long, exit manual mode
-        if debug:
-            print ("Leaving manual mode due to inactivity")
-        #Look into flashing some lights as a warning, or putting something on the LCD
-        heaterOff()
-        pumpOff()
-        blowerOff()
-        lightOff()
-        manualMode = 0
-    if (pumpStatus != 2 and blowerStatus == 0 and lightStatus == 0): #If user shuts everything off (with pump off or low), disable manual mode to resume normal functions
-        if (pumpStatus == 0 or inTimeWindow == 1): #Pump on low is as "off" as it gets in a time window
-            if debug:
-                print ("Everything is off - Leaving manual mode")
-            manualMode = 0
-    if runMode != 0: #No heat in filter-only mode
-        if pumpStatus != 0: #Dont do any heat related stuff if the pump is off. Remember that the blower and light will also trigger manual mode
-            if (epochTime - pumpStartTime >= sensorWarmupTime): #If sensor has had a chance to warm up, compare temps
-                if debug:
-                    print ("Sensor warm")
-                if (currentTemp < turnOnTemp):
-                    if heatStatus != 1:
-                        heaterOn()
-                elif (currentTemp >= targetTemp):
-                    if heatStatus != 0:
-                        heaterOff()
-                #else:
-                #    if heatStatus != 0:
-                #        heaterOff()
-            elif debug:
-                print ("Sensor not warmed up")
-        else: #Safeguard to make sure the heater isnt running if the user stops the pump in manual mode
-            if heatStatus != 0:
-                heaterOff()
-
-def pumpRunLow():
-    GPIO.output(pumpLowPin, 0)
-    GPIO.output(pumpHighPin, 1)
-    global pumpStatus
-    global pumpStartTime
-    if pumpStatus == 0: #Only reset this if the pump was off
-        pumpStartTime = epochTime
-    pumpStatus = 1
-
-
-def pumpRunHigh():
-    #Shut off pumpLowPin, turn on pumpHighPin. I don't know what would happen if both were on, but let's not find out.
-    GPIO.output(pumpLowPin, 1)
-    GPIO.output(pumpHighPin, 0)
-    global pumpStatus
-    global pumpStartTime
-    if pumpStatus == 0: #Only reset this if the pump was off
-        pumpStartTime = epochTime
-    pumpStatus = 2
-
-
-def pumpOff():
-    heaterOff() #Turn off heater before stopping pump
-    GPIO.output(pumpLowPin, 1)
-    GPIO.output(pumpHighPin, 1)
-    global pumpStatus
-    pumpStatus = 0
-
-
-def heaterOn():
-    heatTimer = epochTime - heaterOffTime
-    if heatTimer > heaterCooldownTime:
-        GPIO.output(heaterPin, 0)
-        global heatStatus
-        heatStatus = 1
-        if debug:
-            print("Heater on")
-    elif debug:
-        print("Heater in cooldown period", heatTimer)
-
-
-def heaterOff():
-    global heaterOffTime
-    GPIO.output(heaterPin, 1)
-    global heatStatus
-    heaterOffTime = epochTime
-    heatStatus = 0
-    if debug:
-        print("Heater off")
-
-
-def blowerOn():
-    GPIO.output(blowerPin, 0)
-    global blowerStatus
-    blowerStatus = 1
-
+def collectButtons():
+    #Drain the debounced presses from buttonSampler for tub.readButtons(). Both button types come through its queue. In simulation there's no input thread,
+    #so the pins are sampled here instead, with nextDeadline() coming back every buttonSampleTime while needed
+    pressedButtons.clear()
+    if sim is not None and buttonType == 1:
+        buttonSampler.sample()
+    for pin, when in buttonSampler.pending():
+        pressedButtons[pin] = min(when, pressedButtons.get(pin, when))
+        buttonMetrics[pin].inc()
 
-def blowerOff():
-    GPIO.output(blowerPin, 1)
-    global blowerStatus
-    blowerStatus = 0
 
-
-def lightOn():
-    GPIO.output(lightPin, 0)
-    global lightStatus
-    lightStatus = 1
-
-
-def lightOff():
-    GPIO.output(lightPin, 1)
-    global lightStatus
-    lightStatus = 0
-
-
-def buttonLedOn():
-    GPIO.output(buttonLedPin, 0)
-    #Do i even need a status here?
-    global buttonLedStatus
-    buttonLedStatus = 1
-
-
-def buttonLedOff():
-    GPIO.output(buttonLedPin, 1)
-    global buttonLedStatus
-    buttonLedStatus = 0
+def buttonEdge(pin):
+    #GPIO edge callback. In interrupt mode the edge is the press. In simulation it only wakes the main loop to sample
+    if buttonType == 0:
+        buttonSampler.edge(pin)
+    else:
+        wakeEvent.set()
+
+
+def nextDeadline():
+    #Work out the earliest time something the main loop acts on can change without a button edge or sensor reading
+    deadline = epochTime + maxLoopSleep
+    if pressedButtons: #Go round again straight away so the screen and timers catch up with the press
+        deadline = epochTime
+    if sim is not None: #The simulation samples the sensor and buttons from the main loop
+        if buttonType == 1 and buttonSampler.busy(): #Keep sampling until every pin has settled
+            deadline = min(deadline, epochTime + buttonSampleTime)
+        deadline = min(deadline, nextSampleTime)
+        if sensorWakeEvent.is_set():
+            deadline = epochTime
+    if historyLog:
+        deadline = min(deadline, nextHistoryTime)
+    return tub.nextDeadline(deadline) #Screen, timers, schedule and state saves
+
+
+def applyWebCommands():
+    #Commands queued by web_api, applied like the mode and temp buttons in tub.readButtons()
+    for name, value in webApi.pending():
+        if debug:
+            print ("Web command", name, value)
+        if traceRecorder:
+            traceRecorder.command(clock.time(), name, value)
+        if name == "runMode":
+            tub.setRunMode(value)
+        elif name == "targetTemp":
+            tub.setTargetTemp(value)
 
 
-def buttonReader(pin): #buttonReader function determines which way to read the GPIO buttons based on user option
-    buttonStatus = 0 #Reset this to 0
-    if buttonType == 0: #Interrupt type button detection
-        if GPIO.event_detected(pin):
-            buttonStatus = 1
-    elif buttonType == 1: #Time based polling button detection
-        buttonStatus = pollButton(pin)
-    return buttonStatus
-
-
-def pollButton(pin): #This is the time-based polling GPIO read
-    global debounceTimer #Need to make this a global to prevent it from being discarded
-    global watchingButton #Same for this one
-    buttonRead = GPIO.input(pin)
-    if buttonRead == False: #Note inverted logic; we're pulling to ground when button is pressed
-        if epochTime - debounceTimer > buttonBounceTime: #If pin pulled low for longer than BounceTime
-            return True #Legitimate button press
-        else:
-            if watchingButton == 0: #If this is the first time the button press is noticed, mark the time
-                debounceTimer = epochTime
-            watchingButton = 1
-    else: #Reset watchingButton if button is not currently pressed
-        watchingButton = 0
-
-
-def readButtons():
-    global runMode
-    global targetTemp
-    global turnOnTemp
-    global manualMode
-    global buttonPressTime
-    #Kill screen saver on first press of any button, without activating that button's function
-    if buttonLedStatus == 0:
-        if buttonReader(pumpButtonPin):
-            buttonPressTime = epochTime #Note time for inactivity timer
-            return 
-        if buttonReader(blowerButtonPin):
-            buttonPressTime = epochTime #Note time for inactivity timer
-            return 
-        if buttonReader(lightButtonPin):
-            buttonPressTime = epochTime #Note time for inactivity timer
-            return 
-        if buttonReader(modeButtonPin):
-            buttonPressTime = epochTime #Note time for inactivity timer
-            return 
-        if buttonReader(tempUpButtonPin):
-            buttonPressTime = epochTime #Note time for inactivity timer
-            return 
-        if buttonReader(tempDownButtonPin):
-            buttonPressTime = epochTime #Note time for inactivity timer
-            return 
-    #Pump
-    if buttonReader(pumpButtonPin):
-        buttonPressTime = epochTime #Note time for inactivity timer
-        if debug:
-            print ("Pump button pressed")
-        manualMode = 1
-        if pumpStatus == 0: #If pump is off, start it on low
-            pumpRunLow()
-        elif pumpStatus == 1: #If pump is on low, set it on high
-            pumpRunHigh()
-        else:
-            if (runMode == 2 or inTimeWindow == 0): #If in hold temp mode, turn off. If in filter only or schedule mode but not in a time window, turn off
-                pumpOff()
-            else: #Revert to low speed if in schedule mode in a time window. Manual mode will exit on its own
-                pumpRunLow()
-    #Blower
-    if buttonReader(blowerButtonPin):
-        buttonPressTime = epochTime #Note time for inactivity timer
-        if debug:
-            print ("Blower button pressed")
-        manualMode = 1
-        if blowerStatus == 0:
-            blowerOn()
-        else:
-            blowerOff()
-    #Light
-    if buttonReader(lightButtonPin):
-        buttonPressTime = epochTime #Note time for inactivity timer
-        if debug:
-            print ("Light button pressed")
-        manualMode = 1
-        if lightStatus == 0:
-            lightOn()
-        else:
-            lightOff()
-    #Mode
-    if buttonReader(modeButtonPin):
-        if debug:
-            print ("Mode button pressed")
-        if runMode == 0:
-            runMode = 1
-        elif runMode == 1:
-            runMode = 2
-        else:
-            runMode = 0
-    #TempUp
-    if buttonReader(tempUpButtonPin):
-        if debug:
-            print ("TempUp button pressed")
-        if targetTemp < maxTemp:
-            targetTemp = targetTemp + 1
-            turnOnTemp = targetTemp - maxTempSag
-    #TempDown
-    if buttonReader(tempDownButtonPin):
-        if debug:
-            print ("TempDown button pressed")
-        if targetTemp > minTemp:
-            targetTemp = targetTemp - 1
-            turnOnTemp = targetTemp - maxTempSag
+def webOutput():
+    #Hand web_api the status. It only serializes it again if something changed
+    webApi.publish(webStatusFields, (tub.currentTemp, tub.controlTemp, tub.targetTemp, tub.turnOnTemp, tub.runMode, tub.manualMode, tub.pumpStatus, tub.heatStatus, tub.blowerStatus, tub.lightStatus, tub.inPreheat, temperatureUnit), epochTime)
 
 
 def screenOutput():
+    #Hand the current status to the display thread. This only builds a tuple, the LCD is drawn in displayWorker()
+    global displayStatus
+    global lastDisplayStatus
+    global displayFramesDropped
+    status = DisplayStatus(tub.currentTemp, tub.targetTemp, tub.runMode, tub.manualMode, tub.pumpStatus, tub.heatStatus, tub.blowerStatus, tub.lightStatus, tempTrend, hour, minute, second)
+    if status == lastDisplayStatus: #Nothing on screen would change
+        return
+    lastDisplayStatus = status
+    if sim is not None: #No display thread in simulation, draw it now
+        if sim.display:
+            drawStatus(status)
+        return
+    with displayCondition:
+        if displayStatus is not None: #Previous status never got drawn
+            displayFramesDropped += 1
+        displayStatus = status
+        displayCondition.notify()
+
+
+def displayCommand(command, *args):
+    #Queue an LCD call (e.g. "backlight", 0) for the display thread. Commands run in the order they are queued
+    global lastDisplayStatus
+    if sim is not None:
+        getattr(lcd, command)(*args)
+        lastDisplayStatus = None
+        return
+    with displayCondition:
+        displayCommands.append((command, args))
+        lastDisplayStatus = None #Make sure the next status gets drawn after the command
+        displayCondition.notify()
+
+
+def renderFrame(status):
+    #Compose the whole 20x4 frame, the LCD driver only sends the characters that changed since the last one
     #Temperatures
-    lcd.lcd_display_string_pos("Temp:     ", 1, 0)
-    lcd.lcd_display_string_pos("{}".format(currentTemp), 1, 6)
-    lcd.lcd_display_string_pos(" -> ", 1, 11) #target temp and heater status. Note blank spaces to overwrite old values
-    lcd.lcd_display_string_pos("{} ".format(targetTemp), 1, 15) #The quoted braces and .format() allow variables to be subbed into string
+    line1 = "Temp: {:<5} -> {:<5}".format(status.currentTemp, status.targetTemp)
     #Modes
-    if runMode == 0:
-        if manualMode == 1:
-            lcd.lcd_display_string_pos("Manual - No Heat    ", 2, 0)
+    line2 = ""
+    if status.runMode == 0:
+        if status.manualMode == 1:
+            line2 = "Manual - No Heat"
         else:
-            lcd.lcd_display_string_pos("Filter Only         ", 2, 0)
-        #time.sleep(5) #possibly switch this line back and forth with schedule. dont use sleep, do an epoch check
-        #lcd.lcd_display_string_pos("<schedule>", 3, 0)
-    elif runMode == 1:
-        if manualMode == 1:
-            lcd.lcd_display_string_pos("Schedule - Manual   ", 2, 0)
+            line2 = "Filter Only"
+    elif status.runMode == 1:
+        if status.manualMode == 1:
+            line2 = "Schedule - Manual"
         else:
-            lcd.lcd_display_string_pos("Schedule Mode       ", 2, 0)
-        #time.sleep(5)
-        #lcd.lcd_display_string_pos("<schedule>", 3, 0)
-    elif runMode == 2:
-        if manualMode == 1:
-            lcd.lcd_display_string_pos("Hold Temp - Manual  ", 2, 0)
+            line2 = "Schedule Mode"
+    elif status.runMode == 2:
+        if status.manualMode == 1:
+            line2 = "Hold Temp - Manual"
         else:
-            lcd.lcd_display_string_pos("Hold Temp Mode      ", 2, 0)
-    #Clock
-    if hour < 10:
-        lcd.lcd_display_string_pos("0{}:".format(hour), 4, 6)
+            line2 = "Hold Temp Mode"
+    if lcdGlyphs is not None:
+        return renderIconLines(status, line1, line2)
+    #Outputs
+    if status.pumpStatus == 1:
+        pumpText = "pump"
+    elif status.pumpStatus == 2:
+        pumpText = "PUMP"
     else:
-        lcd.lcd_display_string_pos("{}:".format(hour), 4, 6)
-    if minute < 10:
-        lcd.lcd_display_string_pos("0{}:".format(minute), 4, 9)
+        pumpText = ""
+    if status.heatStatus == 1:
+        heatText = "HEAT"
     else:
-        lcd.lcd_display_string_pos("{}:".format(minute), 4, 9)
-    if second < 10:
-        lcd.lcd_display_string_pos("0{}".format(second), 4, 12)
+        heatText = ""
+    if status.blowerStatus == 1:
+        blowerText = "BLOW"
     else:
-        lcd.lcd_display_string_pos("{}".format(second), 4, 12)
-    #Outputs
-    if pumpStatus == 0:
-        lcd.lcd_display_string_pos("    ", 3, 0)
-    elif pumpStatus == 1:
-        lcd.lcd_display_string_pos("pump", 3, 0)
-    elif pumpStatus == 2:
-        lcd.lcd_display_string_pos("PUMP", 3, 0)
-    if heatStatus == 0:
-        lcd.lcd_display_string_pos("    ", 3, 5)
-    elif heatStatus == 1:
-        lcd.lcd_display_string_pos("HEAT", 3, 5)
-    if blowerStatus == 0:
-        lcd.lcd_display_string_pos("    ", 3, 10)
-    elif blowerStatus == 1:
-        lcd.lcd_display_string_pos("BLOW", 3, 10)
-    if lightStatus == 0:
-        #lcd.backlight(0) #Unfortunately this doesn't work. The backlight turns on any time the screen is updated
-        lcd.lcd_display_string_pos("     ", 3, 15)
-    elif lightStatus == 1:
-        lcd.lcd_display_string_pos("LIGHT", 3, 15)
-        #lcd.backlight(1)
+        blowerText = ""
+    if status.lightStatus == 1:
+        #lcd.backlight(1) #The backlight turns on any time the screen is updated, so it can't follow the light
+        lightText = "LIGHT"
+    else:
+        lightText = ""
+    line3 = "{:<4} {:<4} {:<4} {:<5}".format(pumpText, heatText, blowerText, lightText)
+    #Clock
+    line4 = "      {:02d}:{:02d}:{:02d}".format(status.hour, status.minute, status.second)
+    return [line1, line2, line3, line4]
+
+
+def renderIconLines(status, line1, line2):
+    #renderFrame for lcdIcons: an icon for each output that's on, the trend arrow at the end of the line and a
+    #progress bar next to the clock while heating. Icons the panel doesn't have yet are uploaded as this runs
+    lcdGlyphs.beginFrame()
+    icons = []
+    if status.pumpStatus == 1:
+        icons.append(lcdGlyphs.char("pumpLow", "p"))
+    elif status.pumpStatus == 2:
+        icons.append(lcdGlyphs.char("pumpHigh", "P"))
+    else:
+        icons.append(" ")
+    for on, name, fallback in [(status.heatStatus, "heat", "H"), (status.blowerStatus, "blower", "B"), (status.lightStatus, "light", "L")]:
+        icons.append(lcdGlyphs.char(name, fallback) if on == 1 else " ")
+    trend = lcdGlyphs.char({1: "rising", -1: "falling", 0: "steady"}[status.tempTrend], " ")
+    line3 = " ".join(icons).ljust(19) + trend
+    if status.heatStatus == 1:
+        bar = lcdGlyphs.bar(1 - (status.targetTemp - status.currentTemp) / heatBarDegrees, 5)
+    else:
+        bar = "     "
+    line4 = "{} {:02d}:{:02d}:{:02d}".format(bar, status.hour, status.minute, status.second)
+    return [line1, line2, line3, line4]
+
+
+def displayWorker():
+    #Owns the LCD. Waits for commands or a new status and draws them, so the control loop never waits on I2C
+    global displayStatus
+    global displayBusy
+    lcdReady.wait() #Frames and commands queue up until then
+    while True:
+        with displayCondition:
+            displayBusy = 0
+            while displayStatus is None and not displayCommands:
+                displayCondition.wait()
+            displayBusy = 1
+            commands = list(displayCommands)
+            displayCommands.clear()
+            status = displayStatus
+            displayStatus = None
+        for command, args in commands:
+            getattr(lcd, command)(*args)
+        if status is not None:
+            drawStatus(status)
+
+
+def drawStatus(status):
+    global displayFramesRendered
+    global displayRenderTime
+    renderStart = time.time()
+    lcd.lcd_begin() #Any icon uploads go in the same transaction as the frame
+    frame = renderFrame(status)
+    if traceRecorder:
+        traceRecorder.frame(clock.time(), frame)
+    lcd.lcd_display_frame(frame)
+    lcd.lcd_flush()
+    frameTime = time.time() - renderStart
+    frameMetric.observe(frameTime)
+    displayRenderTime += frameTime
+    displayFramesRendered += 1
+
+
+def waitForDisplay(timeout):
+    #Give the display thread up to timeout seconds to finish what it has queued
+    giveUp = time.time() + timeout
+    while (displayBusy or displayStatus is not None or displayCommands) and time.time() < giveUp:
+        time.sleep(0.01)
+
+
+def phaseSignal(signum, frame):
+    #SIGUSR1: start timing the main loop phases, or write out what has been timed so far
+    if not phaseTimer.enabled:
+        phaseTimer.enable()
+        print("Phase timing started, send SIGUSR1 again for the report")
+        return
+    path = os.path.join(profileDir, time.strftime("hottub-phases-%Y%m%d-%H%M%S.txt"))
+    try:
+        with open(path, "w") as reportFile:
+            reportFile.write(phaseTimer.report())
+        print("Phase report written to", path)
+    except OSError as error:
+        print("Couldn't write phase report:", error)
+
+
+def stackSignal(signum, frame):
+    #SIGUSR2: sample every thread's stack for stackProfileSeconds, or stop a run early
+    if stackProfiler.running():
+        stackProfiler.stop()
+        return
+    path = os.path.join(profileDir, time.strftime("hottub-stacks-%Y%m%d-%H%M%S.txt"))
+    stackProfiler.start(stackProfileSeconds, path)
+    print("Sampling stacks to", path)
+
+
+def logHistory():
+    #Append one record of the current state to historyLog
+    flags = 0
+    for name, bit in history_log.flagBits.items():
+        if relays.actual.get(name) or (name == "preheat" and tub.inPreheat):
+            flags |= bit
+    try:
+        historyLog.append(epochTime, tub.currentTemp, tub.controlTemp, tub.targetTemp, tub.runMode, tub.manualMode, flags)
+    except OSError as error:
+        if debug:
+            print ("Couldn't log history:", error)
 
 
 def screenSaver():
     #Turn off LCD backlight
-    lcd.backlight(0)
+    displayCommand("backlight", 0)
     #Turn off button LEDs
-    buttonLedOff()
+    tub.buttonLedOff()
 
 
 def outputToText():
-    textfile = open(webOutputFile, 'w')
-    #this needs to be rewritten. write only accepts one arg
-    textfile.write(epochTime)
-    textfile.close()
+    #Update the shared status block in place, in status_block.fieldNames order
+    cooldownRemaining = relays.cooldownRemaining("heater", epochTime)
+    statusWriter.publish(epochTime, tub.currentTemp, tub.controlTemp, tub.targetTemp, tub.turnOnTemp, tub.runMode, tub.manualMode, tub.pumpStatus,
+        tub.heatStatus, tub.blowerStatus, tub.lightStatus, tub.inPreheat, temperatureUnitByte, cooldownRemaining, lastSampleTime,
+        tub.pumpStartTime, tub.heaterOffTime, tub.preheatStartTime, startTime)
 
 
-#Clear any previous GPIO config - May want to specify to only clear this program's pins in the future to play nice with others (though on my Pi 1 I'm using all but 3)
-#Set up GPIO pins and interrupts. This uses the internal pull UP resistor, so we want the falling edge. The other pin of the buttons is GND
-GPIO.cleanup()
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(pumpLowPin, GPIO.OUT, initial=1)
-GPIO.setup(pumpHighPin, GPIO.OUT, initial=1)
-GPIO.setup(heaterPin, GPIO.OUT, initial=1)
-GPIO.setup(blowerPin, GPIO.OUT, initial=1)
-GPIO.setup(lightPin, GPIO.OUT, initial=1)
-GPIO.setup(buttonLedPin, GPIO.OUT, initial=1)
-GPIO.setup(pumpButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(blowerButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(lightButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(modeButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(tempUpButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(tempDownButtonPin , GPIO.IN, pull_up_down=GPIO.PUD_UP)
+#Set up the interrupts on the pins set up at the top
 #Interrupts aren't really working. They false trigger on EVERYTHING. Crosstalk, EMI from the motors, etc.
-#Interrupts left as user option, just in case
-if buttonType == 0:
-    GPIO.add_event_detect(pumpButtonPin, GPIO.FALLING, bouncetime=buttonBounceTime)
-    GPIO.add_event_detect(blowerButtonPin, GPIO.FALLING, bouncetime=buttonBounceTime)
-    GPIO.add_event_detect(lightButtonPin, GPIO.FALLING, bouncetime=buttonBounceTime)
-    GPIO.add_event_detect(modeButtonPin, GPIO.FALLING, bouncetime=buttonBounceTime)
-    GPIO.add_event_detect(tempUpButtonPin, GPIO.FALLING, bouncetime=buttonBounceTime)
-    GPIO.add_event_detect(tempDownButtonPin, GPIO.FALLING, bouncetime=buttonBounceTime)
+#Interrupts left as user option, just in case. Polling mode reads the pins from the input thread instead,
+#but in simulation the edges are still watched to wake the main loop so it can sample
+buttonSampler = button_input.sampler(GPIO, buttonPins, clock, buttonSampleTime, buttonDebounceTime, buttonBounceTime / 1000, wakeEvent.set, buttonIdleSampleTime)
+if buttonType == 0 or sim is not None:
+    GPIO.add_event_detect(pumpButtonPin, GPIO.FALLING, callback=buttonEdge, bouncetime=buttonBounceTime)
+    GPIO.add_event_detect(blowerButtonPin, GPIO.FALLING, callback=buttonEdge, bouncetime=buttonBounceTime)
+    GPIO.add_event_detect(lightButtonPin, GPIO.FALLING, callback=buttonEdge, bouncetime=buttonBounceTime)
+    GPIO.add_event_detect(modeButtonPin, GPIO.FALLING, callback=buttonEdge, bouncetime=buttonBounceTime)
+    GPIO.add_event_detect(tempUpButtonPin, GPIO.FALLING, callback=buttonEdge, bouncetime=buttonBounceTime)
+    GPIO.add_event_detect(tempDownButtonPin, GPIO.FALLING, callback=buttonEdge, bouncetime=buttonBounceTime)
 
 #Shut off all relays on initialization, redundant but just in case
 #pumpOff()
@@ -526,73 +665,165 @@ if buttonType == 0:
 #lightOff()
 
 
-if temperatureUnit not in ['F', 'C']:
-    faultMode()
-
-
-#Begin sensor read thread
-sensorThread = threading.Thread(target=readCurrentTemp)
-sensorThread.setDaemon(True) #Daemonized threads die if main process is killed
-sensorThread.start()
+if sim is not None:
+    sim.attach(globals())
+else:
+    #Begin display thread. From here on only displayWorker() talks to the LCD
+    displayThread = threading.Thread(target=displayWorker)
+    displayThread.setDaemon(True)
+    displayThread.start()
+    #Begin button input thread. Presses reach the main loop through buttonSampler's queue
+    if buttonType == 1:
+        buttonSampler.start()
+    signal.signal(signal.SIGUSR1, phaseSignal)
+    signal.signal(signal.SIGUSR2, stackSignal)
 
 
-buttonLedOn()
+if temperatureUnit not in ['F', 'C']:
+    faultMode()
+temperatureUnitByte = temperatureUnit.encode()
+
+if enableWebOutput:
+    import status_block
+    statusWriter = status_block.writer(webOutputFile)
+if historyDir:
+    import history_log
+    historyLog = history_log.logger(historyDir, historySpoolDir, historyFlushMinutes * 60, {"raw": historyRawDays * 86400, "minute": historyMinuteDays * 86400})
+if sim is not None and sim.webApi is not None: #Commands from a replayed trace
+    webApi = sim.webApi
+    webApi.wake = wakeEvent.set
+elif enableWebApi:
+    import web_api
+    webApi = web_api.server(webApiAddress, webApiPort, wakeEvent.set)
+    try:
+        webApi.start()
+    except OSError as error: #Port in use or an address this machine doesn't have. The tub runs without it
+        print("Web API failed to start:", error)
+        webApi = None
+
+
+#Begin sensor read thread. In simulation the main loop takes the samples itself
+if sim is None:
+    sensorThread = threading.Thread(target=readCurrentTemp)
+    sensorThread.setDaemon(True) #Daemonized threads die if main process is killed
+    sensorThread.start()
+
+
+tub.buttonLedOn()
 #Begin main loop
 try: #The try/catch should handle ctrl c more gracefully and allow me to cleanup the GPIO
-    while True:
+    while sim is None or sim.clock.running():
+        wakeEvent.clear()
+        passStart = time.perf_counter()
+        if startupErrors: #The LCD or a temp sensor didn't start, see initLcd/initSensors
+            faultMode()
+        if phaseTimer.enabled:
+            phaseTimer.begin()
         currentTime = getCurrentTime()
         hour = currentTime[0]
         minute = currentTime[1]
         second = currentTime[2]
         epochTime = currentTime[3]
-        inactivityTime = epochTime - buttonPressTime
+        if lastMetricsTime: #Time since the last pass goes to the state things were left in
+            modeTimeMetrics[tub.runMode].inc(epochTime - lastMetricsTime)
+            if tub.heatStatus:
+                heaterOnMetric.inc(epochTime - lastMetricsTime)
+        lastMetricsTime = epochTime
+        if sim is not None and (epochTime >= nextSampleTime or sensorWakeEvent.is_set()):
+            sensorWakeEvent.clear()
+            nextSampleTime = epochTime + max(sampleTemp(), DS18B20_driver.conversionTimes[tempSensor.resolution])
         if debug:
             print ("Time is", hour, ":", minute, ":", second)
             #print ("Epoch", epochTime)
+        if phaseTimer.enabled:
+            phaseTimer.mark("time")
         if debug:
-            print ("Temperature is", currentTemp)
-            print ("Target Temp is", targetTemp)
-        if (hour >= timeWindowStart and hour <= timeWindowEnd): #If within time window
-            inTimeWindow = 1
-        else:
-            inTimeWindow = 0
-        if debug:
-            if (inTimeWindow == 1):
-                print ("Within schedule window") 
-            else:
-                print ("Outside schedule window")
-        if manualMode == 1:
-            if debug:
-                print ("Running in manual mode")
-            manualRunMode()
-        #Check run mode, do that stuff
-        if runMode == 0:
-            filterOnlyMode()
-        elif runMode == 1:
-            scheduleMode()
-        elif runMode == 2:
-            holdTempMode()
-        else:
-            faultMode()
+            print ("Temperature is", tub.currentTemp, "filtered", tub.controlTemp, "rate", round(tempHistory.rate(), 2), "per minute")
+            print ("Target Temp is", tub.targetTemp)
+            print ("Sensor policy", sensorPolicy, "at", round(sensorSampleRate, 2), "samples per second")
+            for sensorName in extraTempSensors:
+                if sensorName in sensorReadings:
+                    print (sensorName, "temperature is", sensorReadings[sensorName][0], "at", time.strftime("%H:%M:%S", time.localtime(sensorReadings[sensorName][1])))
+        tub.control(epochTime) #Schedule, preheat, manual mode and the run mode's rules
+        if phaseTimer.enabled:
+            phaseTimer.mark("modes")
         #Read button events
-        readButtons()
-        if inactivityTime < screenTimeout: #Only print to screen if screensaver mode is off
-            if buttonLedStatus == 0:
-                buttonLedOn()
+        collectButtons()
+        tub.readButtons([buttonActions[pin] for pin in pressedButtons])
+        if webApi:
+            applyWebCommands()
+        if pressedButtons: #Measure button down to action latency
+            buttonLatency = clock.time() - min(pressedButtons.values())
+            buttonLatencyMax = max(buttonLatency, buttonLatencyMax)
+            if debug:
+                print ("Button latency", round(buttonLatency * 1000, 1), "ms, worst", round(buttonLatencyMax * 1000, 1), "ms")
+        if phaseTimer.enabled:
+            phaseTimer.mark("input")
+        if tub.screenOn(): #Only print to screen if screensaver mode is off
+            if tub.buttonLedStatus == 0: #Leaving screensaver
+                tub.buttonLedOn()
+                displayCommand("backlight", 1)
             #Print status on LCD. Backlight turns on automatically
             screenOutput()
         else:
             if debug:
                 print("Screensaver active")
-            if buttonLedStatus == 1:
+            if tub.buttonLedStatus == 1:
                 screenSaver()
-            time.sleep(.25) #Turns out it's the LCD commands that slow the loop down. Without printing to the screen this loops hundreds of times per second, pegging CPU
-        if (pumpStatus == 0 and heatStatus != 0): #The heater should NEVER be on without the pump. Run this check at the end of each loop for debugging
+        if phaseTimer.enabled:
+            phaseTimer.mark("display")
+        interlockOk = tub.commit() #Write this pass's relay changes
+        if not startupDecisionSeconds:
+            startupDecisionSeconds = time.perf_counter() - startupStart
+            if sim is None or debug:
+                print ("Outputs safe after", round(startupSafeSeconds * 1000, 1), "ms, first control decision after", round(startupDecisionSeconds * 1000, 1), "ms")
+        if debug:
+            print ("Relays", relays.describe())
+        if not interlockOk: #The heater should NEVER be on without the pump. Run this check at the end of each loop for debugging
             faultMode()
+        tub.saveState()
+        if phaseTimer.enabled:
+            phaseTimer.mark("interlock")
         if debug:
+            print ("Frames rendered", displayFramesRendered, "dropped", displayFramesDropped, "render time", round(displayRenderTime, 2))
             print ("") #Newline for formatting
         if enableWebOutput:
             outputToText()
-        #time.sleep(1) #This is helpful for some bench testing to keep loop speeds reasonable when there are no sensors to read
+        if webApi:
+            webOutput()
+        if historyLog and epochTime >= nextHistoryTime:
+            nextHistoryTime = epochTime - epochTime % historyInterval + historyInterval
+            logHistory()
+        if tub.runMode != lastRunMode:
+            modeChangeMetric.inc()
+            lastRunMode = tub.runMode
+        if metricsFile and epochTime >= nextMetricsExport:
+            nextMetricsExport = epochTime + metricsInterval
+            try:
+                metricsRegistry.export(metricsFile)
+            except OSError as error:
+                if debug:
+                    print ("Couldn't write metrics:", error)
+        loopDurationMetric.observe(time.perf_counter() - passStart)
+        if phaseTimer.enabled:
+            phaseTimer.mark("web")
+            phaseTimer.end()
+        #Sleep until the next thing is due, or until a button edge or new temperature wakes us
+        sleepTime = nextDeadline() - clock.time()
+        if debug:
+            print ("Sleeping", round(max(sleepTime, 0), 3), "seconds")
+        if sim is not None:
+            clock.sleep(sleepTime, wakeEvent)
+        elif sleepTime > 0:
+            wakeEvent.wait(sleepTime)
 except KeyboardInterrupt:
         GPIO.cleanup()
+finally:
+    tub.saveState(force=True)
+    if historyLog:
+        try:
+            historyLog.close()
+        except OSError as error:
+            print ("Couldn't flush history:", error)
+    if traceRecorder:
+        traceRecorder.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+#
+#Custom character icons for the LCD. The HD44780 has only 8 CGRAM slots for characters of its own, and the library
+#has more icons than that, so cache keeps track of which icon is in which slot. An icon is uploaded only when a
+#frame uses it and it isn't already loaded. When every slot is taken, the one drawn least recently is reused. A slot
+#already used in the frame being built is never reused, because the panel would redraw every cell showing it with
+#the new icon.
+
+#5x8 patterns, top row first
+library = {
+    "pumpLow": (0b00000, 0b01110, 0b10001, 0b10101, 0b10001, 0b01110, 0b00000, 0b00000),
+    "pumpHigh": (0b10101, 0b01110, 0b11111, 0b11011, 0b11111, 0b01110, 0b10101, 0b00000),
+    "heat": (0b00100, 0b00100, 0b01010, 0b01010, 0b10101, 0b10001, 0b01110, 0b00000),
+    "blower": (0b00010, 0b01000, 0b00001, 0b10100, 0b00010, 0b01000, 0b11111, 0b00000),
+    "light": (0b01110, 0b10001, 0b10001, 0b10001, 0b01010, 0b01110, 0b01110, 0b00100),
+    "rising": (0b00100, 0b01110, 0b10101, 0b00100, 0b00100, 0b00100, 0b00100, 0b00000),
+    "falling": (0b00100, 0b00100, 0b00100, 0b00100, 0b10101, 0b01110, 0b00100, 0b00000),
+    "steady": (0b00000, 0b00100, 0b00010, 0b11111, 0b00010, 0b00100, 0b00000, 0b00000),
+}
+for columns in range(1, 5): #Partly filled cells for bar graphs, bar1 to bar4 fifths
+    library["bar{}".format(columns)] = (0b11111 << (5 - columns) & 0b11111,) * 8
+fullBlock = chr(0xFF) #Solid cell from the character ROM, no slot needed
+
+
+class cache:
+    def __init__(self, panel, icons=library, slots=8):
+        self.panel = panel #I2C_LCD_driver.lcd
+        self.icons = icons
+        self.names = [None] * slots #Icon in each slot
+        self.lastUsed = [0] * slots #Frame each slot was last drawn in
+        self.frame = 0
+        self.hits = 0 #Icons drawn that were already loaded
+        self.uploads = 0
+        self.evictions = 0 #Uploads that replaced another icon
+        self.fallbacks = 0 #Icons drawn as their fallback text because every slot was in use
+
+    def beginFrame(self):
+        #Call before building each frame, so the slots it uses are known
+        self.frame += 1
+
+    def char(self, name, fallback="?"):
+        #The character that shows icon name, loading it into a slot first if needed. The upload goes in the
+        #panel's open batch if there is one, so it can share a transaction with the frame
+        if name in self.names:
+            slot = self.names.index(name)
+            self.hits += 1
+        else:
+            free = [slot for slot in range(len(self.names)) if self.lastUsed[slot] != self.frame]
+            if not free:
+                self.fallbacks += 1
+                return fallback
+            slot = min(free, key=lambda slot: (self.names[slot] is not None, self.lastUsed[slot]))
+            if self.names[slot] is not None:
+                self.evictions += 1
+            self.names[slot] = name
+            if self.panel.lcd_load_custom_char(slot, self.icons[name]):
+                self.uploads += 1
+        self.lastUsed[slot] = self.frame
+        return chr(slot)
+
+    def bar(self, fraction, width):
+        #A bar graph width cells long, filled to fraction in fifths of a cell
+        columns = round(max(0, min(fraction, 1)) * width * 5)
+        text = fullBlock * (columns // 5)
+        if columns % 5:
+            text += self.char("bar{}".format(columns % 5), "|")
+        return text.ljust(width)
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+#
+#Counters, gauges and fixed bucket histograms, written out as Prometheus text for node_exporter's textfile
+#collector. Updating one is an attribute change, no locks: each metric is only ever updated from one thread (the
+#main loop, the sensor thread or the display thread), and export() only reads. Values that already live elsewhere,
+#like the relay cycle counts, are copied in by collector functions just before each export.
+#
+#Point node_exporter at the directory with --collector.textfile.directory, e.g. /run/node_exporter
+
+from bisect import bisect_left
+import os
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + "}"
+
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class counter:
+    def __init__(self, labels=None):
+        self.labels = formatLabels(labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def lines(self, name):
+        return ["{}{} {}".format(name, self.labels, formatValue(self.value))]
+
+
+class gauge(counter):
+    def set(self, value):
+        self.value = value
+
+
+class histogram:
+    def __init__(self, buckets, labels=None):
+        self.labelDict = dict(labels or {})
+        self.labels = formatLabels(labels)
+        self.buckets = tuple(sorted(buckets)) #Upper bounds. +Inf is implied
+        self.counts = [0] * (len(self.buckets) + 1) #Per bucket, not cumulative, so observe() touches one slot
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name):
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append("{}_bucket{} {}".format(name, formatLabels(dict(self.labelDict, le=formatValue(bound))), total))
+        result.append("{}_sum{} {}".format(name, self.labels, formatValue(self.sum)))
+        result.append("{}_count{} {}".format(name, self.labels, self.count))
+        return result
+
+
+class registry:
+    def __init__(self, prefix="hottub_"):
+        self.prefix = prefix
+        self.families = {} #Name: (type, help, {label tuple: metric})
+        self.collectors = [] #Functions run before each export to copy in outside values
+
+    def metric(self, kind, name, help, labels, make):
+        family = self.families.setdefault(self.prefix + name, (kind, help, {}))
+        key = tuple(sorted((labels or {}).items()))
+        if key not in family[2]:
+            family[2][key] = make()
+        return family[2][key]
+
+    def counter(self, name, help, labels=None):
+        return self.metric("counter", name, help, labels, lambda: counter(labels))
+
+    def gauge(self, name, help, labels=None):
+        return self.metric("gauge", name, help, labels, lambda: gauge(labels))
+
+    def histogram(self, name, help, buckets, labels=None):
+        return self.metric("histogram", name, help, labels, lambda: histogram(buckets, labels))
+
+    def text(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for name, (kind, help, children) in self.families.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for child in list(children.values()):
+                lines.extend(child.lines(name))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        #Write to a temp file and rename, so the collector never reads half a file
+        with open(path + ".tmp", "w") as metricsFile:
+            metricsFile.write(self.text())
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+#
+#Several tubs from one process, for a board that has the relays, buttons and LCDs of more than one spa (through
+#GPIO expanders or just a lot of pins). Each tub is a tub_controller.controller, the same control rules
+#hottubcontrol.py runs, with its own pin map, sensor, schedule, LCD and state file. Single tub extras (the web API,
+#metrics, history, traces) stay in hottubcontrol.py.
+#
+#One scheduler thread steps the tubs. Each tub says when it next needs a step, and the scheduler keeps those in a
+#heap, so a pass only steps the tubs that are due or have a new button press or temperature. A step does a fixed
+#amount of work whatever the tub count, so a tub's latency is its own step plus those of the tubs due in the same
+#pass. State files are written after the pass's steps, at most one per pass, so no tub's relays wait on another
+#tub's SD card write. benchmark.py measures the step latency against stand-in hardware: stepLatencyBound is the
+#stated bound on wall time, and steps over it are counted per tub. The scheduler thread's CPU time for the same span
+#is kept beside it, so a step that is slow only because the host preempted the process shows up as such. Schedules
+#are compiled when a tub is built, so that doesn't land in a step. The sensors are read by a pool with one worker per
+#1-Wire master, which converts every sensor on its bus at once for whichever tubs asked.
+#
+#Usage: set up tubs below, then python3 multi_tub.py
+
+import collections
+import heapq
+import os
+import queue
+import threading
+import time
+
+import DS18B20_driver
+import I2C_LCD_driver
+import button_input
+import temp_history
+import tub_controller
+
+
+##User options##
+debug = 0
+gpioBackend = "RPi.GPIO" #"RPi.GPIO" or "gpiochip", see hottubcontrol.py
+gpioChip = "/dev/gpiochip0"
+temperatureUnit = 'F' #Uppercase F or C, for every tub
+buttonSampleTime = 0.005 #Time in seconds between reads of every button pin of every tub
+buttonIdleSampleTime = 0.05 #Time in seconds between reads while every button is released
+buttonDebounceTime = 0.02
+buttonBounceTime = 300 #Milliseconds a button is ignored for after being released
+stepLatencyBound = 0.01 #Time in seconds from the start of a pass to the end of a tub's step that counts as slow, see slowSteps
+maxLoopSleep = 5 #Longest time in seconds the scheduler sleeps when nothing is due
+#One dict per tub. Anything not given comes from tubDefaults. Pins are BCM numbers, and must not overlap between tubs
+tubs = [
+    {"name": "Spa", "sensorAddress": "031722cbb8ff", "lcdAddress": 0x27,
+     "pins": {"pumpLow": 9, "pumpHigh": 10, "heater": 11, "blower": 8, "light": 7, "buttonLed": 4},
+     "buttons": {"pump": 25, "blower": 14, "light": 15, "mode": 17, "tempUp": 18, "tempDown": 23}},
+]
+#The control options are the ones in hottubcontrol.py, see tub_controller.defaults. These are the rest
+tubDefaults = dict(tub_controller.defaults, **{
+    "sensorBus": "w1_bus_master1", #1-Wire master the tub's sensor is on
+    "sensorIntervals": {"pump off": 30, "warmup": 5, "heating": 1, "near setpoint": 1, "normal": 1}, #Time in seconds between samples under each of hottubcontrol.py's sensorPolicies. The bus is shared, so there's no back to back sampling
+    "nearSetpointBand": 1.0,
+    "tempMedianWindow": 5,
+    "lcdAddress": None, #I2C address of the tub's LCD, or None for no LCD
+    "stateFile": None, #Defaults to hottubstate-<name>.json next to this file
+    "buttons": {}, #Action: pin, for the actions in tub_controller.buttonActions
+})
+##End user options##
+
+
+class scheduledTub(tub_controller.controller):
+    #A controller with what the scheduler keeps per tub
+    __slots__ = ("name", "lcd", "buttonPins", "presses", "history", "nextSampleTime", "sampleRequested", "saveQueued",
+                 "deadline", "frame", "steps", "slowSteps", "worstStep")
+
+    def __init__(self, options, gpio, clock, lcd=None):
+        options = dict(tubDefaults, **options)
+        if options["stateFile"] is None:
+            options["stateFile"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hottubstate-{}.json".format(options["name"]))
+        tub_controller.controller.__init__(self, options, gpio, options["pins"], clock.time(), self.pumpStarting)
+        self.name = options["name"]
+        self.lcd = lcd
+        self.buttonPins = {pin: action for action, pin in options["buttons"].items()}
+        self.presses = [] #Actions pressed since the last step
+        self.history = temp_history.history(600, options["tempMedianWindow"])
+        self.nextSampleTime = 0
+        self.sampleRequested = False
+        self.saveQueued = False #Waiting for the scheduler to write the state file
+        self.deadline = 0 #When the scheduler should step this tub next
+        self.frame = None #Last frame handed to the display
+        self.steps = 0
+        self.slowSteps = 0 #Steps that finished more than stepLatencyBound after their pass started
+        self.worstStep = 0
+
+    def pumpStarting(self):
+        self.nextSampleTime = self.now #Out of the slow pump-off sampling
+
+    def temperature(self, reading, when):
+        #A sample from the sensor pool. None if the read failed, which asks again next step
+        self.sampleRequested = False
+        if reading is None:
+            return
+        self.history.append(when, reading)
+        self.tempTime = when
+        self.currentTemp = reading
+        self.controlTemp = round(self.history.median(), 1)
+        interval = self.options["sensorIntervals"][self.sensorPolicy(self.options["nearSetpointBand"])]
+        self.nextSampleTime = max(self.nextSampleTime, when + interval)
+
+    def render(self):
+        #20x4 frame in the same layout as hottubcontrol.py's words display, with the tub name on the clock line
+        modes = ["Filter Only", "Schedule Mode", "Hold Temp Mode"]
+        line2 = modes[self.runMode] if self.manualMode != 1 else ["Manual - No Heat", "Schedule - Manual", "Hold Temp - Manual"][self.runMode]
+        pumpText = ["", "pump", "PUMP"][self.pumpStatus]
+        line3 = "{:<4} {:<4} {:<4} {:<5}".format(pumpText, "HEAT" if self.heatStatus else "", "BLOW" if self.blowerStatus else "",
+                                             "LIGHT" if self.lightStatus else "")
+        line4 = "{:<11} {}".format(self.name[:11], time.strftime("%H:%M:%S", time.localtime(self.now)))
+        return ["Temp: {:<5} -> {:<5}".format(self.currentTemp, self.targetTemp), line2, line3, line4]
+
+    def step(self, now):
+        #One pass of the control logic, as in hottubcontrol.py's main loop. Returns the frame to show, or None.
+        #The state is only handed to the journal, the scheduler writes it
+        self.steps += 1
+        if self.faulted:
+            return None
+        self.control(now)
+        presses = self.presses
+        self.presses = []
+        self.readButtons(presses)
+        frame = None
+        if self.screenOn():
+            if self.buttonLedStatus == 0: #Leaving screensaver
+                self.buttonLedOn()
+            frame = self.render()
+        elif self.buttonLedStatus == 1: #Screensaver
+            self.buttonLedOff()
+            frame = []
+        if not self.commit():
+            self.fault() #Everything off for this tub only. The other tubs carry on
+            print("FAULT - STOPPING", self.name)
+            frame = []
+        self.recordState()
+        if frame == self.frame:
+            return None
+        self.frame = frame
+        return frame
+
+    def saveDue(self):
+        if self.saveQueued: #Already waiting its turn
+            return None
+        return tub_controller.controller.saveDue(self)
+
+    def nextDeadline(self, latest):
+        if self.faulted:
+            return float("inf")
+        deadline = latest
+        if not self.sampleRequested:
+            deadline = min(deadline, self.nextSampleTime)
+        return tub_controller.controller.nextDeadline(self, deadline)
+
+
+class sensorPool:
+    #One worker per 1-Wire master. A request for any tub on a bus converts every sensor on it at once, and the
+    #readings of all of them go on results as (tub name, temperature or None, time). Without threads, requests are
+    #read straight away, for the simulation
+    def __init__(self, buses, clock, wake=None, threaded=True):
+        self.buses = buses #Master name: DS18B20_driver.ds18b20_bus with the sensors named by tub
+        self.clock = clock
+        self.wake = wake
+        self.threaded = threaded
+        self.results = queue.SimpleQueue()
+        self.requested = {bus: threading.Event() for bus in buses}
+        self.reads = 0
+
+    def request(self, bus):
+        if not self.threaded:
+            self.read(bus)
+        else:
+            self.requested[bus].set()
+
+    def read(self, bus):
+        readings, errors = self.buses[bus].read_all()
+        self.reads += 1
+        now = self.clock.time()
+        for name in self.buses[bus].sensors:
+            self.results.put((name, round(readings[name][0], 1) if name in readings else None, now))
+        if self.wake is not None:
+            self.wake()
+
+    def worker(self, bus):
+        while True:
+            self.requested[bus].wait()
+            self.requested[bus].clear()
+            self.read(bus)
+
+    def start(self):
+        for bus in self.buses:
+            thread = threading.Thread(target=self.worker, args=(bus,), name="sensors " + bus)
+            thread.setDaemon(True)
+            thread.start()
+
+    def pending(self):
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+
+class scheduler:
+    def __init__(self, controllers, clock, sensors, buttons=None, display=None):
+        self.controllers = {tub.name: tub for tub in controllers}
+        self.clock = clock
+        self.sensors = sensors #sensorPool
+        self.buttons = buttons #button_input.sampler over every tub's button pins
+        self.display = display #Called with (tub, frame) for each new frame. [] means screensaver
+        self.buttonOwners = {}
+        for tub in controllers:
+            for pin in tub.buttonPins:
+                self.buttonOwners[pin] = tub
+        self.busOf = {tub.name: tub.options["sensorBus"] for tub in controllers}
+        self.wakeEvent = threading.Event()
+        self.queue = [(0, tub.name) for tub in controllers] #Heap of (deadline, tub name). Stale entries are skipped
+        self.saves = collections.deque() #Tubs whose state file is due to be written
+        self.latencies = collections.deque(maxlen=10000) #Seconds from the start of a pass to the end of each step
+        self.cpuLatencies = collections.deque(maxlen=10000) #The scheduler thread's CPU seconds over the same spans
+        self.saveTimes = collections.deque(maxlen=10000) #Seconds each state file write took
+
+    def due(self, tub, when):
+        #Step tub at when, or sooner if it's already due sooner
+        if when < tub.deadline:
+            tub.deadline = when
+            heapq.heappush(self.queue, (when, tub.name))
+
+    def runOnce(self):
+        #Hand out new temperatures and presses, then step every tub that is due
+        passStart = time.perf_counter()
+        passCpuStart = time.thread_time()
+        now = self.clock.time()
+        for name, reading, when in self.sensors.pending():
+            tub = self.controllers[name]
+            tub.temperature(reading, when)
+            self.due(tub, now)
+        if self.buttons is not None:
+            for pin, when in self.buttons.pending():
+                tub = self.buttonOwners[pin]
+                tub.presses.append(tub.buttonPins[pin])
+                self.due(tub, now)
+        requests = set()
+        while self.queue and self.queue[0][0] <= now:
+            deadline, name = heapq.heappop(self.queue)
+            tub = self.controllers[name]
+            if deadline != tub.deadline: #Superseded by an earlier one
+                continue
+            frame = tub.step(now)
+            if frame is not None and self.display is not None:
+                self.display(tub, frame)
+            if not tub.sampleRequested and now >= tub.nextSampleTime and not tub.faulted:
+                tub.sampleRequested = True
+                requests.add(self.busOf[name])
+            if not tub.saveQueued and tub.journal.due(now):
+                tub.saveQueued = True
+                if tub.journal.urgent: #Heater change, ahead of the settled ones
+                    self.saves.appendleft(tub)
+                else:
+                    self.saves.append(tub)
+            tub.deadline = tub.nextDeadline(now + maxLoopSleep)
+            heapq.heappush(self.queue, (tub.deadline, name))
+            latency = time.perf_counter() - passStart
+            self.latencies.append(latency)
+            self.cpuLatencies.append(time.thread_time() - passCpuStart)
+            tub.worstStep = max(tub.worstStep, latency)
+            if latency > stepLatencyBound:
+                tub.slowSteps += 1
+                if debug:
+                    print(name, "step took", round(latency * 1000, 1), "ms")
+        for bus in requests:
+            self.sensors.request(bus)
+        if self.saves: #After every step, one per pass, so a burst of saves can't hold a pass up for long
+            tub = self.saves.popleft()
+            tub.saveQueued = False
+            saveStart = time.perf_counter()
+            tub.saveState()
+            self.saveTimes.append(time.perf_counter() - saveStart)
+
+    def nextWake(self):
+        if not self.sensors.results.empty() or self.saves:
+            return self.clock.time()
+        return self.queue[0][0] if self.queue else self.clock.time() + maxLoopSleep
+
+    def run(self, running=lambda: True):
+        while running():
+            self.wakeEvent.clear()
+            self.runOnce()
+            sleepTime = min(self.nextWake() - self.clock.time(), maxLoopSleep)
+            if hasattr(self.clock, "running"): #sim_backend.clock
+                self.clock.sleep(sleepTime, self.wakeEvent)
+            elif sleepTime > 0:
+                self.wakeEvent.wait(sleepTime)
+
+
+class displays:
+    #One thread draws every tub's LCD, newest frame per tub, so a slow I2C bus holds up no tub's control
+    def __init__(self, threaded=True):
+        self.threaded = threaded
+        self.condition = threading.Condition()
+        self.frames = {} #lcd: frame waiting to be drawn
+
+    def __call__(self, tub, frame):
+        if tub.lcd is None:
+            return
+        if not self.threaded:
+            self.draw(tub.lcd, frame)
+            return
+        with self.condition:
+            self.frames[tub.lcd] = frame
+            self.condition.notify()
+
+    def draw(self, lcd, frame):
+        if frame:
+            lcd.backlight(1)
+            lcd.lcd_display_frame(frame)
+        else:
+            lcd.backlight(0)
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while not self.frames:
+                    self.condition.wait()
+                frames = self.frames
+                self.frames = {}
+            for lcd, frame in frames.items():
+                self.draw(lcd, frame)
+
+    def start(self):
+        thread = threading.Thread(target=self.worker, name="displays")
+        thread.setDaemon(True)
+        thread.start()
+
+
+def setupPins(configs, gpio):
+    #Every tub's relays driven off, then the buttons. Call this before anything slow, see hottubcontrol.py
+    gpio.setmode(gpio.BCM)
+    for config in configs:
+        for pin in config["pins"].values():
+            gpio.setup(pin, gpio.OUT, initial=1)
+    if hasattr(gpio, "commit"): #gpiochip_backend: every tub's relay lines in one request, driven from now on
+        gpio.commit()
+    for config in configs:
+        for pin in config.get("buttons", {}).values():
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+
+
+def build(configs, gpio, clock, sensors, lcds=None, threaded=True):
+    #The controllers, sensor pool, buttons and scheduler, on pins already set up by setupPins().
+    #sensors is tub name: sensor object, lcds tub name: I2C_LCD_driver.lcd
+    buttonPins = [pin for config in configs for pin in config.get("buttons", {}).values()]
+    lcds = lcds or {}
+    controllers = [scheduledTub(config, gpio, clock, lcds.get(config["name"])) for config in configs]
+    buses = {}
+    for tub in controllers:
+        buses.setdefault(tub.options["sensorBus"], {})[tub.name] = sensors[tub.name]
+    sensorBuses = {bus: DS18B20_driver.ds18b20_bus(members, master=bus, bulk=None if threaded else False) for bus, members in buses.items()}
+    wake = threading.Event()
+    pool = sensorPool(sensorBuses, clock, wake.set, threaded)
+    buttons = button_input.sampler(gpio, buttonPins, clock, buttonSampleTime, buttonDebounceTime, buttonBounceTime / 1000, wake.set, buttonIdleSampleTime)
+    tubScheduler = scheduler(controllers, clock, pool, buttons, displays(threaded))
+    tubScheduler.wakeEvent = wake
+    if not threaded: #Simulation: edges go straight onto the button queue, as in interrupt mode
+        for pin in buttonPins:
+            gpio.add_event_detect(pin, gpio.FALLING, callback=buttons.edge, bouncetime=buttonBounceTime)
+    return tubScheduler
+
+
+def simulate(multiSimulation):
+    #Run the tubs against sim_backend.multiSimulation stand-ins until its clock runs out. Returns the scheduler
+    setupPins(multiSimulation.configs, multiSimulation.gpio)
+    tubScheduler = build(multiSimulation.configs, multiSimulation.gpio, multiSimulation.clock, multiSimulation.sensors,
+                         {name: I2C_LCD_driver.lcd(bus=I2C_LCD_driver.recording_bus()) for name in multiSimulation.sensors}, threaded=False)
+    tubScheduler.run(multiSimulation.clock.running)
+    return tubScheduler
+
+
+if __name__ == '__main__':
+    if gpioBackend == "gpiochip":
+        import gpiochip_backend
+        GPIO = gpiochip_backend.chip(gpioChip)
+    else:
+        import RPi.GPIO as GPIO
+    GPIO.cleanup()
+    setupPins(tubs, GPIO) #Relays off before the sensors and LCDs, whose setup is slow
+    sensors = {config["name"]: DS18B20_driver.ds18b20(config["sensorAddress"], temperatureUnit) for config in tubs}
+    lcds = {}
+    for config in tubs:
+        if config.get("lcdAddress") is not None:
+            lcds[config["name"]] = I2C_LCD_driver.lcd(address=config["lcdAddress"])
+            lcds[config["name"]].lcd_clear()
+    tubScheduler = build(tubs, GPIO, time, sensors, lcds)
+    tubScheduler.sensors.start()
+    tubScheduler.buttons.start()
+    tubScheduler.display.start()
+    try:
+        tubScheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for stoppingTub in tubScheduler.controllers.values():
+            stoppingTub.now = time.time()
+            stoppingTub.relays.allOff(stoppingTub.now)
+            stoppingTub.saveState(True)
+        GPIO.cleanup()
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+#
+#Profiling for a running controller, without restarting it in debug mode. phases times each section of the main
+#loop, keeping the last history passes and the worst few whole passes. When it's disabled the main loop only checks
+#its enabled flag. stacks samples the stacks of every thread from a background thread for a set time and writes
+#them in the collapsed format flamegraph.pl and speedscope read.
+#
+#hottubcontrol.py hooks these to signals: kill -USR1 <pid> starts phase timing, or writes a report if it's already
+#running. kill -USR2 <pid> starts the stack sampler, or stops it early and writes what it has.
+
+from array import array
+import gc
+import os
+import sys
+import threading
+import time
+
+
+def percentile(ordered, point):
+    return ordered[min(len(ordered) - 1, len(ordered) * point // 100)]
+
+
+class phases:
+    def __init__(self, names, history=1000, worst=5):
+        self.names = list(names)
+        self.index = {name: position for position, name in enumerate(self.names)}
+        self.history = history
+        self.times = [array('d', bytes(8 * history)) for name in self.names] #One ring per phase
+        self.totals = array('d', bytes(8 * history))
+        self.current = array('d', bytes(8 * len(self.names))) #This pass so far
+        self.head = 0
+        self.count = 0
+        self.worst = [] #(total, per phase times, start time) of the slowest passes, slowest first
+        self.worstKept = worst
+        self.enabled = False
+        self.gcTime = 0 #Seconds in the collector since enabled, from gc.callbacks
+        self.gcStart = None
+        self.since = None
+        self.last = 0
+        self.passStart = None #Set by begin(), so a pass the timer was switched on partway through isn't recorded
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self.since = time.time()
+            self.passStart = None
+            gc.callbacks.append(self.gcCallback)
+
+    def disable(self):
+        if self.enabled:
+            self.enabled = False
+            gc.callbacks.remove(self.gcCallback)
+
+    def gcCallback(self, phase, info):
+        if phase == "start":
+            self.gcStart = time.perf_counter()
+        elif self.gcStart is not None:
+            self.gcTime += time.perf_counter() - self.gcStart
+            self.gcStart = None
+
+    def begin(self):
+        self.passStart = self.last = time.perf_counter()
+        for position in range(len(self.names)):
+            self.current[position] = 0
+
+    def mark(self, name):
+        #Charge the time since the last mark (or begin) to phase name
+        if self.passStart is None:
+            return
+        now = time.perf_counter()
+        self.current[self.index[name]] += now - self.last
+        self.last = now
+
+    def end(self):
+        if self.passStart is None:
+            return
+        total = self.last - self.passStart
+        self.passStart = None
+        for position in range(len(self.names)):
+            self.times[position][self.head] = self.current[position]
+        self.totals[self.head] = total
+        self.head = (self.head + 1) % self.history
+        self.count = min(self.count + 1, self.history)
+        if len(self.worst) < self.worstKept or total > self.worst[-1][0]:
+            self.worst.append((total, list(self.current), time.time()))
+            self.worst.sort(key=lambda entry: -entry[0])
+            del self.worst[self.worstKept:]
+
+    def report(self):
+        lines = ["Main loop phases over the last {} passes, timing since {}, {:.3f} s in gc".format(
+            self.count, time.ctime(self.since) if self.since else "never", self.gcTime)]
+        lines.append("{:<10} {:>10} {:>10} {:>10} {:>10} {:>10}".format("phase", "p50 ms", "p90 ms", "p99 ms", "max ms", "total s"))
+        for name, ring in list(zip(self.names, self.times)) + [("pass", self.totals)]:
+            ordered = sorted(ring[:self.count])
+            if not ordered:
+                continue
+            lines.append("{:<10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(name,
+                percentile(ordered, 50) * 1000, percentile(ordered, 90) * 1000, percentile(ordered, 99) * 1000,
+                ordered[-1] * 1000, sum(ordered)))
+        lines.append("Worst passes:")
+        for total, times, when in self.worst:
+            lines.append("  {} {:.3f} ms: {}".format(time.strftime("%H:%M:%S", time.localtime(when)), total * 1000,
+                ", ".join("{} {:.3f}".format(name, spent * 1000) for name, spent in zip(self.names, times) if spent)))
+        return "\n".join(lines) + "\n"
+
+
+class stacks:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {} #Collapsed stack: samples
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.path = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, path):
+        self.counts = {}
+        self.path = path
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, args=(seconds,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self, seconds):
+        me = threading.get_ident()
+        names = {}
+        giveUp = time.monotonic() + seconds
+        while not self.stopEvent.is_set() and time.monotonic() < giveUp:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stack = ";".join(reversed(calls))
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.stopEvent.wait(self.interval)
+        self.write()
+
+    def write(self):
+        with open(self.path + ".tmp", "w") as stackFile:
+            for stack, count in sorted(self.counts.items()):
+                stackFile.write("{} {}\n".format(stack, count))
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+#
+#Output layer between the control logic and the GPIO pins. The control functions only say what each output should
+#be. commit() runs once per pass of the main loop and writes the outputs that really changed, so a mode function
+#calling heaterOff() on every pass costs nothing. The interlocks (the heater needs a pump) and cooldowns (the heater
+#relay mustn't cycle quickly) are enforced here, so no path through the control logic can skip them. Every relay
+#change is counted per output, for estimating relay wear. state() and restore() carry the counts across restarts.
+
+
+class outputs:
+    def __init__(self, gpio, pins, cooldowns=None, interlocks=None, activeLow=True):
+        self.gpio = gpio
+        self.pins = dict(pins) #Name: pin
+        self.cooldowns = dict(cooldowns or {}) #Name: seconds it has to stay off before it can turn on again
+        self.interlocks = dict(interlocks or {}) #Name: names, at least one of which must be on for it to be on
+        self.onLevel = 0 if activeLow else 1
+        self.desired = dict.fromkeys(self.pins, False)
+        self.actual = dict.fromkeys(self.pins, False) #Outputs are set up off
+        self.offTimes = dict.fromkeys(self.pins, float("-inf")) #When each output last actually went off
+        self.transitions = dict.fromkeys(self.pins, 0) #Off to on changes, one relay cycle each
+        self.writes = 0 #GPIO write calls made
+        self.suppressed = 0 #set() calls that didn't change anything
+        self.interlockTrips = 0 #Times commit() had to hold an output off because its interlock wasn't met
+        self.changed = False #Set when a transition count changed, so the caller knows to save state()
+
+    def set(self, name, on, now):
+        #Ask for an output to be on or off from the next commit(). Returns False, and leaves it off, if it can't be
+        #turned on yet because of its cooldown or interlock
+        on = bool(on)
+        if on and not self.desired[name]:
+            if now - self.offTimes[name] <= self.cooldowns.get(name, -1):
+                return False
+            if not self.interlockMet(name, self.desired):
+                return False
+        if self.desired[name] == on:
+            self.suppressed += 1
+        self.desired[name] = on
+        return True
+
+    def isOn(self, name):
+        return self.desired[name]
+
+    def interlockMet(self, name, state):
+        required = self.interlocks.get(name)
+        if not required:
+            return True
+        for other in required:
+            if state[other]:
+                return True
+        return False
+
+    def cooldownRemaining(self, name, now):
+        if self.actual[name]:
+            return 0
+        return max(self.offTimes[name] + self.cooldowns.get(name, 0) - now, 0)
+
+    def commit(self, now):
+        #Write every output whose desired state differs from the pins. Interlocked outputs go off first and on
+        #last, with everything else switched together in between (one step on backends that take a list)
+        for name in self.interlocks:
+            if self.desired[name] and not self.interlockMet(name, self.desired):
+                self.desired[name] = False
+                self.interlockTrips += 1
+        offFirst = []
+        together = []
+        onLast = []
+        for name, on in self.desired.items():
+            if on == self.actual[name]:
+                continue
+            if name in self.interlocks:
+                (onLast if on else offFirst).append(name)
+            else:
+                together.append(name)
+        for group in (offFirst, together, onLast):
+            if group:
+                self.write(group, now)
+        return len(offFirst) + len(together) + len(onLast)
+
+    def write(self, names, now):
+        pins = [self.pins[name] for name in names]
+        levels = [self.onLevel if self.desired[name] else 1 - self.onLevel for name in names]
+        if len(pins) == 1:
+            self.gpio.output(pins[0], levels[0])
+        else:
+            self.gpio.output(pins, levels)
+        self.writes += 1
+        for name in names:
+            self.actual[name] = self.desired[name]
+            if self.desired[name]:
+                self.transitions[name] += 1
+                self.changed = True
+            else:
+                self.offTimes[name] = now
+
+    def allOff(self, now):
+        #Everything off straight away, for faults and shutdown
+        for name in self.desired:
+            self.desired[name] = False
+        self.commit(now)
+
+    def describe(self):
+        return ", ".join("{} {}".format(name, self.transitions[name]) for name in self.pins) + \
+            " cycles, {} writes, {} redundant".format(self.writes, self.suppressed)
+
+    def state(self):
+        #What's worth keeping across restarts, as plain JSON types
+        return {"transitions": dict(self.transitions)}
+
+    def restore(self, state):
+        for name, count in state.get("transitions", {}).items():
+            if name in self.transitions:
+                self.transitions[name] = count
@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+#
+#Hardware-free stand-ins for running hottubcontrol.py off the Pi: GPIO relays and buttons, a temperature sensor
+#driven by a simple thermal model of the tub, and a virtual clock the main loop sleeps on. The LCD is the real
+#I2C_LCD_driver on a recording_bus, so its shadow frame is the 20x4 character model.
+#
+#To use it, build a simulation, make it current with start(), then run hottubcontrol.py (see run()). The
+#controller sees sim_backend.current and swaps in the stand-ins instead of touching hardware. Virtual time only
+#moves when the main loop sleeps, so a simulated day takes seconds.
+
+import heapq
+import itertools
+import os
+import runpy
+import tempfile
+import time
+
+import DS18B20_driver
+
+
+current = None #The simulation hottubcontrol.py should use, set by start()
+
+
+class clock:
+    #Virtual epoch time. sleep() jumps straight to the end of the sleep, running any scheduled events on the way
+    def __init__(self, start, end):
+        self.now = start
+        self.end = end
+        self.events = [] #Heap of (time, order, callback)
+        self.order = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def running(self):
+        return self.now < self.end
+
+    def schedule(self, when, callback):
+        heapq.heappush(self.events, (when, next(self.order), callback))
+
+    def sleep(self, seconds, wakeEvent=None):
+        #Returns early if an event callback sets wakeEvent, like a button edge waking the real loop.
+        #Always moves on at least a millisecond, as real time does between two passes of the loop
+        target = self.now + max(seconds, 0.001)
+        while self.events and self.events[0][0] <= target:
+            when, order, callback = heapq.heappop(self.events)
+            self.now = max(self.now, when)
+            callback()
+            if wakeEvent is not None and wakeEvent.is_set():
+                return
+        self.now = max(self.now, target)
+
+
+class gpio:
+    #Stand-in for the RPi.GPIO module. Output changes are logged as (time, pin, value)
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_UP = 22
+    FALLING = 32
+
+    def __init__(self, simClock):
+        self.clock = simClock
+        self.levels = {}
+        self.transitions = []
+        self.callbacks = {}
+        self.detected = set()
+        self.outputHooks = [] #Called with (pin, value) before an output changes
+
+    def setmode(self, mode):
+        pass
+
+    def cleanup(self, *pins):
+        pass
+
+    def setup(self, pin, direction, initial=None, pull_up_down=None):
+        if direction == self.OUT: #Initial state, not logged as a transition
+            self.levels[pin] = 1 if initial is None else int(initial)
+        else:
+            self.levels[pin] = 1 #Pulled up, button released
+
+    def output(self, pin, value):
+        #One pin and value, or lists of them like RPi.GPIO. Changes in a list are logged at the same instant
+        if not isinstance(pin, int):
+            for onePin, oneValue in zip(pin, value if not isinstance(value, int) else [value] * len(pin)):
+                self.output(onePin, oneValue)
+            return
+        value = int(value)
+        if self.levels.get(pin) != value:
+            for hook in self.outputHooks:
+                hook(pin, value)
+            self.levels[pin] = value
+            self.transitions.append((self.clock.now, pin, value))
+
+    def input(self, pin):
+        return self.levels.get(pin, 1)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def event_detected(self, pin):
+        if pin in self.detected:
+            self.detected.discard(pin)
+            return True
+        return False
+
+    def setInput(self, pin, level):
+        #Drive an input pin, firing the edge detection on a falling edge
+        falling = self.levels.get(pin, 1) == 1 and level == 0
+        self.levels[pin] = level
+        if falling:
+            self.detected.add(pin)
+            if self.callbacks.get(pin):
+                self.callbacks[pin](pin)
+
+    def press(self, pin, hold=0.2):
+        #Pull the pin low now and release it hold seconds later
+        self.setInput(pin, 0)
+        self.clock.schedule(self.clock.now + hold, lambda: self.setInput(pin, 1))
+
+
+class tub:
+    #Thermal model of the water and the externally mounted sensor, in degrees of the controller's unit per minute.
+    #The heater only adds heat while the pump is moving water past it
+    def __init__(self, simClock, water=95, ambient=50, heaterPower=0.15, lossFactor=0.0004):
+        self.clock = simClock
+        self.water = water
+        self.ambient = ambient
+        self.heaterPower = heaterPower
+        self.lossFactor = lossFactor
+        self.sensor = water
+        self.pumpOn = False
+        self.heaterOn = False
+        self.lastUpdate = simClock.now
+
+    def update(self):
+        #Integrate in steps of at most 10 seconds up to the current virtual time
+        while self.lastUpdate < self.clock.now:
+            step = min(10, self.clock.now - self.lastUpdate)
+            minutes = step / 60
+            self.water += (self.heaterPower * (self.heaterOn and self.pumpOn) - self.lossFactor * (self.water - self.ambient)) * minutes
+            if self.pumpOn: #Sensor catches up with the water, time constant about 30 seconds
+                self.sensor += (self.water - self.sensor) * min(1, minutes * 2)
+            else: #Pipe cools off towards halfway between water and air
+                self.sensor += ((self.water + self.ambient) / 2 - self.sensor) * min(1, minutes / 10)
+            self.lastUpdate += step
+
+
+class sensor:
+    #Same interface as DS18B20_driver.ds18b20, reading the tub model
+    def __init__(self, simTub):
+        self.tub = simTub
+        self.resolution = 12
+        self.failing = False #Reads fail like a sensor that stopped answering while set
+
+    def get_temperature(self):
+        if self.failing:
+            raise DS18B20_driver.SensorError("Simulated read failure")
+        self.tub.update()
+        return round(self.tub.sensor, 1)
+
+    def set_resolution(self, bits):
+        self.resolution = bits
+        return True
+
+
+class web_commands:
+    #Stand-in for web_api.server's side of the main loop, for replaying the commands in a trace. No HTTP
+    def __init__(self):
+        self.commands = []
+        self.wake = None #Set by hottubcontrol.py to its wakeEvent.set
+
+    def command(self, name, value):
+        self.commands.append((name, value))
+        if self.wake is not None:
+            self.wake()
+
+    def pending(self):
+        while self.commands:
+            yield self.commands.pop(0)
+
+    def publish(self, fieldNames, values, when=None):
+        return False
+
+
+class simulation:
+    def __init__(self, start, hours, options=None, water=95, ambient=50):
+        self.clock = clock(start, start + hours * 3600)
+        self.gpio = gpio(self.clock)
+        self.tub = tub(self.clock, water, ambient)
+        self.sensor = sensor(self.tub)
+        #User options to override in hottubcontrol.py. Files the controller saves go in a temp dir unless given,
+        #removed along with the simulation
+        self.stateDir = tempfile.TemporaryDirectory(prefix="hottubsim")
+        self.options = dict({"stateFile": os.path.join(self.stateDir.name, "hottubstate.json"),
+                             "historySpoolDir": os.path.join(self.stateDir.name, "historyspool")}, **(options or {}))
+        self.controller = None #hottubcontrol.py's globals, once it has started
+        self.webApi = None #web_commands to feed the controller web commands, as trace_log.replay does
+        self.display = True #False skips drawing the LCD and the trend arrow, for runs that only look at the relays
+        self.gpio.outputHooks.append(self.relayChanged)
+
+    def attach(self, controller):
+        #Called by hottubcontrol.py once its pins and state exist
+        self.controller = controller
+
+    def relayChanged(self, pin, value):
+        if self.controller is None:
+            return
+        self.tub.update()
+        levels = dict(self.gpio.levels)
+        levels[pin] = value
+        c = self.controller
+        self.tub.pumpOn = levels.get(c["pumpLowPin"]) == 0 or levels.get(c["pumpHighPin"]) == 0
+        self.tub.heaterOn = levels.get(c["heaterPin"]) == 0
+
+    def press(self, buttonName, when, hold=0.2):
+        #Schedule a button press by pin name, e.g. press("pumpButtonPin", start + 3600)
+        self.clock.schedule(when, lambda: self.gpio.press(self.controller[buttonName], hold))
+
+    def relayLog(self, pinName):
+        #[(time, on)] for one output, with relays active low like the real board
+        pin = self.controller[pinName]
+        return [(when, value == 0) for when, logPin, value in self.gpio.transitions if logPin == pin]
+
+    def onTime(self, pinName):
+        #Total seconds the output was on
+        total = 0
+        onSince = None
+        for when, on in self.relayLog(pinName):
+            if on and onSince is None:
+                onSince = when
+            elif not on and onSince is not None:
+                total += when - onSince
+                onSince = None
+        if onSince is not None:
+            total += self.clock.now - onSince
+        return total
+
+    def checkInterlock(self):
+        #The heater must never be on while both pump relays are off. Changes made in the same instant (one pass of
+        #the loop, such as the two pump pins switching in pumpRunHigh) are checked together
+        levels = {}
+        c = self.controller
+        transitions = self.gpio.transitions
+        for index, (when, pin, value) in enumerate(transitions):
+            levels[pin] = value
+            if index + 1 < len(transitions) and transitions[index + 1][0] == when:
+                continue
+            if levels.get(c["heaterPin"]) == 0 and levels.get(c["pumpLowPin"]) != 0 and levels.get(c["pumpHighPin"]) != 0:
+                raise AssertionError("Heater on without pump at {}".format(time.ctime(when)))
+
+
+class multiSimulation:
+    #Several tubs on one clock and one gpio, for multi_tub.py. configs are its tub dicts, with the pins of each tub
+    #driving that tub's model. State files go in a temp dir unless given, removed along with the simulation
+    def __init__(self, start, hours, configs, water=95, ambient=50):
+        self.clock = clock(start, start + hours * 3600)
+        self.gpio = gpio(self.clock)
+        self.stateDir = tempfile.TemporaryDirectory(prefix="hottubsim")
+        self.configs = [dict({"stateFile": os.path.join(self.stateDir.name, config["name"] + ".json")}, **config) for config in configs]
+        self.tubs = {config["name"]: tub(self.clock, water, ambient) for config in self.configs}
+        self.sensors = {name: sensor(simTub) for name, simTub in self.tubs.items()}
+        self.pinOwners = {} #Output pin: (tub name, output name)
+        for config in self.configs:
+            for output, pin in config["pins"].items():
+                self.pinOwners[pin] = (config["name"], output)
+        self.gpio.outputHooks.append(self.relayChanged)
+
+    def relayChanged(self, pin, value):
+        if pin not in self.pinOwners:
+            return
+        name, output = self.pinOwners[pin]
+        simTub = self.tubs[name]
+        simTub.update()
+        levels = dict(self.gpio.levels)
+        levels[pin] = value
+        pins = self.pins(name)
+        simTub.pumpOn = levels.get(pins["pumpLow"]) == 0 or levels.get(pins["pumpHigh"]) == 0
+        simTub.heaterOn = levels.get(pins["heater"]) == 0
+
+    def pins(self, name):
+        return {output: pin for pin, (owner, output) in self.pinOwners.items() if owner == name}
+
+    def press(self, name, button, when, hold=0.2):
+        #Schedule a press of one tub's button, e.g. press("Spa", "pump", start + 3600)
+        pin = [config for config in self.configs if config["name"] == name][0]["buttons"][button]
+        self.clock.schedule(when, lambda: self.gpio.press(pin, hold))
+
+    def relayLog(self, name, output):
+        pin = self.pins(name)[output]
+        return [(when, value == 0) for when, logPin, value in self.gpio.transitions if logPin == pin]
+
+    def checkInterlock(self):
+        #As simulation.checkInterlock, for every tub
+        levels = {}
+        transitions = self.gpio.transitions
+        tubPins = {name: self.pins(name) for name in self.tubs}
+        for index, (when, pin, value) in enumerate(transitions):
+            levels[pin] = value
+            if index + 1 < len(transitions) and transitions[index + 1][0] == when:
+                continue
+            for name, pins in tubPins.items():
+                if levels.get(pins["heater"]) == 0 and levels.get(pins["pumpLow"]) != 0 and levels.get(pins["pumpHigh"]) != 0:
+                    raise AssertionError("{} heater on without pump at {}".format(name, time.ctime(when)))
+
+
+def multiConfigs(count):
+    #count tubs with their own pins, one sensor bus per four tubs and windows an hour apart
+    configs = []
+    for index in range(count):
+        pins = range(100 + index * 12, 112 + index * 12)
+        configs.append({"name": "tub{}".format(index), "sensorBus": "w1_bus_master{}".format(index // 4 + 1),
+                        "pins": dict(zip(["pumpLow", "pumpHigh", "heater", "blower", "light", "buttonLed"], pins[:6])),
+                        "buttons": dict(zip(["pump", "blower", "light", "mode", "tempUp", "tempDown"], pins[6:])),
+                        "scheduleWindows": [("daily", "{:02d}:00".format(index % 20), "{:02d}:00".format(index % 20 + 3))],
+                        "defaultMode": 1, "targetTemp": 100})
+    return configs
+
+
+def start(simulation):
+    global current
+    current = simulation
+
+
+def run(simulation, script=os.path.join(os.path.dirname(os.path.abspath(__file__)), "hottubcontrol.py")):
+    #Run the controller against simulation until its clock runs out. Returns the controller's globals
+    start(simulation)
+    try:
+        return runpy.run_path(script, run_name="hottubcontrol")
+    finally:
+        start(None)
+
+
+#A day each of schedule, hold temp and manual mode, checking the relays afterwards. A failed check raises
+#AssertionError, with or without python -O
+def scenarios():
+    midnight = time.mktime((2026, 1, 5, 0, 0, 0, 0, 0, -1))
+
+    def check(condition, message):
+        if not condition:
+            raise AssertionError(message)
+
+    def scenario(name, options, presses=(), sensorFailure=None, hours=24):
+        sim = simulation(midnight, hours, options)
+        for buttonName, when in presses:
+            sim.press(buttonName, midnight + when)
+        if sensorFailure is not None:
+            sim.clock.schedule(midnight + sensorFailure, lambda: setattr(sim.sensor, "failing", True))
+        realStart = time.time()
+        run(sim)
+        sim.checkInterlock()
+        print("{}: simulated {} h in {:.1f} s, pump low {:.0f} min, heater {:.0f} min, water {:.1f}".format(
+            name, hours, time.time() - realStart, sim.onTime("pumpLowPin") / 60, sim.onTime("heaterPin") / 60, sim.tub.water))
+        return sim
+
+    sim = scenario("schedule", {"defaultMode": 1, "enablePreheat": 0})
+    pumpLog = sim.relayLog("pumpLowPin")
+    check(pumpLog[0][1] and time.localtime(pumpLog[0][0]).tm_hour == 18, "Pump should start with the window")
+    check(time.localtime(pumpLog[-1][0]).tm_hour == 21, "Pump should stop when the window closes")
+
+    #Three days, so the thermal model has readings to preheat from after the first window. Each later day the pump
+    #runs once ahead of the window, until the water is up to temperature, then for the window itself
+    sim = scenario("preheat", {"defaultMode": 1, "enablePreheat": 1}, hours=72)
+    pumpLog = sim.relayLog("pumpLowPin")
+    check([on for when, on in pumpLog] == [True, False] * 5, "Pump should run once to preheat and once for the window")
+    runs = [(time.localtime(start), time.localtime(stop)) for (start, on), (stop, off) in zip(pumpLog[::2], pumpLog[1::2])]
+    check([start.tm_hour < 18 for start, stop in runs] == [False, True, False, True, False], "Preheat should start before the window")
+    check(all(stop.tm_hour < 18 for start, stop in runs[1::2]), "Preheat should stop once the water is up to temperature")
+    heaterLog = sim.relayLog("heaterPin")
+    check(all(on[0] - off[0] >= 5 * 60 for off, on in zip(heaterLog[1::2], heaterLog[2::2])), "Heater shouldn't short cycle")
+
+    sim = scenario("holdtemp", {"defaultMode": 2})
+    check(len(sim.relayLog("pumpLowPin")) >= 24, "Pump should run at every check time")
+    check(sim.onTime("heaterPin") > 0, "Heater should run to hold the temperature")
+
+    #The sensor stops answering part way through the first heat. The heater goes off once the last reading is
+    #maxTempAge old, and stays off
+    sim = scenario("sensorfail", {"defaultMode": 2, "maxTempAge": 120}, sensorFailure=20 * 60)
+    heaterLog = sim.relayLog("heaterPin")
+    check(heaterLog[0][1] and heaterLog[0][0] < midnight + 20 * 60, "Heater should be on when the sensor fails")
+    check(not heaterLog[1][1] and heaterLog[1][0] <= midnight + 20 * 60 + 121, "Heater should go off once the reading is stale")
+    check(len(heaterLog) == 2, "Heater shouldn't come back on without a reading")
+
+    #Monday, with a weekday window running past midnight and a one-off window at lunchtime
+    sim = scenario("weekly", {"defaultMode": 0, "scheduleWindows": [("weekdays", "22:00", "01:00")],
+                              "scheduleExceptions": [("2026-01-05 12:00", "2026-01-05 13:30", 1)]})
+    pumpHours = [(time.strftime("%H:%M", time.localtime(when)), on) for when, on in sim.relayLog("pumpLowPin")]
+    check(pumpHours == [("12:00", True), ("13:30", False), ("22:00", True)], "Pump should follow the weekly schedule")
+
+    #First press only wakes the screen, the next two start the pump on low then switch it to high
+    sim = scenario("manual", {"defaultMode": 0}, [("pumpButtonPin", 10 * 3600), ("pumpButtonPin", 10 * 3600 + 5), ("pumpButtonPin", 10 * 3600 + 10)])
+    highLog = sim.relayLog("pumpHighPin")
+    check(highLog[0][1] and 0 <= highLog[0][0] - midnight - (10 * 3600 + 10) < 0.1, "Third press should switch to high once debounced")
+    check(highLog[1][0] - highLog[0][0] <= 61 * 60, "Inactivity timeout should stop the pump")
+
+    #Three tubs from one multi_tub.py scheduler, each following its own window, with the blower of one turned on
+    import multi_tub
+    configs = multiConfigs(3)
+    for config in configs: #Windows an hour apart, so no preheat
+        config["enablePreheat"] = 0
+    sim = multiSimulation(midnight, 24, configs)
+    sim.press("tub1", "blower", midnight + 9 * 3600)
+    sim.press("tub1", "blower", midnight + 9 * 3600 + 5)
+    realStart = time.time()
+    tubScheduler = multi_tub.simulate(sim)
+    sim.checkInterlock()
+    for index in range(3):
+        pumpHours = [(time.localtime(when).tm_hour, on) for when, on in sim.relayLog("tub{}".format(index), "pumpLow")]
+        check(pumpHours == [(index, True), (index + 3, False)], "Each tub's pump should follow its own window")
+    check(sim.relayLog("tub1", "blower")[0][1], "Second press should turn tub1's blower on")
+    check(not sim.relayLog("tub0", "blower") and not sim.relayLog("tub2", "blower"), "Other tubs' blowers shouldn't move")
+    latencies = sorted(tubScheduler.latencies)
+    print("multi: simulated 24 h of 3 tubs in {:.1f} s, {} steps, worst step {:.2f} ms".format(
+        time.time() - realStart, sum(tub.steps for tub in tubScheduler.controllers.values()), latencies[-1] * 1000))
+    print("All scenarios passed")
+
+
+if __name__ == '__main__':
+    #Run through the importable module, so hottubcontrol.py sees the same sim_backend.current
+    import sim_backend
+    sim_backend.scenarios()
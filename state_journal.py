@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+#
+#Controller state that should survive a reboot or power cut: the user's settings, the heater cooldown and what the
+#controller has learned. set() only changes the copy in RAM. flush() writes it out, to a temp file that is synced
+#and renamed over the old one, so the file on the SD card is always either the old or the new state. Writes are
+#coalesced: nothing is written until changes have settled for settleTime, and never more often than minInterval,
+#so mashing the temp buttons costs one write rather than one per press. A change set as urgent, like the heater
+#going on or off, is due straight away, since losing it would get the heater cooldown wrong after a power cut.
+
+import json
+import os
+
+
+version = 1
+
+
+class journal:
+    def __init__(self, path, minInterval=60, settleTime=5):
+        self.path = path
+        self.minInterval = minInterval #Seconds between writes at most
+        self.settleTime = settleTime #Seconds without a change before writing
+        self.state = {}
+        self.dirty = False
+        self.urgent = False #An urgent change is waiting, so the state is due now
+        self.lastChange = 0
+        self.lastWrite = float("-inf")
+        self.writes = 0
+
+    def load(self):
+        #Read the saved state into RAM and return it. A missing or unreadable file gives an empty state
+        try:
+            with open(self.path) as journalFile:
+                saved = json.load(journalFile)
+        except (OSError, ValueError):
+            return self.state
+        if isinstance(saved, dict) and saved.get("version") == version:
+            self.state = saved.get("state", {})
+        return self.state
+
+    def get(self, name, default=None):
+        return self.state.get(name, default)
+
+    def set(self, name, value, now, urgent=False):
+        #value must be plain JSON types
+        if self.state.get(name) != value:
+            self.state[name] = value
+            self.dirty = True
+            self.urgent = self.urgent or urgent
+            self.lastChange = now
+
+    def due(self, now):
+        if self.urgent:
+            return True
+        return self.dirty and now - self.lastChange >= self.settleTime and now - self.lastWrite >= self.minInterval
+
+    def nextDue(self):
+        #When due() next turns true, or None while nothing has changed. An urgent change is due since it was made
+        if not self.dirty:
+            return None
+        if self.urgent:
+            return self.lastChange
+        return max(self.lastChange + self.settleTime, self.lastWrite + self.minInterval)
+
+    def failed(self, now):
+        #A flush() at now raised. Wait out minInterval before trying again rather than retrying on every pass,
+        #urgent or not. The state stays dirty
+        self.urgent = False
+        self.lastWrite = now
+
+    def flush(self, now, force=False):
+        #Write the state if it changed and the rate limit allows, or whenever it changed if force is set.
+        #Returns True if it wrote
+        if not (self.dirty and (force or self.due(now))):
+            return False
+        with open(self.path + ".tmp", "w") as journalFile:
+            json.dump({"version": version, "saved": now, "state": self.state}, journalFile)
+            journalFile.flush()
+            os.fsync(journalFile.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory) #Make the rename itself survive a power cut
+        finally:
+            os.close(directory)
+        self.dirty = False
+        self.urgent = False
+        self.lastWrite = now
+        self.writes += 1
+        return True
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+#
+#Fixed layout status block for other local processes (a web page, a logger) to read. The controller maps the file
+#once and packs the status into it in place every loop, so there is no open, close or new file per update. A
+#sequence counter around each update lets readers tell a consistent snapshot from one caught half written: it is
+#odd while an update is in progress and changes on every update.
+#
+#Usage: python3 status_block.py [file] [interval] prints the status every interval seconds
+
+import collections
+import mmap
+import os
+import struct
+import sys
+import time
+
+
+magic = b"HTST"
+version = 1
+header = struct.Struct("<4sHxxQ") #Magic, layout version, sequence counter
+fields = struct.Struct("<dddddBBBBBBBcdddddd")
+fieldNames = ("updated currentTemp controlTemp targetTemp turnOnTemp runMode manualMode pumpStatus heatStatus "
+              "blowerStatus lightStatus inPreheat temperatureUnit heaterCooldownRemaining lastSampleTime "
+              "pumpStartTime heaterOffTime preheatStartTime startTime")
+status = collections.namedtuple("status", fieldNames)
+size = header.size + fields.size
+sequenceOffset = 8 #Where the counter sits in header
+sequenceField = struct.Struct("<Q")
+
+
+class writer:
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.block = mmap.mmap(fd, size)
+        finally:
+            os.close(fd) #The mapping keeps the file open
+        self.sequence = 0
+        header.pack_into(self.block, 0, magic, version, self.sequence)
+
+    def publish(self, *values):
+        #values in fieldNames order. The counter goes odd, the fields are packed, then it goes even again. The
+        #values tuple is the one allocation per call, kept on purpose: one pack_into of every field takes about
+        #1.3 us, where a precompiled pack_into per field at its own offset took 2.9 us
+        self.sequence += 1
+        sequenceField.pack_into(self.block, sequenceOffset, self.sequence)
+        fields.pack_into(self.block, header.size, *values)
+        self.sequence += 1
+        sequenceField.pack_into(self.block, sequenceOffset, self.sequence)
+
+    def close(self):
+        self.block.close()
+
+
+class reader:
+    def __init__(self, path):
+        with open(path, "rb") as statusFile:
+            self.block = mmap.mmap(statusFile.fileno(), size, access=mmap.ACCESS_READ)
+        blockMagic, blockVersion, sequence = header.unpack_from(self.block, 0)
+        if blockMagic != magic or blockVersion != version:
+            raise ValueError("{} is not a version {} hot tub status block".format(path, version))
+        self.sequence = None #Counter of the last snapshot returned
+
+    def read(self, retries=100):
+        #Latest consistent snapshot as a status tuple, or None if the controller hasn't published yet or kept
+        #writing through every retry
+        for attempt in range(retries):
+            before = sequenceField.unpack_from(self.block, sequenceOffset)[0]
+            if before == 0:
+                return None
+            if before % 2 == 0:
+                values = fields.unpack_from(self.block, header.size)
+                if sequenceField.unpack_from(self.block, sequenceOffset)[0] == before:
+                    self.sequence = before
+                    return status(*values)
+            time.sleep(0.0001)
+        return None
+
+    def changed(self):
+        #Cheap check for a newer update than the last read() returned
+        return sequenceField.unpack_from(self.block, sequenceOffset)[0] != self.sequence
+
+    def close(self):
+        self.block.close()
+
+
+if __name__ == '__main__':
+    statusReader = reader(sys.argv[1] if len(sys.argv) > 1 else "/dev/shm/hottubstatus")
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    while True:
+        if statusReader.changed():
+            snapshot = statusReader.read()
+            if snapshot is not None:
+                print(time.strftime("%H:%M:%S", time.localtime(snapshot.updated)), snapshot)
+        time.sleep(interval)
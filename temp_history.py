@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+#
+#Fixed size temperature history for the sensor thread. Samples live in preallocated arrays used as a ring,
+#so memory use is the same after a day or a year of uptime. Also keeps the filtered values the control logic
+#compares against, so one bad sample can't flip the heater relay.
+
+from array import array
+from bisect import bisect_left, insort
+import math
+
+
+class history:
+    def __init__(self, capacity=3600, medianWindow=5, emaTimeConstant=30):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.temps = array('d', bytes(8 * capacity))
+        self.head = 0 #Index the next sample goes in
+        self.count = 0
+        self.medianWindow = medianWindow
+        self.sortedWindow = array('d') #Last medianWindow samples, kept sorted
+        self.emaTimeConstant = emaTimeConstant #Seconds
+        self.ema = None
+
+    def append(self, timestamp, temp):
+        #O(1) apart from the median window shuffle, which is medianWindow long
+        if self.count >= self.medianWindow:
+            dropped = self.temps[(self.head - self.medianWindow) % self.capacity]
+            del self.sortedWindow[bisect_left(self.sortedWindow, dropped)]
+        insort(self.sortedWindow, temp)
+        if self.ema is None:
+            self.ema = temp
+        else:
+            #Samples aren't evenly spaced (see sensorPolicies), so weight by the time since the last one
+            elapsed = timestamp - self.times[(self.head - 1) % self.capacity]
+            alpha = 1 - math.exp(-max(elapsed, 0) / self.emaTimeConstant)
+            self.ema += alpha * (temp - self.ema)
+        self.times[self.head] = timestamp
+        self.temps[self.head] = temp
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.temps[(self.head - 1) % self.capacity]
+
+    def median(self):
+        #Median of the last medianWindow samples, or of all of them if there are fewer
+        size = len(self.sortedWindow)
+        if size == 0:
+            return None
+        if size % 2:
+            return self.sortedWindow[size // 2]
+        return (self.sortedWindow[size // 2 - 1] + self.sortedWindow[size // 2]) / 2
+
+    def rate(self, window=300):
+        #Rate of change in degrees per minute, least squares slope over the last window seconds
+        if self.count < 2:
+            return 0
+        newest = self.times[(self.head - 1) % self.capacity]
+        n = 0
+        sumT = sumY = sumTT = sumTY = 0
+        for i in range(1, self.count + 1):
+            index = (self.head - i) % self.capacity
+            t = self.times[index] - newest
+            if t < -window:
+                break
+            y = self.temps[index]
+            n += 1
+            sumT += t
+            sumY += y
+            sumTT += t * t
+            sumTY += t * y
+        spread = n * sumTT - sumT * sumT
+        if n < 2 or spread == 0:
+            return 0
+        return (n * sumTY - sumT * sumY) / spread * 60
+
+    def samples(self):
+        #(timestamp, temp) pairs, oldest first
+        for i in range(self.count, 0, -1):
+            index = (self.head - i) % self.capacity
+            yield self.times[index], self.temps[index]
@@ -0,0 +1,83 @@
+#Stand-in for the kernel side of the gpiochip v2 uAPI, for testing gpiochip_backend without a Pi or gpio-sim.
+#install() swaps it in for fcntl.ioctl and os.open/os.close on the chip, so gpiochip_backend runs unchanged. It
+#unpacks every gpio_v2_line_request it gets, holds the lines like the kernel does (a held line can't be requested
+#again, EBUSY) and keeps a log of requests, value sets and releases to assert against.
+
+import errno
+import os
+
+import gpiochip_backend as backend
+
+
+class kernel:
+    chipFd = 1000
+
+    def __init__(self):
+        self.nextFd = 1001
+        self.requests = {} #Request fd: unpacked request dict
+        self.held = {} #Line offset: request fd holding it
+        self.levels = {} #Line offset: level
+        self.log = [] #("request", fd) / ("set", fd, bits, mask) / ("release", fd, offsets)
+
+    def install(self, monkeypatch):
+        realOpen = os.open
+        realClose = os.close
+        monkeypatch.setattr(backend.fcntl, "ioctl", self.ioctl)
+        monkeypatch.setattr(backend.os, "open", lambda path, *args: self.chipFd if path.startswith("/dev/gpiochip") else realOpen(path, *args))
+        monkeypatch.setattr(backend.os, "close", lambda fd: self.close(fd) if fd in self.requests or fd == self.chipFd else realClose(fd))
+
+    @staticmethod
+    def unpack(request):
+        fields = backend.lineRequest.unpack(bytes(request))
+        count = fields[backend.linesMax + 2]
+        config = backend.lineConfig.unpack(fields[backend.linesMax + 1])
+        attributes = []
+        for index in range(config[1]):
+            attributeId, padding, value, mask = config[2 + index * 4:6 + index * 4]
+            attributes.append((attributeId, value, mask))
+        return {"offsets": list(fields[:count]), "consumer": fields[backend.linesMax].rstrip(b"\0").decode(),
+                "flags": config[0], "attributes": attributes, "fd": fields[-1]}
+
+    def ioctl(self, fd, op, buffer):
+        if op == backend.GET_LINE_IOCTL:
+            assert fd == self.chipFd
+            request = self.unpack(buffer)
+            for offset in request["offsets"]:
+                if offset in self.held:
+                    raise OSError(errno.EBUSY, "line {} busy".format(offset))
+            requestFd = self.nextFd
+            self.nextFd += 1
+            request["fd"] = requestFd
+            self.requests[requestFd] = request
+            for index, offset in enumerate(request["offsets"]):
+                self.held[offset] = requestFd
+                for attributeId, value, mask in request["attributes"]:
+                    if attributeId == backend.ATTR_ID_OUTPUT_VALUES and mask >> index & 1:
+                        self.levels[offset] = value >> index & 1
+            fields = list(backend.lineRequest.unpack(bytes(buffer)))
+            fields[-1] = requestFd
+            buffer[:] = backend.lineRequest.pack(*fields)
+            self.log.append(("request", requestFd))
+            return 0
+        offsets = self.requests[fd]["offsets"]
+        bits, mask = backend.lineValues.unpack(bytes(buffer))
+        if op == backend.SET_VALUES_IOCTL:
+            for index, offset in enumerate(offsets):
+                if mask >> index & 1:
+                    self.levels[offset] = bits >> index & 1
+            self.log.append(("set", fd, bits, mask))
+        elif op == backend.GET_VALUES_IOCTL:
+            bits = sum(self.levels.get(offset, 1) << index for index, offset in enumerate(offsets) if mask >> index & 1)
+            buffer[:] = backend.lineValues.pack(bits, mask)
+        return 0
+
+    def close(self, fd):
+        if fd == self.chipFd:
+            return
+        request = self.requests.pop(fd)
+        for offset in request["offsets"]:
+            del self.held[offset]
+        self.log.append(("release", fd, request["offsets"]))
+
+    def releases(self):
+        return [entry for entry in self.log if entry[0] == "release"]
@@ -0,0 +1,190 @@
+import pytest
+
+import DS18B20_driver
+from DS18B20_driver import SensorError, crc8, ds18b20
+
+address = "031722cbb8ff"
+
+
+def sensorDir(tmp_path):
+    path = tmp_path / (DS18B20_driver.familyCode + "-" + address)
+    path.mkdir(exist_ok=True)
+    return path
+
+
+def w1Slave(raw, verdict="YES", crc=None):
+    #The kernel's two line w1_slave text for a scratchpad holding raw (1/16 degree steps)
+    scratchpad = bytes([raw & 0xFF, raw >> 8 & 0xFF, 0x4b, 0x46, 0x7f, 0xff, 0x0e, 0x10])
+    scratchpad += bytes([crc8(scratchpad) if crc is None else crc])
+    text = " ".join("{:02x}".format(byte) for byte in scratchpad)
+    return "{} : crc={:02x} {}\n{} t={}\n".format(text, scratchpad[8], verdict, text, raw * 125 // 2)
+
+
+def makeSensor(tmp_path, unit='C', slave=None, temperature=None):
+    path = sensorDir(tmp_path)
+    if slave is not None:
+        (path / "w1_slave").write_text(slave)
+    if temperature is not None:
+        (path / "temperature").write_text(temperature)
+    return ds18b20(address, unit, str(tmp_path))
+
+
+def test_w1_slave_good_read(tmp_path):
+    sensor = makeSensor(tmp_path, slave="72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n")
+    assert not sensor.useTemperatureFile
+    assert sensor.readMilliCelsius() == 23125
+    assert sensor.get_temperature() == 23.1
+    sensor.close()
+
+
+def test_w1_slave_kernel_crc_no(tmp_path):
+    sensor = makeSensor(tmp_path, slave=w1Slave(0x0172, verdict="NO"))
+    with pytest.raises(SensorError):
+        sensor.readMilliCelsius()
+
+
+def test_w1_slave_bad_crc_byte(tmp_path):
+    sensor = makeSensor(tmp_path, slave=w1Slave(0x0172, crc=0x58))
+    with pytest.raises(SensorError, match="crc mismatch"):
+        sensor.readMilliCelsius()
+
+
+def test_w1_slave_power_on_reset_rejected(tmp_path):
+    sensor = makeSensor(tmp_path, slave=w1Slave(85000 * 2 // 125))
+    with pytest.raises(SensorError, match="Power-on"):
+        sensor.readMilliCelsius()
+
+
+def test_w1_slave_negative(tmp_path):
+    sensor = makeSensor(tmp_path, slave=w1Slave(-162 & 0xFFFF)) #-10.125 C
+    assert sensor.readMilliCelsius() == -10125
+    assert sensor.get_temperature() == -10.1
+
+
+def test_w1_slave_low_resolution_masks_undefined_bits(tmp_path):
+    sensor = makeSensor(tmp_path, slave=w1Slave(0x0177))
+    sensor.resolution = 9
+    assert sensor.readMilliCelsius() == 0x0170 * 125 // 2
+
+
+def test_temperature_file_preferred(tmp_path):
+    sensor = makeSensor(tmp_path, slave=w1Slave(0), temperature="23125\n")
+    assert sensor.useTemperatureFile
+    assert sensor.readMilliCelsius() == 23125
+
+
+def test_temperature_file_power_on_reset_rejected(tmp_path):
+    sensor = makeSensor(tmp_path, temperature="85000\n")
+    with pytest.raises(SensorError, match="Power-on"):
+        sensor.readMilliCelsius()
+
+
+def test_temperature_file_garbage(tmp_path):
+    sensor = makeSensor(tmp_path, temperature="\n")
+    with pytest.raises(SensorError, match="Bad temperature"):
+        sensor.readMilliCelsius()
+
+
+@pytest.mark.parametrize("unit, milli, expected", [
+    ('C', 23125, 23.1),
+    ('C', 38950, 39.0),
+    ('C', -5500, -5.5),
+    ('F', 23125, 73.6),
+    ('F', 40000, 104.0),
+    ('F', 0, 32.0),
+    ('F', -17778, 0.0),
+    ('F', -40000, -40.0),
+])
+def test_temperature_file_unit_scaling(tmp_path, unit, milli, expected):
+    sensor = makeSensor(tmp_path, unit, temperature="{}\n".format(milli))
+    assert sensor.get_temperature() == expected
+
+
+def test_temperature_file_rereads_on_each_call(tmp_path):
+    sensor = makeSensor(tmp_path, temperature="20000\n")
+    assert sensor.readMilliCelsius() == 20000
+    (sensorDir(tmp_path) / "temperature").write_text("21000\n")
+    assert sensor.readMilliCelsius() == 21000
+
+
+def test_missing_sensor(tmp_path):
+    with pytest.raises(SensorError, match="No DS18B20"):
+        ds18b20(address, 'C', str(tmp_path))
+
+
+class fakeSensor:
+    resolution = 9
+
+    def __init__(self, value):
+        self.value = value
+        self.reads = 0
+
+    def get_temperature(self):
+        self.reads += 1
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(DS18B20_driver.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(DS18B20_driver.time, "sleep", lambda seconds: None)
+    return now
+
+
+def makeBus(tmp_path, sensors, bulkContents="0\n"):
+    master = tmp_path / "w1_bus_master1"
+    master.mkdir()
+    bulkFile = master / "therm_bulk_read"
+    if bulkContents is None:
+        bulkFile.mkdir() #Any open fails
+    else:
+        bulkFile.write_text(bulkContents)
+    return DS18B20_driver.ds18b20_bus(sensors, devicesDir=str(tmp_path), bulkBackoff=60), bulkFile
+
+
+def test_bus_bulk_read(tmp_path, clock):
+    sensors = {"Water": fakeSensor(100.5), "Ambient": fakeSensor(SensorError("gone"))}
+    bus, bulkFile = makeBus(tmp_path, sensors)
+    assert bus.bulk
+    readings, errors = bus.read_all()
+    assert bulkFile.read_text() == "trigger"
+    assert readings["Water"][0] == 100.5
+    assert list(errors) == ["Ambient"]
+
+
+def test_bus_bulk_failure_then_sequential_then_retry(tmp_path, clock):
+    sensors = {"Water": fakeSensor(100.5), "Ambient": fakeSensor(70.0)}
+    bus, bulkFile = makeBus(tmp_path, sensors, bulkContents=None)
+    readings, errors = bus.read_all()
+    assert readings == {}
+    assert set(errors) == {"Water", "Ambient"}
+    assert all(isinstance(error, SensorError) for error in errors.values())
+    assert sensors["Water"].reads == 0
+
+    #Inside the backoff: one sensor at a time, without touching therm_bulk_read
+    bulkFile.rmdir()
+    clock[0] += 59
+    readings, errors = bus.read_all()
+    assert errors == {}
+    assert {name: reading[0] for name, reading in readings.items()} == {"Water": 100.5, "Ambient": 70.0}
+    assert not bulkFile.exists()
+
+    #Backoff over and the master works again
+    bulkFile.write_text("0\n")
+    clock[0] += 2
+    readings, errors = bus.read_all()
+    assert errors == {} and len(readings) == 2
+    assert bulkFile.read_text() == "trigger"
+    assert bus.bulk
+
+
+def test_bus_bulk_off_stays_sequential(tmp_path, clock):
+    sensors = {"Water": fakeSensor(100.5)}
+    (tmp_path / "w1_bus_master1").mkdir()
+    bus = DS18B20_driver.ds18b20_bus(sensors, devicesDir=str(tmp_path))
+    assert not bus.bulk
+    readings, errors = bus.read_all()
+    assert readings["Water"][0] == 100.5 and errors == {}
@@ -0,0 +1,99 @@
+import pytest
+
+import gpiochip_backend
+from fake_gpiochip import kernel
+
+
+@pytest.fixture
+def chip(monkeypatch):
+    fake = kernel()
+    fake.install(monkeypatch)
+    gpio = gpiochip_backend.chip()
+    gpio.kernel = fake
+    return gpio
+
+
+def setupRelays(gpio, pins=(17, 27, 22)):
+    gpio.setmode(gpio.BCM)
+    for pin in pins:
+        gpio.setup(pin, gpio.OUT, initial=1)
+
+
+def test_setup_requests_nothing_until_commit(chip):
+    setupRelays(chip)
+    assert chip.kernel.log == []
+    chip.commit()
+    assert chip.kernel.log == [("request", 1001)]
+
+
+def test_commit_packs_one_output_request_at_the_initial_values(chip):
+    chip.setup(17, chip.OUT, initial=1)
+    chip.setup(27, chip.OUT, initial=0)
+    chip.setup(22, chip.OUT)
+    chip.commit()
+    request = chip.kernel.requests[1001]
+    assert request["offsets"] == [17, 27, 22]
+    assert request["consumer"] == "hottubcontrol"
+    assert request["flags"] == gpiochip_backend.FLAG_OUTPUT
+    assert request["attributes"] == [(gpiochip_backend.ATTR_ID_OUTPUT_VALUES, 0b101, 0b111)]
+    assert chip.kernel.levels == {17: 1, 27: 0, 22: 1}
+
+
+def test_first_output_commits(chip):
+    setupRelays(chip)
+    chip.output(27, 0)
+    assert chip.kernel.log == [("request", 1001), ("set", 1001, 0b101, 0b010)]
+
+
+def test_list_output_is_one_ioctl(chip):
+    setupRelays(chip)
+    chip.commit()
+    chip.output([17, 27], [0, 0])
+    assert chip.kernel.log[1:] == [("set", 1001, 0b100, 0b011)]
+    assert chip.kernel.levels == {17: 0, 27: 0, 22: 1}
+    assert [chip.input(pin) for pin in (17, 27, 22)] == [0, 0, 1]
+
+
+def test_setup_after_commit_never_releases_a_held_line(chip):
+    setupRelays(chip)
+    chip.commit()
+    chip.output(17, 0)
+    chip.setup(17, chip.OUT, initial=1) #Again, already held
+    chip.setup(5, chip.OUT, initial=1) #New
+    chip.setup(6, chip.IN, pull_up_down=chip.PUD_UP)
+    chip.output(5, 0)
+    assert chip.kernel.releases() == []
+    assert chip.kernel.held[17] == chip.kernel.held[27] == 1001
+    assert chip.kernel.requests[chip.kernel.held[5]]["offsets"] == [5]
+    assert chip.kernel.levels[17] == 1 and chip.kernel.levels[5] == 0
+    assert ("set", 1001, 0b111, 0b001) in chip.kernel.log
+
+
+def test_held_output_cant_become_an_input(chip):
+    setupRelays(chip)
+    chip.commit()
+    with pytest.raises(ValueError):
+        chip.setup(17, chip.IN)
+
+
+def test_inputs_request_with_pull_up_and_edges(chip):
+    setupRelays(chip)
+    chip.commit()
+    chip.setup(5, chip.IN, pull_up_down=chip.PUD_UP)
+    chip.setup(6, chip.IN, pull_up_down=chip.PUD_UP)
+    assert chip.input_many([5, 6]) == [1, 1]
+    chip.kernel.levels[6] = 0
+    assert chip.input(6) == 0
+    inputs = chip.kernel.requests[chip.kernel.held[5]]
+    assert inputs["offsets"] == [5, 6]
+    assert inputs["attributes"] == [(gpiochip_backend.ATTR_ID_FLAGS, gpiochip_backend.FLAG_INPUT | gpiochip_backend.FLAG_BIAS_PULL_UP, 0b11)]
+    assert all(entry[2] != [17, 27, 22] for entry in chip.kernel.releases())
+
+
+def test_cleanup_releases_everything(chip):
+    setupRelays(chip)
+    chip.commit()
+    chip.setup(5, chip.IN)
+    chip.input(5)
+    chip.cleanup()
+    assert chip.kernel.held == {}
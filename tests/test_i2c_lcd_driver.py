@@ -0,0 +1,100 @@
+import pytest
+
+import I2C_LCD_driver
+
+
+def expander(value, rs=0):
+    #The PCF8574 bytes for one command (rs=0) or character (rs=1): each nibble with the backlight on, then EN
+    #high and low to latch it
+    out = []
+    for nibble in (value & 0xF0, (value << 4) & 0xF0):
+        byte = nibble | rs | 0x08
+        out += [byte, byte | 0x04, byte]
+    return bytes(out)
+
+
+def command(value):
+    return expander(value)
+
+
+def text(string):
+    return b"".join(expander(ord(char), 1) for char in string)
+
+
+@pytest.fixture
+def panel(monkeypatch):
+    monkeypatch.setattr(I2C_LCD_driver, "sleep", lambda seconds: None)
+    bus = I2C_LCD_driver.recording_bus()
+    panel = I2C_LCD_driver.lcd(bus=bus)
+    bus.clear()
+    return panel, bus
+
+
+def test_expander_bytes():
+    assert command(0x94) == bytes([0x98, 0x9C, 0x98, 0x48, 0x4C, 0x48])
+    assert text("A") == bytes([0x49, 0x4D, 0x49, 0x19, 0x1D, 0x19])
+
+
+def test_frame_on_clean_shadow(panel):
+    panel, bus = panel
+    panel.lcd_display_frame(["Temp", "Pump", "AB"])
+    #Write order is lines 1, 3, 2, 4. The address counter starts at 0x00 so line 1 needs no address command
+    assert bus.transactions == [("rdwr", text("Temp") + command(0x94) + text("AB") + command(0xC0) + text("Pump"))]
+    assert "".join(panel.frame[0]) == "Temp".ljust(20)
+    assert panel.cursor == 0x44
+
+
+def test_one_character_change(panel):
+    panel, bus = panel
+    panel.lcd_display_frame(["Temp", "Pump"])
+    bus.clear()
+    panel.lcd_display_frame(["Tamp", "Pump"])
+    assert bus.transactions == [("rdwr", command(0x81) + text("a"))]
+    bus.clear()
+    panel.lcd_display_frame(["Tamp", "Pump"])
+    assert bus.transactions == []
+
+
+def test_run_merges_across_a_one_cell_gap_in_write_order(panel):
+    panel, bus = panel
+    #The last cell of line 1 and the second of line 3 are two apart in write order (0x13, 0x15), so the unchanged
+    #first cell of line 3 is rewritten rather than sending a second address command
+    panel.lcd_display_frame(["x".rjust(20), "", " y"])
+    assert bus.transactions == [("rdwr", command(0x93) + text("x y"))]
+    bus.clear()
+    #Likewise from the end of line 3 (0x27) to line 2 (0x40), where the counter jumps
+    panel.lcd_display_frame(["x".rjust(20), " z", " y".ljust(19) + "w"])
+    assert bus.transactions == [("rdwr", command(0xA7) + text("w z"))]
+    bus.clear()
+    #A two cell gap costs more to rewrite than to skip
+    panel.lcd_display_frame(["x".rjust(20), " z  v", " y".ljust(19) + "w"])
+    assert bus.transactions == [("rdwr", command(0xC4) + text("v"))]
+
+
+def test_invalidate_redraws_every_cell(panel):
+    panel, bus = panel
+    lines = ["Line one", "Line two", "Line three", "Line four"]
+    panel.lcd_display_frame(lines)
+    bus.clear()
+    panel.lcd_invalidate()
+    panel.lcd_display_frame(lines)
+    padded = [line.ljust(20) for line in lines]
+    assert bus.transactions == [("rdwr", command(0x80) + text(padded[0] + padded[2] + padded[1] + padded[3]))]
+
+
+def test_cgram_reload(panel):
+    panel, bus = panel
+    up = (0x04, 0x0E, 0x1F, 0x04, 0x04, 0x04, 0x00, 0x00)
+    down = tuple(reversed(up))
+    panel.lcd_load_custom_chars([up, down])
+    assert bus.transactions == [("rdwr", command(0x40) + b"".join(expander(row, 1) for row in up)
+                                 + command(0x48) + b"".join(expander(row, 1) for row in down))]
+    bus.clear()
+    panel.lcd_load_custom_chars([up, down])
+    assert bus.transactions == []
+    panel.lcd_load_custom_chars([up, up])
+    assert bus.transactions == [("rdwr", command(0x48) + b"".join(expander(row, 1) for row in up))]
+    bus.clear()
+    #The address counter was left in CGRAM, so the next frame has to set it even at 0x00
+    panel.lcd_display_frame(["\x00"])
+    assert bus.transactions == [("rdwr", command(0x80) + expander(0, 1))]
@@ -0,0 +1,32 @@
+import profiler
+
+
+def test_pass_enabled_partway_through_isnt_recorded():
+    timer = profiler.phases(["a", "b"])
+    timer.enable()
+    try:
+        timer.mark("a")
+        timer.end()
+        assert timer.count == 0 and timer.worst == []
+        timer.begin()
+        timer.mark("a")
+        timer.mark("b")
+        timer.end()
+        assert timer.count == 1
+        assert timer.worst[0][0] < 1
+    finally:
+        timer.disable()
+
+
+def test_reenabling_drops_the_pass_left_open():
+    timer = profiler.phases(["a"])
+    timer.enable()
+    timer.begin()
+    timer.disable()
+    timer.enable()
+    try:
+        timer.mark("a")
+        timer.end()
+        assert timer.count == 0
+    finally:
+        timer.disable()
@@ -0,0 +1,35 @@
+import state_journal
+
+
+def test_settled_change_is_due_after_settle_time(tmp_path):
+    journal = state_journal.journal(str(tmp_path / "state.json"), minInterval=60, settleTime=5)
+    assert journal.nextDue() is None
+    journal.set("targetTemp", 100, 1000)
+    assert journal.nextDue() == 1005
+    assert not journal.due(1004) and journal.due(1005)
+    assert journal.flush(1005)
+    journal.set("targetTemp", 101, 1010)
+    assert journal.nextDue() == 1065 #minInterval since the last write
+    assert state_journal.journal(journal.path).load() == {"targetTemp": 100}
+
+
+def test_urgent_change_is_due_at_once(tmp_path):
+    journal = state_journal.journal(str(tmp_path / "state.json"))
+    journal.set("heatStatus", 1, 1000, urgent=True)
+    assert journal.nextDue() == 1000
+    assert journal.flush(1000)
+    assert journal.nextDue() is None
+
+
+def test_failed_write_backs_off(tmp_path):
+    journal = state_journal.journal(str(tmp_path / "missing" / "state.json"), minInterval=60, settleTime=5)
+    journal.set("heatStatus", 1, 1000, urgent=True)
+    try:
+        journal.flush(1000)
+    except OSError:
+        journal.failed(1000)
+    assert journal.dirty
+    assert not journal.due(1030)
+    assert journal.nextDue() == 1060
+    (tmp_path / "missing").mkdir()
+    assert journal.flush(1060)
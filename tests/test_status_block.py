@@ -0,0 +1,16 @@
+import status_block
+
+
+def test_publish_and_read_back(tmp_path):
+    path = str(tmp_path / "status")
+    writer = status_block.writer(path)
+    reader = status_block.reader(path)
+    assert reader.read() is None
+    values = (1000.0, 98.5, 98.4, 100.0, 99.0, 2, 0, 1, 1, 0, 0, 0, b"F", 0.0, 999.0, 500.0, 0.0, 0.0, 10.0)
+    writer.publish(*values)
+    assert reader.changed()
+    assert reader.read() == status_block.status(*values)
+    assert not reader.changed()
+    assert writer.sequence == 2
+    writer.close()
+    reader.close()
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+import web_api
+
+
+def reply(response):
+    head, body = response.split(b"\r\n\r\n", 1)
+    return head.split(b"\r\n")[0].decode(), json.loads(body)
+
+
+@pytest.mark.parametrize("body, error", [
+    (b"not json", "body is not JSON"),
+    (b"[]", "expected an object like {\"targetTemp\": 101}"),
+    (b"{\"fan\": 1}", "unknown command fan"),
+    (b"{\"runMode\": 3}", "runMode must be 0, 1 or 2"),
+    (b"{\"targetTemp\": \"100\"}", "targetTemp must be a number"),
+    (b"{\"targetTemp\": true}", "targetTemp must be a number"),
+    (b"{\"targetTemp\": NaN}", "targetTemp must be finite"),
+    (b"{\"targetTemp\": -Infinity}", "targetTemp must be finite"),
+    (b"{\"targetTemp\": 1" + b"0" * 400 + b"}", "targetTemp is out of range"),
+])
+def test_bad_commands_are_rejected(body, error):
+    api = web_api.server()
+    status, answer = reply(api.command(body))
+    assert status == "HTTP/1.1 400 Bad Request"
+    assert answer == {"error": error}
+    assert api.commands.empty()
+
+
+def test_command_is_queued():
+    woken = []
+    api = web_api.server(wake=lambda: woken.append(True))
+    status, answer = reply(api.command(b"{\"targetTemp\": 101, \"runMode\": 2}"))
+    assert status == "HTTP/1.1 202 Accepted"
+    assert list(api.pending()) == [("targetTemp", 101), ("runMode", 2)]
+    assert woken == [True]
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+#
+#Learned heating and cooling rates for the tub, used to start heating before the schedule window opens so the
+#water is at targetTemp when it does. Rates are in degrees per minute, kept across restarts in the state journal
+#through state() and restore().
+
+
+class model:
+    def __init__(self, heatingRate=0.1, coolingRate=0.02, learnWeight=0.2, minSegment=600):
+        self.heatingRate = heatingRate #Rise while the heater is on, net of losses
+        self.coolingRate = coolingRate #Fall while the heater is off, as a positive number
+        self.learnWeight = learnWeight #How far each new observation moves a rate
+        self.minSegment = minSegment #Seconds of steady heater state before a rate is learned from it
+        self.heatingSamples = 0
+        self.coolingSamples = 0
+        self.segment = None #(start time, start temp, heater on) of the current steady stretch
+        self.lastValid = None #(time, temp) of the last reading taken with the pump running and the sensor warm
+        self.changed = False #Set when a rate was learned, so the caller knows to save
+
+    def learn(self, heating, observed):
+        if heating:
+            if observed > 0:
+                self.heatingRate += self.learnWeight * (observed - self.heatingRate)
+                self.heatingSamples += 1
+                self.changed = True
+        elif observed >= 0:
+            self.coolingRate += self.learnWeight * (observed - self.coolingRate)
+            self.coolingSamples += 1
+            self.changed = True
+
+    def update(self, now, temp, heaterOn, sensorValid):
+        #Feed one observation. sensorValid means the pump is running and the sensor has warmed up
+        if not sensorValid:
+            self.segment = None
+            return
+        heaterOn = bool(heaterOn)
+        if self.segment is None and self.lastValid is not None and now - self.lastValid[0] >= self.minSegment:
+            #First good reading after the pump was off. The heater can't run without the pump, so this was all cooling
+            self.learn(False, (self.lastValid[1] - temp) / (now - self.lastValid[0]) * 60)
+        self.lastValid = (now, temp)
+        if self.segment is None or self.segment[2] != heaterOn:
+            self.segment = (now, temp, heaterOn)
+            return
+        elapsed = now - self.segment[0]
+        if elapsed >= self.minSegment:
+            change = (temp - self.segment[1]) / elapsed * 60
+            if heaterOn:
+                self.learn(True, change)
+            else:
+                self.learn(False, -change)
+            self.segment = (now, temp, heaterOn)
+
+    def estimate(self, when):
+        #Best guess of the water temperature at time when, from the last good reading and the cooling rate
+        if self.lastValid is None:
+            return None
+        return self.lastValid[1] - self.coolingRate * max(when - self.lastValid[0], 0) / 60
+
+    def preheatStart(self, windowStart, targetTemp, warmup, maxPreheat):
+        #Time to start the pump so the water reaches targetTemp at windowStart. The pump runs for warmup seconds
+        #before the heater is allowed on. Never more than maxPreheat seconds early, and never before we know a temp
+        expected = self.estimate(windowStart)
+        if expected is None or expected >= targetTemp:
+            return windowStart
+        heatTime = (targetTemp - expected) / max(self.heatingRate, 0.001) * 60
+        return windowStart - min(heatTime + warmup, maxPreheat)
+
+    def describe(self):
+        return "heating {:.3f}/min ({} samples), cooling {:.3f}/min ({} samples)".format(
+            self.heatingRate, self.heatingSamples, self.coolingRate, self.coolingSamples)
+
+    def state(self):
+        #What's worth keeping across restarts, as plain JSON types
+        return {"heatingRate": self.heatingRate, "coolingRate": self.coolingRate,
+                "heatingSamples": self.heatingSamples, "coolingSamples": self.coolingSamples,
+                "lastValid": list(self.lastValid) if self.lastValid else None}
+
+    def restore(self, state):
+        self.heatingRate = state.get("heatingRate", self.heatingRate)
+        self.coolingRate = state.get("coolingRate", self.coolingRate)
+        self.heatingSamples = state.get("heatingSamples", 0)
+        self.coolingSamples = state.get("coolingSamples", 0)
+        if state.get("lastValid"):
+            self.lastValid = tuple(state["lastValid"])
+
+
+#Learn a simulated tub over a week of evenings, then show how close it gets to target at window start
+if __name__ == '__main__':
+    heaterPower = 0.15 #Degrees per minute the heater adds
+    lossFactor = 0.0004 #Newton cooling, per minute per degree above ambient
+    ambient = 50
+    target = 100
+    windowStart = 18 * 3600
+    warmup = 60
+    water = 100.0
+    learner = model()
+    step = 30
+    for day in range(7):
+        dayStart = day * 86400
+        heating = False
+        pumpStart = None
+        for t in range(dayStart, dayStart + 86400, step):
+            todayWindow = dayStart + windowStart
+            if pumpStart is None:
+                start = learner.preheatStart(todayWindow, target, warmup, 4 * 3600)
+            else: #Once started, keep going. The estimate drops as the water heats, which would stop the pump again
+                start = pumpStart
+            pumpOn = start <= t < todayWindow + 2 * 3600
+            if pumpOn and pumpStart is None:
+                pumpStart = t
+            elif not pumpOn:
+                pumpStart = None
+            valid = pumpOn and t - pumpStart >= warmup
+            if valid:
+                if water < target - 0.2:
+                    heating = True
+                elif water >= target:
+                    heating = False
+            else:
+                heating = False
+            if t == todayWindow:
+                print("day {}: {:.1f} at window start, {}".format(day, water, learner.describe()))
+            learner.update(t, round(water, 1), heating, valid)
+            water += (heaterPower * heating - lossFactor * (water - ambient)) * step / 60
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+#
+#Record and replay of everything the controller sees and does. The recorder starts with the state the controller
+#loaded from its state file, then appends small binary records for every temperature sample, button level change,
+#web command, relay change and LCD frame. The replayer feeds a trace back
+#through hottubcontrol.py on sim_backend's virtual clock and diffs the relay changes against the recorded ones.
+#
+#Usage: python3 trace_log.py <trace file> [option=value ...] replays a trace and prints the differences. The trace
+#doesn't hold the user options, so pass any the controller was running with that differ from the defaults,
+#e.g. defaultMode=0
+
+import ast
+import json
+import os
+import struct
+import sys
+import time
+
+import sim_backend
+import state_journal
+
+
+magic = b"HTTRACE1"
+header = struct.Struct("<BdH") #Record type, epoch time, payload length
+tempPayload = struct.Struct("<f")
+pinPayload = struct.Struct("<BB") #Pin, level
+
+TEMP = 1
+BUTTON = 2 #Input pin level as the controller read it
+EVENT = 3 #Edge reported to an add_event_detect callback or by event_detected
+OUTPUT = 4
+FRAME = 5 #The four LCD lines, joined with newlines
+COMMAND = 6 #A web_api command as the controller applied it, [name, value] as JSON
+STATE = 7 #The state_journal state the controller started with, as JSON
+
+
+class recorder:
+    def __init__(self, path, flushInterval=10):
+        self.traceFile = open(path, "wb", buffering=65536)
+        self.traceFile.write(magic)
+        self.flushInterval = flushInterval #Seconds of trace time between flushes to the file
+        self.lastFlush = 0
+
+    def write(self, recordType, when, payload):
+        self.traceFile.write(header.pack(recordType, when, len(payload)) + payload)
+        if when - self.lastFlush >= self.flushInterval:
+            self.traceFile.flush()
+            self.lastFlush = when
+
+    def temp(self, when, value):
+        self.write(TEMP, when, tempPayload.pack(value))
+
+    def pin(self, recordType, when, pin, level):
+        self.write(recordType, when, pinPayload.pack(pin, level))
+
+    def state(self, when, state):
+        self.write(STATE, when, json.dumps(state).encode())
+
+    def command(self, when, name, value):
+        self.write(COMMAND, when, json.dumps([name, value]).encode())
+
+    def frame(self, when, lines):
+        self.write(FRAME, when, "\n".join(lines).encode("latin-1", "replace"))
+
+    def close(self):
+        self.traceFile.close()
+
+
+class recording_gpio:
+    #Wraps the GPIO module so every input level change the controller reads and every output change it makes
+    #goes into the trace. Anything else passes straight through
+    def __init__(self, gpio, traceRecorder, clock):
+        self.gpio = gpio
+        self.recorder = traceRecorder
+        self.clock = clock
+        self.levels = {}
+
+    def __getattr__(self, name):
+        return getattr(self.gpio, name)
+
+    def setup(self, pin, direction, **kwargs):
+        #Outputs start at their initial level, which isn't a change worth recording
+        if direction == self.gpio.OUT and kwargs.get("initial") is not None:
+            self.levels[pin] = int(kwargs["initial"])
+        self.gpio.setup(pin, direction, **kwargs)
+
+    def input(self, pin):
+        level = int(self.gpio.input(pin))
+        if self.levels.get(pin, 1) != level:
+            self.levels[pin] = level
+            self.recorder.pin(BUTTON, self.clock.time(), pin, level)
+        return level
+
+    def add_event_detect(self, pin, edge, callback=None, **kwargs):
+        if callback is not None:
+            def recordingCallback(pin, callback=callback):
+                self.recorder.pin(EVENT, self.clock.time(), pin, 0)
+                callback(pin)
+            self.gpio.add_event_detect(pin, edge, callback=recordingCallback, **kwargs)
+        else:
+            self.gpio.add_event_detect(pin, edge, **kwargs)
+
+    def event_detected(self, pin):
+        detected = self.gpio.event_detected(pin)
+        if detected:
+            self.recorder.pin(EVENT, self.clock.time(), pin, 0)
+        return detected
+
+    def input_many(self, pins):
+        #Bulk read where the backend has one (gpiochip_backend), one pin at a time otherwise
+        if hasattr(self.gpio, "input_many"):
+            levels = self.gpio.input_many(pins)
+        else:
+            levels = [int(self.gpio.input(pin)) for pin in pins]
+        now = self.clock.time()
+        for pin, level in zip(pins, levels):
+            if self.levels.get(pin, 1) != level:
+                self.levels[pin] = level
+                self.recorder.pin(BUTTON, now, pin, level)
+        return levels
+
+    def output(self, pin, value):
+        #One pin and value, or lists of them. Passed on as given so a list stays one step on the backend
+        now = self.clock.time()
+        pins = (pin,) if isinstance(pin, int) else pin
+        values = (value,) * len(pins) if isinstance(value, int) else value
+        for onePin, oneValue in zip(pins, values):
+            oneValue = int(oneValue)
+            if self.levels.get(onePin) != oneValue:
+                self.levels[onePin] = oneValue
+                self.recorder.pin(OUTPUT, now, onePin, oneValue)
+        self.gpio.output(pin, value)
+
+
+def read(path):
+    #Yields (type, time, value) where value is a temperature, a (pin, level) pair, a (name, value) command, a state
+    #dict or a list of LCD lines
+    with open(path, "rb") as traceFile:
+        if traceFile.read(len(magic)) != magic:
+            raise ValueError("{} is not a hot tub trace".format(path))
+        while True:
+            raw = traceFile.read(header.size)
+            if len(raw) < header.size:
+                return
+            recordType, when, length = header.unpack(raw)
+            payload = traceFile.read(length)
+            if len(payload) < length: #Cut off by a crash or power cut
+                return
+            if recordType == TEMP:
+                yield recordType, when, round(tempPayload.unpack(payload)[0], 1)
+            elif recordType == FRAME:
+                yield recordType, when, payload.decode("latin-1").split("\n")
+            elif recordType == COMMAND:
+                yield recordType, when, tuple(json.loads(payload.decode()))
+            elif recordType == STATE:
+                yield recordType, when, json.loads(payload.decode())
+            else:
+                yield recordType, when, pinPayload.unpack(payload)
+
+
+class trace_sensor:
+    #Sensor stand-in that returns whatever temperature the trace had at the current virtual time
+    def __init__(self, clock, samples):
+        self.clock = clock
+        self.samples = samples #[(time, temp)] in time order
+        self.index = 0
+        self.resolution = 12
+
+    def get_temperature(self):
+        while self.index + 1 < len(self.samples) and self.samples[self.index + 1][0] <= self.clock.now:
+            self.index += 1
+        return self.samples[self.index][1]
+
+    def set_resolution(self, bits):
+        self.resolution = bits
+        return True
+
+
+def replay(path, options=None, tolerance=2):
+    #Runs the trace back through the controller. Returns (recorded outputs, replayed outputs, differences), where
+    #outputs are [(time, pin, level)] and a difference is a (recorded, replayed) pair that doesn't match in pin and
+    #level, or is more than tolerance seconds apart. Missing entries show up as None
+    samples = []
+    inputs = []
+    commands = []
+    recorded = []
+    initialState = None
+    for recordType, when, value in read(path):
+        if recordType == TEMP:
+            samples.append((when, value))
+        elif recordType == COMMAND:
+            commands.append((when, value))
+        elif recordType == STATE:
+            initialState = value
+        elif recordType in (BUTTON, EVENT):
+            inputs.append((recordType, when, value))
+        elif recordType == OUTPUT:
+            recorded.append((when, value[0], value[1]))
+    if not samples:
+        raise ValueError("No temperature samples in {}".format(path))
+    start = samples[0][0]
+    end = max(samples[-1][0], recorded[-1][0] if recorded else 0, inputs[-1][1] if inputs else 0)
+
+    #Never touch the live state file or write a new trace while replaying. The state file goes in the
+    #simulation's temp dir unless options give one
+    options = dict(options or {}, traceFile="")
+    sim = sim_backend.simulation(start, (end - start) / 3600 + 1 / 3600, options)
+    if initialState is not None: #Start from what the recorded controller loaded, through the same state file
+        startState = state_journal.journal(sim.options["stateFile"])
+        for name, value in initialState.items():
+            startState.set(name, value, start)
+        startState.flush(start, force=True)
+    sim.sensor = trace_sensor(sim.clock, samples)
+    sim.display = False #Only the relays are compared
+    polledPins = set(pin for recordType, when, (pin, level) in inputs if recordType == BUTTON)
+    for recordType, when, (pin, level) in inputs:
+        if recordType == EVENT:
+            if pin in polledPins: #Edge of a level change that is replayed anyway
+                continue
+            sim.clock.schedule(when, lambda pin=pin: sim.gpio.press(pin))
+        else:
+            sim.clock.schedule(when, lambda pin=pin, level=level: sim.gpio.setInput(pin, level))
+    if commands:
+        sim.webApi = sim_backend.web_commands()
+        for when, (name, value) in commands:
+            sim.clock.schedule(when, lambda name=name, value=value: sim.webApi.command(name, value))
+    sim_backend.run(sim)
+
+    replayed = list(sim.gpio.transitions)
+    differences = []
+    for index in range(max(len(recorded), len(replayed))):
+        old = recorded[index] if index < len(recorded) else None
+        new = replayed[index] if index < len(replayed) else None
+        if old is None or new is None or old[1:] != new[1:] or abs(old[0] - new[0]) > tolerance:
+            differences.append((old, new))
+    return recorded, replayed, differences
+
+
+if __name__ == '__main__':
+    realStart = time.time()
+    options = {}
+    for argument in sys.argv[2:]:
+        name, value = argument.split("=", 1)
+        options[name] = ast.literal_eval(value)
+    recorded, replayed, differences = replay(sys.argv[1], options)
+    print("Replayed {} recorded relay changes in {:.1f} s, {} differences".format(len(recorded), time.time() - realStart, len(differences)))
+    for old, new in differences[:20]:
+        print("  recorded {}  replayed {}".format(old, new))
@@ -0,0 +1,487 @@
+#!/usr/bin/python3
+#
+#The control rules for one tub: the filter only, schedule and hold temp modes, preheating for the schedule window,
+#manual mode from the buttons, and the heater interlock and cooldown through relay_outputs. A controller holds all
+#of one tub's state, so hottubcontrol.py runs one of them and multi_tub.py runs one per tub. Everything around the
+#rules (reading the sensor and buttons, the LCD, the web API, metrics, history) stays with the caller, which sets
+#currentTemp/controlTemp and tempTime, calls control() and readButtons() each pass, then commit() and saveState().
+
+import math
+import time
+
+import relay_outputs
+import state_journal
+import thermal_model
+import weekly_schedule
+
+
+#Options a controller takes, with their defaults. See hottubcontrol.py's user options for what each one does
+defaults = {
+    "debug": 0,
+    "defaultMode": 1,
+    "targetTemp": 98, #On first boot, relatively safe
+    "minTemp": 60,
+    "maxTemp": 108,
+    "maxTempSag": 0.2,
+    "sensorWarmupTime": 60,
+    "maxTempAge": 120,
+    "heaterCooldownTimeMinutes": 5,
+    "inactivityTimeoutMinutes": 60,
+    "screenTimeoutMinutes": 5,
+    "scheduleWindows": [("daily", "18:00", "21:00")],
+    "scheduleExceptions": [],
+    "tempCheckTimes": [0],
+    "enablePreheat": 1,
+    "maxPreheatMinutes": 180,
+    "stateFile": "hottubstate.json",
+    "stateSaveInterval": 60,
+}
+buttonActions = ("pump", "blower", "light", "mode", "tempUp", "tempDown")
+
+
+class controller:
+    __slots__ = ("options", "debug", "relays", "schedule", "journal", "thermalModel", "pumpStarted", "runMode",
+                 "manualMode", "targetTemp", "turnOnTemp", "currentTemp", "controlTemp", "tempTime", "pumpStatus", "heatStatus",
+                 "blowerStatus", "lightStatus", "buttonLedStatus", "pumpStartTime", "heaterOffTime", "buttonPressTime",
+                 "inactivityTime", "loopProtect", "inTimeWindow", "inCheckTime", "scheduleValidFrom",
+                 "scheduleValidUntil", "preheatStartTime", "preheatWindow", "inPreheat", "now", "faulted")
+
+    def __init__(self, options, gpio, pins, now, pumpStarted=None):
+        #pins is output name: pin for pumpLow, pumpHigh, heater, blower, light and buttonLed, already set up off.
+        #pumpStarted is called when the pump goes on from off, e.g. to get the sensor out of its slow sampling
+        options = dict(defaults, **options)
+        self.options = options
+        self.debug = options["debug"]
+        self.relays = relay_outputs.outputs(gpio, pins, cooldowns={"heater": options["heaterCooldownTimeMinutes"] * 60},
+            interlocks={"heater": ("pumpLow", "pumpHigh")}) #The heater should NEVER be on without the pump
+        self.schedule = weekly_schedule.schedule(options["scheduleWindows"], options["scheduleExceptions"], options["tempCheckTimes"])
+        self.pumpStarted = pumpStarted
+        #runMode, targetTemp and the rest of the journal come back from stateFile, so they survive a power failure
+        self.journal = state_journal.journal(options["stateFile"], options["stateSaveInterval"])
+        saved = self.journal.load()
+        self.runMode = saved.get("runMode", options["defaultMode"]) #0 is filter only (summer mode), 1 is schedule mode, 2 is hold-temp mode
+        if self.runMode not in [0, 1, 2]:
+            self.runMode = options["defaultMode"]
+        self.manualMode = 0 #Manual mode overrides some settings while people are in the hot tub
+        self.targetTemp = min(max(saved.get("targetTemp", options["targetTemp"]), options["minTemp"]), options["maxTemp"])
+        self.turnOnTemp = self.targetTemp - options["maxTempSag"]
+        self.currentTemp = 0
+        self.controlTemp = 0 #currentTemp after the caller's filter. This is what the heater decisions compare against
+        self.tempTime = 0 #When the caller last got a good reading. 0 until the first one
+        self.thermalModel = thermal_model.model()
+        self.thermalModel.restore(saved.get("thermalModel", {}))
+        self.pumpStatus = 0
+        self.heatStatus = 0
+        self.blowerStatus = 0
+        self.lightStatus = 0
+        self.buttonLedStatus = 0
+        self.pumpStartTime = 0
+        self.heaterOffTime = saved.get("heaterOffTime", 0) #So a quick restart can't skip the cooldown
+        if saved.get("heatStatus"): #Went down with the heater on, or before saving that it went off. Cool down from now
+            self.heaterOffTime = now
+        self.relays.restore(saved.get("relays", {}))
+        if self.heaterOffTime:
+            self.relays.offTimes["heater"] = self.heaterOffTime
+        self.buttonPressTime = 0
+        self.inactivityTime = 0
+        self.loopProtect = 0
+        self.inTimeWindow = 0
+        self.inCheckTime = 0
+        self.scheduleValidFrom = 0 #The schedule state holds from scheduleValidFrom until scheduleValidUntil
+        self.scheduleValidUntil = 0
+        self.preheatStartTime = 0
+        self.preheatWindow = 0 #Start of the window preheating began for, so it only happens once per window
+        self.inPreheat = 0
+        self.now = now
+        self.faulted = False
+        self.updateSchedule() #Compiles the schedule now rather than in the first pass
+
+    def sensorWarm(self):
+        #The sensor is mounted externally, so it only reflects the water once the pump has run sensorWarmupTime
+        return self.now - self.pumpStartTime >= self.options["sensorWarmupTime"]
+
+    def tempFresh(self):
+        #Whether controlTemp comes from a reading recent enough to heat on. A failed sensor keeps the heater off
+        return self.tempTime != 0 and self.now - self.tempTime <= self.options["maxTempAge"]
+
+    def sensorPolicy(self, nearSetpointBand):
+        #Name of the temperature sampling policy for the current state, see hottubcontrol.py's sensorPolicies
+        if self.pumpStatus == 0:
+            return "pump off"
+        if not self.sensorWarm():
+            return "warmup"
+        if (abs(self.currentTemp - self.turnOnTemp) <= nearSetpointBand or abs(self.currentTemp - self.targetTemp) <= nearSetpointBand):
+            return "near setpoint"
+        if self.heatStatus == 1:
+            return "heating"
+        return "normal"
+
+    def control(self, now):
+        #The mode part of one pass: schedule, preheat, manual mode and the run mode's rules
+        self.now = now
+        self.inactivityTime = now - self.buttonPressTime
+        if now >= self.scheduleValidUntil or now < self.scheduleValidFrom: #Nothing in the schedule changes in between, unless the clock is set back
+            self.updateSchedule()
+        if self.debug:
+            if (self.inTimeWindow == 1):
+                print ("Within schedule window")
+            else:
+                print ("Outside schedule window")
+        #Learn heating/cooling rates, and see whether it's time to preheat for the next window
+        self.thermalModel.update(now, self.controlTemp, self.heatStatus, self.pumpStatus != 0 and self.sensorWarm() and self.tempFresh())
+        self.updatePreheat()
+        if self.debug:
+            print ("Thermal model", self.thermalModel.describe())
+            if self.inPreheat:
+                print ("Preheating for the schedule window")
+            elif self.preheatStartTime:
+                print ("Preheat starts at", time.strftime("%H:%M", time.localtime(self.preheatStartTime)))
+        if self.manualMode == 1:
+            if self.debug:
+                print ("Running in manual mode")
+            self.manualRunMode()
+        #Check run mode, do that stuff
+        if self.runMode == 0:
+            self.filterOnlyMode()
+        elif self.runMode == 1:
+            self.scheduleMode()
+        else:
+            self.holdTempMode()
+        if self.heatStatus != 0 and not self.tempFresh(): #No reading to turn it off by
+            if self.debug:
+                print ("No temperature reading for", self.options["maxTempAge"], "seconds, heater off")
+            self.heaterOff()
+
+    def updateSchedule(self):
+        scheduleState, self.scheduleValidFrom, self.scheduleValidUntil = self.schedule.lookup(self.now)
+        self.inTimeWindow = int(scheduleState & weekly_schedule.window != 0)
+        self.inCheckTime = int(scheduleState & weekly_schedule.check != 0)
+
+    def filterOnlyMode(self):
+        if self.heatStatus != 0: #Shut off heater if it's on
+            self.heaterOff()
+        if self.manualMode != 1:
+            if (self.inTimeWindow == 1): #If within time window, run pump on low
+                if self.pumpStatus == 0:
+                    self.pumpRunLow()
+            else:
+                if self.pumpStatus != 0:
+                    self.pumpOff()
+
+    def updatePreheat(self):
+        #Work out when to start heating ahead of the schedule window, from the learned heating and cooling rates
+        windowStart = None
+        if self.options["enablePreheat"] and self.runMode == 1 and self.inTimeWindow == 0:
+            windowStart = self.schedule.nextWindowStart(self.now)
+        if windowStart is None:
+            self.preheatStartTime = 0
+            self.preheatWindow = 0
+            self.inPreheat = 0
+        elif self.preheatWindow == windowStart:
+            #Already started. The estimate shrinks as the water heats, so recomputing would stop and restart the pump.
+            #Carry on until the window opens or the water is up to temperature, then leave it for the window
+            if self.inPreheat and self.sensorWarm() and self.tempFresh() and self.controlTemp >= self.targetTemp:
+                self.inPreheat = 0
+        else:
+            warmup = 0 if self.pumpStatus != 0 and self.sensorWarm() else self.options["sensorWarmupTime"] #No wait if the pump is already running
+            self.preheatStartTime = self.thermalModel.preheatStart(windowStart, self.targetTemp, warmup, self.options["maxPreheatMinutes"] * 60)
+            if self.now >= self.preheatStartTime:
+                self.preheatWindow = windowStart
+                self.inPreheat = 1
+
+    def scheduleMode(self):
+        #if manualMode != 1: #Moving the manual check to later in this function
+        if (self.inTimeWindow == 1 or self.inPreheat == 1): #If within time window (or heating up for it), run pump on low
+            if self.pumpStatus == 0: #Note this isn't the usual != 1 here; we don't want to force low speed if someone has high speed going instead. This does prevent a user from stopping the pump during this time
+                self.pumpRunLow()
+            if self.manualMode != 1: #Manual mode does this already. No need to do it twice per loop
+                if self.sensorWarm(): #If sensor has had a chance to warm up, compare temps
+                    if self.debug:
+                        print ("Sensor warm")
+                    if (self.controlTemp < self.turnOnTemp):
+                        if self.heatStatus != 1:
+                            self.heaterOn()
+                    elif (self.controlTemp >= self.targetTemp):
+                        if self.heatStatus != 0:
+                            self.heaterOff()
+                elif self.debug:
+                    print ("Sensor not warmed up")
+        elif self.manualMode != 1: #Dont shut off the pump if in manual mode
+            if self.heatStatus != 0:
+                self.heaterOff()
+            if self.pumpStatus != 0:
+                self.pumpOff()
+
+    def holdTempMode(self):
+        if self.manualMode != 1: #Manual mode has its own temperature holding. The temp check intervals holdTemp mode uses are so close together it doesn't matter if a user skips one
+            if (self.inCheckTime == 1 or self.pumpStatus != 0): #If current time is one of the listed minutes OR if pump is already running check the temp. The pumpstatus check allows sensor warmups > 1 minute
+                if self.debug:
+                    print("Check temperature now - loopProtect", self.loopProtect)
+                if (self.pumpStatus != 1 and self.loopProtect == 0): #If pump is not on low and we haven't already started it before, turn it on
+                    self.pumpRunLow()
+                    self.loopProtect = 1 #Prevent pump from being restarted multiple times in the check period, since the reading could finish in less than 60 seconds
+                if self.sensorWarm(): #If sensor has had a chance to warm up, compare temps
+                    if self.debug:
+                        print ("Sensor warm")
+                    if (self.controlTemp < self.targetTemp):
+                        if (self.heatStatus != 1 and self.pumpStatus != 0):
+                            self.heaterOn()
+                    else:
+                        self.heaterOff()
+                        self.pumpOff() #If up to temp after sensor caught up, shut everything off.
+                elif self.debug:
+                    print ("Sensor not warmed up")
+            else:
+                self.pumpOff()
+                self.loopProtect = 0 #Reset loop protection once outside of check period
+                if self.debug:
+                    print ("Not time to check temperature")
+
+    def manualRunMode(self):
+        if self.inactivityTime > self.options["inactivityTimeoutMinutes"] * 60: #If idle for too long, exit manual mode
+            if self.debug:
+                print ("Leaving manual mode due to inactivity")
+            #Look into flashing some lights as a warning, or putting something on the LCD
+            self.heaterOff()
+            self.pumpOff()
+            self.blowerOff()
+            self.lightOff()
+            self.manualMode = 0
+        if (self.pumpStatus != 2 and self.blowerStatus == 0 and self.lightStatus == 0): #If user shuts everything off (with pump off or low), disable manual mode to resume normal functions
+            if (self.pumpStatus == 0 or self.inTimeWindow == 1): #Pump on low is as "off" as it gets in a time window
+                if self.debug:
+                    print ("Everything is off - Leaving manual mode")
+                self.manualMode = 0
+        if self.runMode != 0: #No heat in filter-only mode
+            if self.pumpStatus != 0: #Dont do any heat related stuff if the pump is off. Remember that the blower and light will also trigger manual mode
+                if self.sensorWarm(): #If sensor has had a chance to warm up, compare temps
+                    if self.debug:
+                        print ("Sensor warm")
+                    if (self.controlTemp < self.turnOnTemp):
+                        if self.heatStatus != 1:
+                            self.heaterOn()
+                    elif (self.controlTemp >= self.targetTemp):
+                        if self.heatStatus != 0:
+                            self.heaterOff()
+                elif self.debug:
+                    print ("Sensor not warmed up")
+            else: #Safeguard to make sure the heater isnt running if the user stops the pump in manual mode
+                if self.heatStatus != 0:
+                    self.heaterOff()
+
+    #The output functions below only change what relays wants. commit() writes the real changes once per pass
+    def pumpRunLow(self):
+        self.relays.set("pumpLow", True, self.now)
+        self.relays.set("pumpHigh", False, self.now)
+        if self.pumpStatus == 0: #Only reset this if the pump was off
+            self.pumpStartTime = self.now
+            if self.pumpStarted is not None:
+                self.pumpStarted()
+        self.pumpStatus = 1
+
+    def pumpRunHigh(self):
+        #Shut off pumpLow, turn on pumpHigh. I don't know what would happen if both were on, but let's not find out.
+        self.relays.set("pumpLow", False, self.now)
+        self.relays.set("pumpHigh", True, self.now)
+        if self.pumpStatus == 0: #Only reset this if the pump was off
+            self.pumpStartTime = self.now
+            if self.pumpStarted is not None:
+                self.pumpStarted()
+        self.pumpStatus = 2
+
+    def pumpOff(self):
+        self.heaterOff() #Turn off heater before stopping pump
+        self.relays.set("pumpLow", False, self.now)
+        self.relays.set("pumpHigh", False, self.now)
+        self.pumpStatus = 0
+
+    def heaterOn(self):
+        #relays refuses while the heater is in its cooldown or no pump is on
+        if not self.tempFresh():
+            if self.debug:
+                print("Heater held off, no recent temperature reading")
+            return
+        if self.relays.set("heater", True, self.now):
+            self.heatStatus = 1
+            if self.debug:
+                print("Heater on")
+        elif self.debug:
+            print("Heater held off, cooldown remaining", self.relays.cooldownRemaining("heater", self.now))
+
+    def heaterOff(self):
+        if self.heatStatus != 0: #Only a real change starts the cooldown again
+            self.heaterOffTime = self.now
+            if self.debug:
+                print("Heater off")
+        self.relays.set("heater", False, self.now)
+        self.heatStatus = 0
+
+    def blowerOn(self):
+        self.relays.set("blower", True, self.now)
+        self.blowerStatus = 1
+
+    def blowerOff(self):
+        self.relays.set("blower", False, self.now)
+        self.blowerStatus = 0
+
+    def lightOn(self):
+        self.relays.set("light", True, self.now)
+        self.lightStatus = 1
+
+    def lightOff(self):
+        self.relays.set("light", False, self.now)
+        self.lightStatus = 0
+
+    def buttonLedOn(self):
+        self.relays.set("buttonLed", True, self.now)
+        self.buttonLedStatus = 1
+
+    def buttonLedOff(self):
+        self.relays.set("buttonLed", False, self.now)
+        self.buttonLedStatus = 0
+
+    def readButtons(self, pressed):
+        #Act on the buttons pressed since the last pass, a collection of buttonActions
+        #Kill screen saver on first press of any button, without activating that button's function
+        if self.buttonLedStatus == 0:
+            if pressed:
+                self.buttonPressTime = self.now #Note time for inactivity timer
+            return
+        #Pump
+        if "pump" in pressed:
+            self.buttonPressTime = self.now #Note time for inactivity timer
+            if self.debug:
+                print ("Pump button pressed")
+            self.manualMode = 1
+            if self.pumpStatus == 0: #If pump is off, start it on low
+                self.pumpRunLow()
+            elif self.pumpStatus == 1: #If pump is on low, set it on high
+                self.pumpRunHigh()
+            else:
+                if (self.runMode == 2 or self.inTimeWindow == 0): #If in hold temp mode, turn off. If in filter only or schedule mode but not in a time window, turn off
+                    self.pumpOff()
+                else: #Revert to low speed if in schedule mode in a time window. Manual mode will exit on its own
+                    self.pumpRunLow()
+        #Blower
+        if "blower" in pressed:
+            self.buttonPressTime = self.now #Note time for inactivity timer
+            if self.debug:
+                print ("Blower button pressed")
+            self.manualMode = 1
+            if self.blowerStatus == 0:
+                self.blowerOn()
+            else:
+                self.blowerOff()
+        #Light
+        if "light" in pressed:
+            self.buttonPressTime = self.now #Note time for inactivity timer
+            if self.debug:
+                print ("Light button pressed")
+            self.manualMode = 1
+            if self.lightStatus == 0:
+                self.lightOn()
+            else:
+                self.lightOff()
+        #Mode
+        if "mode" in pressed:
+            if self.debug:
+                print ("Mode button pressed")
+            self.setRunMode((self.runMode + 1) % 3)
+        #TempUp
+        if "tempUp" in pressed:
+            if self.debug:
+                print ("TempUp button pressed")
+            if self.targetTemp < self.options["maxTemp"]:
+                self.setTargetTemp(self.targetTemp + 1)
+        #TempDown
+        if "tempDown" in pressed:
+            if self.debug:
+                print ("TempDown button pressed")
+            if self.targetTemp > self.options["minTemp"]:
+                self.setTargetTemp(self.targetTemp - 1)
+
+    def setRunMode(self, mode):
+        if mode in (0, 1, 2): #Anything else is ignored, whatever the caller checked
+            self.runMode = int(mode)
+
+    def setTargetTemp(self, temp):
+        #From the temp buttons or a web command, kept within minTemp and maxTemp. NaN would get through min/max
+        #and never compare true against controlTemp, so non-finite values are ignored
+        if not math.isfinite(temp):
+            return
+        self.targetTemp = min(max(temp, self.options["minTemp"]), self.options["maxTemp"])
+        self.turnOnTemp = self.targetTemp - self.options["maxTempSag"]
+
+    def screenOn(self):
+        #False once the screensaver is due
+        return self.inactivityTime < self.options["screenTimeoutMinutes"] * 60
+
+    def commit(self):
+        #Write this pass's relay changes. Returns False if the heater is somehow on without the pump, which the
+        #caller should treat as a fault
+        self.relays.commit(self.now)
+        return not (self.pumpStatus == 0 and self.heatStatus != 0) #The heater should NEVER be on without the pump
+
+    def fault(self):
+        #Everything off and saved. Only this tub, the caller decides what else stops
+        self.heaterOff()
+        self.pumpOff()
+        self.blowerOff()
+        self.lightOff()
+        self.relays.commit(self.now)
+        self.faulted = True
+        self.saveState(force=True)
+
+    def recordState(self):
+        #Hand the state worth keeping to the journal, without writing it
+        journal = self.journal
+        journal.set("runMode", self.runMode, self.now)
+        journal.set("targetTemp", self.targetTemp, self.now)
+        journal.set("heaterOffTime", self.heaterOffTime, self.now)
+        journal.set("heatStatus", self.heatStatus, self.now, urgent=True) #With heaterOffTime, written as soon as the heater changes
+        if self.thermalModel.changed:
+            journal.set("thermalModel", self.thermalModel.state(), self.now)
+            self.thermalModel.changed = False
+        if self.relays.changed:
+            journal.set("relays", self.relays.state(), self.now)
+            self.relays.changed = False
+
+    def saveState(self, force=False):
+        #recordState() and write it if it's due. It only goes to the SD card once changes settle, see state_journal.py
+        self.recordState()
+        try:
+            if self.journal.flush(self.now, force) and self.debug:
+                print ("State saved to", self.journal.path)
+        except OSError as error:
+            self.journal.failed(self.now)
+            if self.debug:
+                print ("Couldn't save state:", error)
+
+    def saveDue(self):
+        #When the journal next wants writing, or None if nothing changed
+        return self.journal.nextDue()
+
+    def nextDeadline(self, latest):
+        #Earliest time something control() acts on can change without a button press or temperature, up to latest
+        now = self.now
+        deadline = min(latest, self.scheduleValidUntil) #Next schedule window or hold temp check change
+        screenTimeout = self.options["screenTimeoutMinutes"] * 60
+        if self.inactivityTime < screenTimeout:
+            deadline = min(deadline, int(now) + 1) #Clock repaint
+            deadline = min(deadline, self.buttonPressTime + screenTimeout) #Screensaver
+        if self.manualMode == 1:
+            deadline = min(deadline, self.buttonPressTime + self.options["inactivityTimeoutMinutes"] * 60 + 0.001) #manualRunMode checks for strictly over the timeout
+        if self.preheatStartTime > now:
+            deadline = min(deadline, self.preheatStartTime)
+        saveDue = self.saveDue()
+        if saveDue is not None: #Save once changes have settled
+            deadline = min(deadline, saveDue)
+        if self.pumpStatus != 0:
+            if not self.sensorWarm():
+                deadline = min(deadline, self.pumpStartTime + self.options["sensorWarmupTime"])
+            heaterCooldownTime = self.options["heaterCooldownTimeMinutes"] * 60
+            if self.heatStatus == 0 and now - self.heaterOffTime <= heaterCooldownTime:
+                deadline = min(deadline, self.heaterOffTime + heaterCooldownTime + 0.001)
+            if self.heatStatus != 0 and self.tempTime:
+                deadline = min(deadline, self.tempTime + self.options["maxTempAge"] + 0.001) #Reading goes stale
+        return max(deadline, now)
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+#
+#Local HTTP/JSON status and control API. An asyncio server runs in its own thread and never touches controller
+#state. The main loop hands it a status tuple each pass. Only when that changes is it turned into JSON, with the
+#whole HTTP response built ahead of time, so a GET is one socket write of a cached bytes object. Commands are put
+#on a queue that the main loop drains, so a burst of requests costs the control loop nothing but the queue reads.
+#
+#  GET /status            current status as JSON
+#  POST /command          {"targetTemp": 101} or {"runMode": 2}, any of commandNames. Answers 202 once queued
+#
+#Usage: python3 web_api.py [port] serves a fixed status and prints the commands it receives
+
+import asyncio
+import json
+import math
+import queue
+import threading
+import time
+
+
+commandNames = ("targetTemp", "runMode")
+maxBodySize = 4096
+
+
+def response(status, body, contentType="application/json"):
+    return ("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nCache-Control: no-store\r\n\r\n".format(
+        status, contentType, len(body))).encode() + body
+
+
+def jsonResponse(status, value):
+    return response(status, json.dumps(value).encode())
+
+
+notFound = jsonResponse("404 Not Found", {"error": "not found"})
+notAllowed = jsonResponse("405 Method Not Allowed", {"error": "method not allowed"})
+noStatus = jsonResponse("503 Service Unavailable", {"error": "no status yet"})
+
+
+class server:
+    def __init__(self, address="127.0.0.1", port=8080, wake=None):
+        self.address = address
+        self.port = port #0 picks a free port, see boundPort once started
+        self.wake = wake #Called after a command is queued, e.g. the main loop's wakeEvent.set
+        self.commands = queue.SimpleQueue() #(name, value) for the main loop to apply
+        self.statusResponse = noStatus #Whole HTTP response for GET /status, swapped in one assignment
+        self.lastStatus = None
+        self.statusUpdates = 0
+        self.requests = 0
+        self.boundPort = None
+        self.loop = None
+        self.started = threading.Event()
+        self.error = None #Why the server couldn't listen, from run()
+
+    def start(self):
+        #Returns once the server is listening. Raises OSError if it couldn't, e.g. the port is in use
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+        if not self.started.wait(5):
+            raise OSError("web API didn't start listening on {}:{}".format(self.address, self.port))
+        if self.error is not None:
+            raise self.error
+        return thread
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            listener = self.loop.run_until_complete(asyncio.start_server(self.handle, self.address, self.port))
+        except OSError as error:
+            self.error = error
+            self.started.set()
+            self.loop.close()
+            return
+        self.boundPort = listener.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def publish(self, fieldNames, values, when=None):
+        #Called by the main loop every pass. Does nothing unless values differs from last time. when is the
+        #controller's time of the change
+        if values == self.lastStatus:
+            return False
+        self.lastStatus = values
+        status = dict(zip(fieldNames, values))
+        status["changed"] = time.time() if when is None else when
+        self.statusResponse = jsonResponse("200 OK", status)
+        self.statusUpdates += 1
+        return True
+
+    def pending(self):
+        #Yields queued commands without blocking
+        while True:
+            try:
+                yield self.commands.get_nowait()
+            except queue.Empty:
+                return
+
+    def command(self, body):
+        try:
+            request = json.loads(body.decode() or "{}")
+        except ValueError:
+            return jsonResponse("400 Bad Request", {"error": "body is not JSON"})
+        if not isinstance(request, dict) or not request:
+            return jsonResponse("400 Bad Request", {"error": "expected an object like {\"targetTemp\": 101}"})
+        for name, value in request.items():
+            if name not in commandNames:
+                return jsonResponse("400 Bad Request", {"error": "unknown command " + name})
+            if name == "runMode" and value not in (0, 1, 2):
+                return jsonResponse("400 Bad Request", {"error": "runMode must be 0, 1 or 2"})
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                return jsonResponse("400 Bad Request", {"error": name + " must be a number"})
+            try:
+                finite = math.isfinite(value) #json.loads takes NaN and Infinity
+            except OverflowError: #An integer too big for a float, like 10**400 written out in digits
+                return jsonResponse("400 Bad Request", {"error": name + " is out of range"})
+            if not finite:
+                return jsonResponse("400 Bad Request", {"error": name + " must be finite"})
+        for name, value in request.items():
+            self.commands.put((name, value))
+        if self.wake is not None:
+            self.wake()
+        return jsonResponse("202 Accepted", {"queued": request})
+
+    async def handle(self, reader, writer):
+        #HTTP/1.1 with keep-alive, just enough for curl, browsers and home automation clients
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                contentLength = 0
+                close = False
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.partition(b":")
+                    name = name.strip().lower()
+                    if name == b"content-length":
+                        contentLength = int(value.strip() or 0)
+                    elif name == b"connection" and value.strip().lower() == b"close":
+                        close = True
+                parts = requestLine.split()
+                if len(parts) < 2 or contentLength > maxBodySize:
+                    writer.write(jsonResponse("400 Bad Request", {"error": "bad request"}))
+                    break
+                body = await reader.readexactly(contentLength) if contentLength else b""
+                method, path = parts[0], parts[1].split(b"?")[0]
+                self.requests += 1
+                if path == b"/status":
+                    writer.write(self.statusResponse if method == b"GET" else notAllowed)
+                elif path == b"/command":
+                    writer.write(self.command(body) if method == b"POST" else notAllowed)
+                else:
+                    writer.write(notFound)
+                await writer.drain()
+                if close or parts[-1] == b"HTTP/1.0":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+if __name__ == '__main__':
+    import sys
+    api = server(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+    api.start()
+    api.publish(("targetTemp", "runMode"), (98, 1))
+    print("Serving on port", api.boundPort)
+    while True:
+        name, value = api.commands.get()
+        print("Command", name, value)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+#
+#Weekly schedule for the filter/heat windows and the hold temp check times. The windows, one-off exceptions and
+#check minutes are compiled into a table of the times the state changes over the next week or so, worked out from
+#local wall clock times one day at a time with mktime, so a window that opens at 18:00 opens at 18:00 on both sides
+#of a DST change. lookup() finds the state for a time, and how long it holds, by bisecting the table. The main loop
+#keeps the answer until then instead of working the schedule out again every pass.
+#
+#Usage: python3 weekly_schedule.py prints the next week's transitions for the schedule in hottubcontrol.py's defaults
+
+from array import array
+from bisect import bisect_right
+import time
+
+
+window = 1 #State bits. In a filter/heat window
+check = 2 #In a hold temp check minute
+dayNames = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+dayGroups = {"daily": range(7), "weekdays": range(5), "weekends": range(5, 7)}
+lookBehind = 86400 #Seconds before the lookup time the table starts, for windows that were already open
+lookAhead = 8 * 86400 #And after it, so the next start of a weekly window is always in the table
+
+
+def parseDays(days):
+    #"daily", "weekdays", "weekends" or names like "mon,wed,fri", to tm_wday numbers
+    if days in dayGroups:
+        return set(dayGroups[days])
+    try:
+        return {dayNames.index(name.strip().lower()[:3]) for name in days.split(",")}
+    except ValueError:
+        raise ValueError("Unknown schedule days {!r}, use daily, weekdays, weekends or names like mon,wed".format(days))
+
+
+def parseClock(clockTime):
+    #"HH:MM" to (hour, minute)
+    try:
+        hour, minute = (int(part) for part in clockTime.split(":"))
+    except ValueError:
+        raise ValueError("Schedule times should be HH:MM, not {!r}".format(clockTime))
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        raise ValueError("Schedule time {!r} is out of range".format(clockTime))
+    return hour, minute
+
+
+def parseDate(dateTime):
+    #"YYYY-MM-DD HH:MM" local time to epoch time
+    try:
+        return time.mktime(time.strptime(dateTime, "%Y-%m-%d %H:%M")[:8] + (-1,))
+    except ValueError:
+        raise ValueError("Schedule exception times should be YYYY-MM-DD HH:MM, not {!r}".format(dateTime))
+
+
+class schedule:
+    def __init__(self, windows, exceptions=(), checkMinutes=()):
+        #windows: (days, "HH:MM" start, "HH:MM" end). An end before the start runs past midnight into the next day,
+        #one equal to the start is a full 24 hours.
+        #exceptions: ("YYYY-MM-DD HH:MM" start, same end, 1 or 0), forcing the window on or off over that time.
+        #checkMinutes: minutes of every hour that are hold temp check times, as in tempCheckTimes
+        self.windows = [(parseDays(days), parseClock(start), parseClock(end)) for days, start, end in windows]
+        self.exceptions = [(parseDate(start), parseDate(end), bool(on)) for start, end, on in exceptions]
+        self.checkMinutes = sorted(set(checkMinutes))
+        for minute in self.checkMinutes:
+            if not 0 <= minute <= 59:
+                raise ValueError("Check minute {} is out of range".format(minute))
+        self.start = self.end = 0 #Span the table covers
+        self.times = array('d') #When each state starts, sorted
+        self.states = array('B')
+        self.windowStarts = array('d') #Times the window bit turns on
+        self.compiles = 0
+
+    def intervals(self, start, end):
+        #(from, to, kind) for everything that overlaps start to end. kind is "window", "on", "off" or "check"
+        found = []
+        day = time.localtime(start - 86400) #From the day before, for windows running over midnight
+        for dayOffset in range(int((end - start) // 86400) + 3):
+            year, month, date = day[0], day[1], day[2] + dayOffset
+            weekday = time.localtime(time.mktime((year, month, date, 12, 0, 0, 0, 0, -1)))[6]
+            for days, (startHour, startMinute), (endHour, endMinute) in self.windows:
+                if weekday not in days:
+                    continue
+                endDate = date + 1 if (endHour, endMinute) <= (startHour, startMinute) else date
+                found.append((time.mktime((year, month, date, startHour, startMinute, 0, 0, 0, -1)),
+                              time.mktime((year, month, endDate, endHour, endMinute, 0, 0, 0, -1)), "window"))
+        for exceptionStart, exceptionEnd, on in self.exceptions:
+            found.append((exceptionStart, exceptionEnd, "on" if on else "off"))
+        if self.checkMinutes:
+            #Step through in quarter hours, which every time zone's offset is a multiple of, so each step starts on a
+            #known local minute. A repeated hour at the end of DST gets its checks twice, like the wall clock says
+            step = start - start % 900
+            while step < end:
+                stepMinute = time.localtime(step)[4]
+                for minute in self.checkMinutes:
+                    if stepMinute <= minute < stepMinute + 15:
+                        checkStart = step + (minute - stepMinute) * 60
+                        found.append((checkStart, checkStart + 60, "check"))
+                step += 900
+        return [interval for interval in found if interval[1] > start and interval[0] < end]
+
+    def compile(self, now):
+        #Build the table for lookBehind before now to lookAhead after it
+        self.start = now - lookBehind
+        self.end = now + lookAhead
+        events = []
+        for intervalStart, intervalEnd, kind in self.intervals(self.start, self.end):
+            events.append((max(intervalStart, self.start), kind, 1))
+            events.append((intervalEnd, kind, -1))
+        events.sort()
+        counts = dict.fromkeys(["window", "on", "off", "check"], 0)
+        self.times = array('d', [self.start])
+        self.states = array('B', [0])
+        self.windowStarts = array('d')
+        index = 0
+        while index < len(events):
+            when = events[index][0]
+            while index < len(events) and events[index][0] == when:
+                counts[events[index][1]] += events[index][2]
+                index += 1
+            state = 0
+            if (counts["window"] > 0 or counts["on"] > 0) and counts["off"] == 0:
+                state |= window
+            if counts["check"] > 0:
+                state |= check
+            if when <= self.start:
+                self.states[0] = state
+            elif state != self.states[-1]:
+                if state & window and not self.states[-1] & window:
+                    self.windowStarts.append(when)
+                self.times.append(when)
+                self.states.append(state)
+        self.compiles += 1
+
+    def lookup(self, now):
+        #(state, time it started, time it can next change). Past the last transition in the table the answer only
+        #holds until the table needs rebuilding
+        if not self.start <= now < self.end - lookBehind:
+            self.compile(now)
+        index = bisect_right(self.times, now) - 1
+        if index + 1 < len(self.times):
+            return self.states[index], self.times[index], min(self.times[index + 1], self.end - lookBehind)
+        return self.states[index], self.times[index], self.end - lookBehind
+
+    def nextWindowStart(self, now):
+        #Epoch time the window next opens after now, or None if it doesn't within lookAhead
+        if not self.start <= now < self.end - lookBehind:
+            self.compile(now)
+        index = bisect_right(self.windowStarts, now)
+        if index < len(self.windowStarts):
+            return self.windowStarts[index]
+        return None
+
+    def transitions(self, start, end):
+        #(time, state) for every change between start and end, for checking a schedule by eye
+        result = []
+        now = start
+        while now < end:
+            state, since, until = self.lookup(now)
+            result.append((now, state))
+            now = until
+        return result
+
+
+if __name__ == '__main__':
+    weekly = schedule([("daily", "18:00", "21:00")])
+    for when, state in weekly.transitions(time.time(), time.time() + 7 * 86400):
+        print(time.strftime("%a %Y-%m-%d %H:%M %Z", time.localtime(when)), "window" if state & window else "off")